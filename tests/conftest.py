@@ -0,0 +1,8 @@
+from __future__ import absolute_import, division, print_function
+import os
+import sys
+
+# allow running "pytest tests" from a source checkout
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import iotbx.phil # cctbx extensions need to be loaded before yamtbx modules
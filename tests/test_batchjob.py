@@ -0,0 +1,91 @@
+from __future__ import absolute_import, division, print_function
+import os
+import time
+import pytest
+
+from yamtbx.util import batchjob
+
+stubs_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stubs", "queue")
+
+@pytest.fixture
+def fake_queue(tmpdir, monkeypatch):
+    # qsub/qstat/sbatch/squeue in stubs/queue keep the queue in $FAKE_QUEUE_DIR
+    qdir = tmpdir.mkdir("queue")
+    monkeypatch.setenv("FAKE_QUEUE_DIR", str(qdir))
+    monkeypatch.setenv("PATH", stubs_dir + os.pathsep + os.environ["PATH"])
+    return qdir
+
+def n_queries(qdir):
+    queries = qdir.join("queries")
+    return len(queries.readlines()) if queries.check() else 0
+
+def make_jobs(tmpdir, n, sleep):
+    jobs = []
+    for i in range(n):
+        wdir = tmpdir.mkdir("job%d" % i)
+        j = batchjob.Job(str(wdir), "job.sh", copy_environ=False)
+        j.write_script("sleep %s\necho done > done.txt\n" % sleep)
+        jobs.append(j)
+    return jobs
+
+def test_base_list_queued_ids_is_failed_query(tmpdir):
+    jm = batchjob.ClusterJobManager(min_query_interval=0)
+    j = batchjob.Job(str(tmpdir), "job.sh")
+    jm.register_submitted(j, "1")
+    assert jm.list_queued_ids() is None
+    jm.update_states([j]) # states are kept
+    assert j.state == batchjob.STATE_SUBMITTED
+    assert jm.job_id == {j: "1"}
+
+def test_exec_local_notified_before_interval(tmpdir):
+    jm = batchjob.ExecLocal(max_parallel=2)
+    jobs = make_jobs(tmpdir, 3, 0.1)
+    for j in jobs: jm.submit(j)
+    t0 = time.time()
+    assert jm.wait_all(jobs, interval=30, timeout=20)
+    assert time.time() - t0 < 10
+    for j in jobs: assert os.path.isfile(os.path.join(j.wdir, "done.txt"))
+    jm.stop_all()
+
+@pytest.mark.parametrize("engine", [batchjob.SGE, batchjob.Slurm])
+def test_cluster_one_query_for_all_jobs(tmpdir, fake_queue, engine):
+    jm = engine(min_query_interval=5)
+    jobs = make_jobs(tmpdir, 4, 1)
+    for j in jobs: jm.submit(j)
+    assert len(set(jm.job_id.values())) == 4
+    assert all([j.state == batchjob.STATE_SUBMITTED for j in jobs])
+
+    for j in jobs: jm.update_state(j) # one query for all jobs
+    assert n_queries(fake_queue) == 1
+    assert all([j.state == batchjob.STATE_RUNNING for j in jobs])
+
+    for j in jobs: jm.update_state(j) # within min_query_interval; not queried
+    assert n_queries(fake_queue) == 1
+
+    jm.min_query_interval = 0.2
+    assert jm.wait_all(jobs, interval=0.2, timeout=30)
+    assert all([j.state == batchjob.STATE_FINISHED for j in jobs])
+    for j in jobs: assert os.path.isfile(os.path.join(j.wdir, "done.txt"))
+    assert n_queries(fake_queue) < 30
+    assert jm.job_id == {}
+
+@pytest.mark.parametrize("engine", [batchjob.SGE, batchjob.Slurm])
+def test_cluster_failed_query_keeps_states(tmpdir, fake_queue, engine):
+    jm = engine(min_query_interval=0)
+    jobs = make_jobs(tmpdir, 2, 0)
+    for j in jobs: jm.submit(j)
+
+    fake_queue.join("fail_query").write("")
+    time.sleep(1) # jobs finished, but the query fails
+    assert not jm.wait_all(jobs, interval=0.1, timeout=0.5)
+    assert all([j.state == batchjob.STATE_SUBMITTED for j in jobs])
+    assert len(jm.job_id) == 2
+
+    fake_queue.join("fail_query").remove()
+    assert jm.wait_all(jobs, interval=0.1, timeout=10)
+    assert all([j.state == batchjob.STATE_FINISHED for j in jobs])
+
+def test_cluster_missing_commands(tmpdir, monkeypatch):
+    monkeypatch.setenv("PATH", str(tmpdir))
+    with pytest.raises(batchjob.SgeError): batchjob.SGE()
+    with pytest.raises(batchjob.SlurmError): batchjob.Slurm()
@@ -0,0 +1,87 @@
+from __future__ import absolute_import, division, print_function
+import bz2
+import numpy
+import pytest
+
+from yamtbx.dataproc import cbf
+
+extremes = {numpy.int32: [0, -1, 1, 127, -128, 128, -129, 32767, -32768, 32768, -32769,
+                          2**31-1, -2**31, 2**31-1, 0, -2**31, 5],
+            numpy.uint32: [0, 1, 255, 2**32-1, 0, 2**31, 2**31-1, 2**32-1, 65535, 65536, 7],
+            numpy.int64: [0, 2**63-1, -2**63, 2**63-1, -1, 2**31, -2**31-1, 2**32, 0, -2**63, 9]}
+
+pilatus_header = "# Detector: PILATUS3 6M, S/N 60-0000\r\n# Exposure_time 0.1 s\r\n# Wavelength 1.0000 A"
+
+def make_data(dtype, n=10000, seed=0):
+    rs = numpy.random.RandomState(seed)
+    data = numpy.concatenate([numpy.array(extremes[dtype], dtype=dtype),
+                              rs.poisson(10, n).astype(dtype), # mostly 1-byte differences
+                              numpy.array(extremes[dtype][::-1], dtype=dtype)])
+    return data
+
+@pytest.mark.parametrize("dtype", sorted(extremes, key=str))
+def test_byte_offset_round_trip(dtype):
+    data = make_data(dtype)
+    enc = cbf.byte_offset_encode(data)
+    dec = cbf.byte_offset_decode(enc, len(data), dtype)
+    assert dec.dtype == dtype
+    assert numpy.array_equal(dec, data)
+
+def test_byte_offset_escape_sizes():
+    # 1, 3, 7 and 15 bytes per element for 8-, 16-, 32- and 64-bit differences
+    for v, size in ((1, 1), (200, 3), (70000, 7), (2**40, 15)):
+        data = numpy.array([v], dtype=numpy.int64)
+        assert len(cbf.byte_offset_encode(data)) == size
+
+def test_byte_offset_too_short():
+    enc = cbf.byte_offset_encode(numpy.arange(10, dtype=numpy.int32))
+    with pytest.raises(RuntimeError):
+        cbf.byte_offset_decode(enc, 11)
+
+@pytest.mark.parametrize("dtype", sorted(extremes, key=str))
+def test_minicbf_round_trip(tmpdir, dtype):
+    data = make_data(dtype, n=100*120-2*len(extremes[dtype]))
+    cbfout = str(tmpdir.join("test.cbf"))
+    cbf.write_minicbf_fast(data, 100, 120, "test", cbfout, pilatus_header=pilatus_header)
+
+    arr, ndimfast, ndimmid, ndimslow, text = cbf.read_minicbf_fast(cbfout)
+    assert (ndimfast, ndimmid, ndimslow) == (100, 120, 1)
+    assert arr.dtype == dtype
+    assert numpy.array_equal(arr, data)
+    assert b"# Exposure_time 0.1 s" in text
+
+def test_minicbf_md5_mismatch(tmpdir):
+    data = make_data(numpy.int32)
+    cbfout = str(tmpdir.join("test.cbf"))
+    cbf.write_minicbf_fast(data, len(data), 1, "test", cbfout)
+
+    raw = bytearray(open(cbfout, "rb").read())
+    raw[raw.find(cbf.CBF_BINARY_START) + len(cbf.CBF_BINARY_START) + 100] ^= 0x01 # flip one bit in binary
+    open(cbfout, "wb").write(bytes(raw))
+
+    with pytest.raises(RuntimeError):
+        cbf.read_minicbf_fast(cbfout)
+
+def test_minicbf_bz2(tmpdir):
+    data = make_data(numpy.int32, n=100*100-2*len(extremes[numpy.int32]))
+    cbfout = str(tmpdir.join("test.cbf"))
+    cbf.write_minicbf_fast(data, 100, 100, "test", cbfout, pilatus_header=pilatus_header)
+    raw = open(cbfout, "rb").read()
+    open(cbfout+".bz2", "wb").write(bz2.compress(raw))
+
+    text, rest = cbf.read_minicbf_header(cbfout+".bz2")
+    assert text == raw[:raw.find(cbf.CBF_BINARY_START)]
+    assert raw.endswith(rest)
+
+    assert cbf.get_pilatus_header(cbfout+".bz2").strip() == pilatus_header.replace("\r\n", "\n")
+
+    arr, ndimfast, ndimmid, ndimslow, _ = cbf.read_minicbf_fast(cbfout+".bz2")
+    assert (ndimfast, ndimmid) == (100, 100)
+    assert numpy.array_equal(arr, data)
+
+def test_read_minicbf_header_without_binary(tmpdir):
+    f = tmpdir.join("text.cbf")
+    f.write_binary(b"###CBF: VERSION 1.5\r\ndata_test\r\n")
+    text, rest = cbf.read_minicbf_header(str(f))
+    assert text == b"###CBF: VERSION 1.5\r\ndata_test\r\n"
+    assert rest == b""
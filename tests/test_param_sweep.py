@@ -0,0 +1,108 @@
+from __future__ import absolute_import, division, print_function
+import os
+import pytest
+
+from yamtbx.dataproc.xds import files
+from yamtbx.dataproc.xds import param_sweep
+from yamtbx.dataproc.xds import get_xdsinp_keyword
+
+stubs_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stubs", "xds")
+
+xdsinp_str = """\
+ JOB= XYCORR INIT COLSPOT IDXREF DEFPIX INTEGRATE CORRECT
+ NAME_TEMPLATE_OF_DATA_FRAMES= ../data/data_??????.cbf
+ DATA_RANGE= 1 100
+ MINPK= 75.0
+ WFAC1= 1.0
+"""
+
+@pytest.fixture
+def srcdir(tmpdir, monkeypatch):
+    # processed by fake xds (stubs/xds/xds) up to INTEGRATE
+    monkeypatch.setenv("PATH", stubs_dir + os.pathsep + os.environ["PATH"])
+    monkeypatch.setenv("FAKE_XDS_LOG", str(tmpdir.join("xds_runs.log")))
+    monkeypatch.setenv("FAKE_XDS_SLEEP", "0.5")
+    src = tmpdir.mkdir("src")
+    for f in files.needed_by_CORRECT: src.join(f).write("%s\n" % f)
+    src.join("XDS.INP").write(xdsinp_str)
+    return src
+
+def read_runs(srcdir):
+    # [(start, end, directory), ..] of fake xds runs
+    log = srcdir.dirpath("xds_runs.log")
+    if not log.check(): return []
+    starts, ends = {}, {}
+    for l in log.readlines():
+        sp = l.split()
+        {"start": starts, "end": ends}[sp[0]][sp[2]] = float(sp[1])
+    return [(starts[d], ends.get(d), d) for d in sorted(starts)]
+
+def make_tasks(n):
+    return [("CORRECT_wfac1_%.1f" % (1+i*0.1), [("JOB", "CORRECT"), ("WFAC1", "%.1f" % (1+i*0.1))]) for i in range(n)]
+
+def test_concurrent_runs(srcdir):
+    tasks = make_tasks(4)
+    sweep = param_sweep.XdsParamSweep(str(srcdir), files.needed_by_CORRECT, xds_cmd="xds", nproc=4, nproc_each=2)
+    results = sweep.run(tasks)
+    assert [r["name"] for r in results] == [t[0] for t in tasks]
+
+    runs = read_runs(srcdir)
+    assert len(runs) == 4
+    assert all([end is not None for start, end, d in runs])
+    # 2 runs at once with 2 cores each
+    max_conc = max([len([1 for s2, e2, d2 in runs if s2 <= s < e2]) for s, e, d in runs])
+    assert max_conc == 2
+
+    for name, inp_params in tasks:
+        wdir = srcdir.join(name)
+        assert wdir.check(dir=1)
+        assert not srcdir.join(name + ".tmp").check()
+        assert wdir.join("CORRECT.LP").check()
+        for f in files.needed_by_CORRECT:
+            assert wdir.join(f).islink()
+            assert wdir.join(f).readlink() == str(srcdir.join(f))
+        kwds = dict(get_xdsinp_keyword(str(wdir.join("XDS.INP"))))
+        assert kwds["JOB"] == "CORRECT"
+        assert kwds["WFAC1"] == inp_params[1][1]
+        assert kwds["MAXIMUM_NUMBER_OF_PROCESSORS"] == "2"
+        assert kwds["NAME_TEMPLATE_OF_DATA_FRAMES"] == os.path.join(str(srcdir.dirpath()), "data", "data_??????.cbf")
+
+    assert srcdir.join("XDS.INP").read() == xdsinp_str # source is not modified
+
+def test_skip_completed_and_redo_incomplete(srcdir):
+    tasks = make_tasks(3)
+    sweep = param_sweep.XdsParamSweep(str(srcdir), files.needed_by_CORRECT, xds_cmd="xds", nproc=3)
+    sweep.run(tasks)
+    assert len(read_runs(srcdir)) == 3
+
+    # run 0: completed; run 1: interrupted while running; run 2: directory removed
+    tmp1 = srcdir.join(tasks[1][0] + ".tmp")
+    srcdir.join(tasks[1][0]).rename(tmp1)
+    tmp1.join("CORRECT.LP").remove()
+    tmp1.join("garbage").write("")
+    srcdir.join(tasks[2][0]).remove()
+    srcdir.dirpath("xds_runs.log").remove()
+
+    results = sweep.run(tasks)
+    assert [r["name"] for r in results] == [t[0] for t in tasks]
+    assert sorted([os.path.basename(d) for s, e, d in read_runs(srcdir)]) == [tasks[1][0] + ".tmp", tasks[2][0] + ".tmp"]
+    for name, inp_params in tasks:
+        assert srcdir.join(name, "CORRECT.LP").check()
+        assert not srcdir.join(name + ".tmp").check()
+    assert not srcdir.join(tasks[1][0], "garbage").check()
+
+def test_failed_post_func_not_completed(srcdir):
+    tasks = make_tasks(2)
+    def post_func(wdir):
+        if tasks[1][0] in wdir: raise RuntimeError("failed")
+    sweep = param_sweep.XdsParamSweep(str(srcdir), files.needed_by_CORRECT, xds_cmd="xds", nproc=2, post_func=post_func)
+    sweep.run(tasks)
+    assert srcdir.join(tasks[0][0]).check(dir=1)
+    assert not srcdir.join(tasks[1][0]).check()
+    assert srcdir.join(tasks[1][0] + ".tmp", "CORRECT.LP").check() # left for inspection
+
+    srcdir.dirpath("xds_runs.log").remove()
+    sweep.post_func = None
+    sweep.run(tasks)
+    assert [os.path.basename(d) for s, e, d in read_runs(srcdir)] == [tasks[1][0] + ".tmp"]
+    assert srcdir.join(tasks[1][0], "CORRECT.LP").check()
@@ -0,0 +1,146 @@
+from __future__ import absolute_import, division, print_function
+import os
+import json
+import pickle
+import pytest
+
+pytest.importorskip("dxtbx")
+
+from yamtbx.dataproc.dials.command_line import run_dials_auto
+
+stubs_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stubs", "dials")
+
+dials_hkl_str = """\
+!FORMAT=XDS_ASCII    MERGE=FALSE    FRIEDEL'S_LAW=FALSE
+!OUTPUT_FILE=INTEGRATE.HKL        DATE= 1-Jan-2016
+!SPACE_GROUP_NUMBER=   19
+!UNIT_CELL_CONSTANTS=    70.000    80.000    90.000  90.000  90.000  90.000
+!X-RAY_WAVELENGTH=  1.00000
+!NUMBER_OF_ITEMS_IN_EACH_DATA_RECORD=8
+!ITEM_H=1
+!ITEM_K=2
+!ITEM_L=3
+!ITEM_IOBS=4
+!ITEM_SIGMA(IOBS)=5
+!ITEM_XD=6
+!ITEM_YD=7
+!ITEM_ZD=8
+!END_OF_HEADER
+!END_OF_DATA
+"""
+
+# dependencies of stages (scan_varying=True)
+stage_deps = dict(find_spots=["import"], export_spots=["find_spots"], index=["find_spots"], refine=["index"],
+                  integrate=["refine"], export_mtz=["integrate"], pointless=["export_mtz"], export_xds_ascii=["integrate"],
+                  aimless=["pointless"], summary=["aimless", "export_xds_ascii"])
+heavy_progs = ("dials.find_spots", "dials.index", "dials.refine", "dials.integrate")
+
+def make_unmerged_mtz(mtzout):
+    # merged one is enough for calc_merging_stats()
+    from cctbx import crystal, miller
+    from cctbx.array_family import flex
+    symm = crystal.symmetry((70, 80, 90, 90, 90, 90), "P212121")
+    mset = miller.build_set(symm, anomalous_flag=False, d_min=5)
+    iobs = mset.array(data=flex.double(range(mset.size())) + 100., sigmas=flex.double(mset.size(), 5.))
+    iobs.set_observation_type_xray_intensity()
+    iobs.as_mtz_dataset(column_root_label="I").mtz_object().write(mtzout)
+
+@pytest.fixture
+def fake_dials(tmpdir, monkeypatch):
+    data = tmpdir.mkdir("fake_data")
+    data.join("DIALS.HKL").write(dials_hkl_str)
+    make_unmerged_mtz(str(data.join("aimless_unmerged.mtz")))
+    monkeypatch.setenv("PATH", stubs_dir + os.pathsep + os.environ["PATH"])
+    monkeypatch.setenv("FAKE_DIALS_DATA", str(data))
+    monkeypatch.setenv("FAKE_DIALS_LOG", str(tmpdir.join("dials_runs.log")))
+    monkeypatch.setenv("FAKE_DIALS_SLEEP", "0.2")
+    monkeypatch.delenv("FAKE_DIALS_FAIL", raising=False)
+    imgdir = tmpdir.mkdir("images")
+    for i in range(5): imgdir.join("data_%.6d.cbf" % (i+1)).write("")
+    return tmpdir
+
+def make_args(topdir, n):
+    args_list = []
+    for i in range(n):
+        wdir = topdir.mkdir("dials_%d" % i) if not topdir.join("dials_%d" % i).check() else topdir.join("dials_%d" % i)
+        args_list.append(dict(filename_template=str(topdir.join("images", "data_??????.cbf")),
+                              prefix=str(topdir.join("images", "data_")), nr_range=(1, 5), wdir=str(wdir),
+                              known_xs=None, overrides={}, scan_varying=True, nproc=2))
+    return args_list
+
+def read_runs(topdir):
+    # [(start, end, wdir, program), ..] of fake programs in the order of start
+    log = topdir.join("dials_runs.log")
+    if not log.check(): return []
+    running, runs = {}, []
+    for l in log.readlines():
+        what, t, wdir, prog, pid = l.split()
+        if what == "start": running[pid] = float(t)
+        else: runs.append((running.pop(pid), float(t), wdir, prog))
+    return sorted(runs)
+
+def read_records(wdir):
+    return json.load(open(os.path.join(wdir, run_dials_auto.StageRunner.record_file)))
+
+def test_stage_order_and_overlap(fake_dials):
+    args_list = make_args(fake_dials, 2)
+    status = run_dials_auto.run_dials_sequences(args_list)
+    assert set(status.values()) == set(["done"])
+    assert len(status) == 2 * 11
+
+    runs = read_runs(fake_dials)
+    for args in args_list:
+        wdir = args["wdir"]
+        records = read_records(wdir)
+        for s, deps in stage_deps.items():
+            for d in deps: # started after dependencies finished
+                assert records[s]["start"] >= records[d]["end"], (s, d)
+        assert os.path.isfile(os.path.join(wdir, "kamo_dials.pkl"))
+        ret = pickle.load(open(os.path.join(wdir, "kamo_dials.pkl"), "rb"))
+        assert ret["symm"].space_group_info().type().number() == 19
+
+    # at most one heavy program at once
+    heavy = [r for r in runs if r[3] in heavy_progs]
+    for (s1, e1, w1, p1), (s2, e2, w2, p2) in zip(heavy[:-1], heavy[1:]):
+        assert s2 >= e1
+    # post-processing of the first dataset overlaps with processing of the second one
+    w0, w1 = args_list[0]["wdir"], args_list[1]["wdir"]
+    light0 = [r for r in runs if r[2] == w0 and r[3] not in heavy_progs and r[3] != "dials.import"]
+    heavy1 = [r for r in runs if r[2] == w1 and r[3] in heavy_progs]
+    assert any([s0 < e1 and s1 < e0 for s0, e0, _, _ in light0 for s1, e1, _, _ in heavy1])
+
+def test_skip_on_rerun(fake_dials):
+    args_list = make_args(fake_dials, 1)
+    run_dials_auto.run_dials_sequences(args_list)
+    fake_dials.join("dials_runs.log").remove()
+
+    status = run_dials_auto.run_dials_sequences(args_list)
+    assert set(status.values()) == set(["skipped"])
+    assert read_runs(fake_dials) == []
+
+    # integrate is redone if its input is updated, and so are the following stages
+    wdir = args_list[0]["wdir"]
+    os.utime(os.path.join(wdir, "refined.refl"), None)
+    status = run_dials_auto.run_dials_sequences(args_list)
+    done = sorted([k[1] for k, v in status.items() if v == "done"])
+    assert done == ["aimless", "export_mtz", "export_xds_ascii", "integrate", "pointless", "summary"]
+
+def test_index_failure_cancels_downstream(fake_dials, monkeypatch):
+    args_list = make_args(fake_dials, 2)
+    monkeypatch.setenv("FAKE_DIALS_FAIL", "dials_0/dials.index")
+    status = run_dials_auto.run_dials_sequences(args_list)
+    w0, w1 = args_list[0]["wdir"], args_list[1]["wdir"]
+
+    assert status[(w0, "index")] == "failed"
+    for s in ("import", "find_spots", "export_spots"):
+        assert status[(w0, s)] == "done"
+    for s in ("refine", "integrate", "export_mtz", "pointless", "export_xds_ascii", "aimless", "summary"):
+        assert status[(w0, s)] == "cancelled"
+        assert read_records(w0)[s]["status"] == "cancelled"
+    assert not os.path.exists(os.path.join(w0, "kamo_dials.pkl"))
+    # all indexing methods were tried
+    assert len([r for r in read_runs(fake_dials) if r[2] == w0 and r[3] == "dials.index"]) == 4
+    assert [r for r in read_runs(fake_dials) if r[2] == w0 and r[3] == "dials.refine"] == []
+
+    # other datasets are not affected
+    assert set([v for k, v in status.items() if k[0] == w1]) == set(["done"])
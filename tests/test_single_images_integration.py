@@ -0,0 +1,94 @@
+from __future__ import absolute_import, division, print_function
+import os
+import numpy
+
+import iotbx.phil
+from yamtbx.dataproc import cbf
+from yamtbx.dataproc.auto.command_line import single_images_integration
+
+stubs_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stubs", "xds")
+
+pilatus_header = """\
+# Detector: PILATUS3 6M, S/N 60-0000
+# 2016-01-01T12:00:00.000
+# Pixel_size 172e-6 m x 172e-6 m
+# Silicon sensor, thickness 0.000450 m
+# Exposure_time 0.1000000 s
+# Exposure_period 0.1000000 s
+# Count_cutoff 1048576 counts
+# Wavelength 1.0000 A
+# Detector_distance %.5f m
+# Beam_xy (50.50, 49.50) pixels
+# Start_angle 0.0000 deg.
+# Angle_increment 0.1000 deg.
+# Oscillation_axis X, CW
+# N_oscillations 1"""
+
+def write_images(datadir, distances):
+    rs = numpy.random.RandomState(1234)
+    imgs = []
+    for i, dist in enumerate(distances):
+        img = str(datadir.join("img_%.6d.cbf" % (i+1)))
+        data = rs.randint(0, 100000, (100, 100)).astype(numpy.int32) # large enough for XIO
+        cbf.write_minicbf_fast(data, 100, 100, "img", img, pilatus_header=pilatus_header % dist)
+        imgs.append(img)
+    return imgs
+
+def make_params(topdir):
+    cmdline = iotbx.phil.process_command_line(args=[], master_string=single_images_integration.master_params_str)
+    params = cmdline.work.extract()
+    params.topdir = topdir
+    params.checkcell.check = False
+    params.pickle_hkl = False # outputs of fake XDS can't be read
+    return params
+
+def read_xds_runs(log):
+    # [(directory, JOB=), ..] in the order of start
+    return [(l.split()[2], l.split()[3:]) for l in open(log) if l.startswith("start")]
+
+def read_dir(wdir):
+    ret = {}
+    for f in os.listdir(wdir):
+        if f == "decision.log": continue # has time
+        path = os.path.join(wdir, f)
+        ret[f] = ("->" + os.readlink(path)) if os.path.islink(path) else open(path, "rb").read()
+    return ret
+
+def test_batch_same_as_single(tmpdir, monkeypatch):
+    monkeypatch.setenv("PATH", stubs_dir + os.pathsep + os.environ["PATH"])
+    datadir = tmpdir.mkdir("data")
+    imgs = write_images(datadir, [0.2, 0.2, 0.25, 0.2]) # XDS.INP of 3rd image is different
+
+    # one image at a time
+    monkeypatch.setenv("FAKE_XDS_LOG", str(tmpdir.join("xds_single.log")))
+    params = make_params(str(tmpdir.join("single")))
+    for img in imgs:
+        single_images_integration.xds_sequence(img, params.topdir, str(datadir), params)
+    runs_single = read_xds_runs(str(tmpdir.join("xds_single.log")))
+
+    # in a batch
+    monkeypatch.setenv("FAKE_XDS_LOG", str(tmpdir.join("xds_batch.log")))
+    params = make_params(str(tmpdir.join("batch")))
+    n, n_reused, eltime = single_images_integration.xds_sequence_batch([(img, params.topdir) for img in imgs],
+                                                                       str(datadir), params)
+    runs_batch = read_xds_runs(str(tmpdir.join("xds_batch.log")))
+    assert (n, n_reused) == (4, 2)
+
+    # XYCORR is run once for each distinct XDS.INP, in the cache directory
+    assert len([r for r in runs_single if "XYCORR" in r[1]]) == 4
+    xycorr_runs = [r for r in runs_batch if "XYCORR" in r[1]]
+    assert len(xycorr_runs) == 2
+    assert all([r[1] == ["XYCORR"] and os.path.basename(r[0]).startswith("xycorr_") for r in xycorr_runs])
+    assert sorted(os.listdir(str(tmpdir.join("batch")))) == ["img_%.6d" % (i+1) for i in range(4)] # cache removed
+
+    # the same files in each working directory
+    for i in range(4):
+        name = "img_%.6d" % (i+1)
+        single = read_dir(str(tmpdir.join("single", name)))
+        batch = read_dir(str(tmpdir.join("batch", name)))
+        assert "XDS_ASCII_full.HKL" in single and "XDS_ASCII_part.HKL" in single
+        assert sorted(single) == sorted(batch)
+        for f in single: assert single[f] == batch[f], (name, f)
+        for d in ("single", "batch"):
+            decilog = tmpdir.join(d, name, "decision.log").read()
+            assert "Uncaught exception" not in decilog and "Processing failed" not in decilog
@@ -0,0 +1,134 @@
+from __future__ import absolute_import, division, print_function
+import os
+
+from yamtbx.dataproc.xds import XdsInp, modify_xdsinp, get_xdsinp_keyword, re_xds_kwd
+
+xdsinp_str = """\
+ JOB= XYCORR INIT COLSPOT IDXREF DEFPIX INTEGRATE CORRECT
+ ORGX= 1231.50 ORGY= 1263.50 ! check this
+ DETECTOR_DISTANCE= 200.00
+ OSCILLATION_RANGE= 0.100
+ X-RAY_WAVELENGTH= 1.00000
+ NAME_TEMPLATE_OF_DATA_FRAMES= ../data_??????.cbf
+! REFERENCE_DATA_SET=xxx/XDS_ASCII.HKL ! e.g. to ensure consistent indexing
+ DATA_RANGE= 1 1800
+ SPOT_RANGE= 1 900
+! BACKGROUND_RANGE=1 10 ! rather collect 5 degrees
+ SPACE_GROUP_NUMBER= 0
+ UNIT_CELL_CONSTANTS= 70 80 90 90 90 90
+ INCLUDE_RESOLUTION_RANGE=50 0
+ FRIEDEL'S_LAW=FALSE
+ DETECTOR=PILATUS MINIMUM_VALID_PIXEL_VALUE=0 OVERLOAD= 1048576
+ SENSOR_THICKNESS= 0.45
+ NX= 2463 NY= 2527  QX= 0.172  QY= 0.172
+ DIRECTION_OF_DETECTOR_X-AXIS=1 0 0
+ DIRECTION_OF_DETECTOR_Y-AXIS=0 1 0
+ ROTATION_AXIS= 1 0 0
+ INCIDENT_BEAM_DIRECTION=0 0 1
+ FRACTION_OF_POLARIZATION=0.98
+ POLARIZATION_PLANE_NORMAL= 0 1 0
+ UNTRUSTED_RECTANGLE= 487  495     0 2528
+ UNTRUSTED_RECTANGLE= 981  989     0 2528
+ UNTRUSTED_RECTANGLE=    0 2464   195  213
+"""
+
+# (edits, write to file?) as xds_sequence() in run_all_xds_simple does for a dataset
+edit_sequence = [([("DELPHI", "5.0")], False),
+                 ([("MAXIMUM_NUMBER_OF_PROCESSORS", "8")], False),
+                 ([("JOB", "XYCORR INIT")], True),
+                 ([("JOB", "INIT"), ("DATA_RANGE", "3 1800")], True),
+                 ([("JOB", "COLSPOT")], True),
+                 ("\n SPOT_RANGE= 1 450\n", False), # append_str
+                 ([("JOB", "IDXREF"), ("UNIT_CELL_CONSTANTS", "70.000 80.000 90.000 90 90 90"),
+                   ("SPACE_GROUP_NUMBER", "19")], True),
+                 ([("JOB", "DEFPIX INTEGRATE"), ("INCLUDE_RESOLUTION_RANGE", "50 0")], True),
+                 ([("JOB", "CORRECT"), ("CORRECTIONS", ""), ("NBATCH", "1"), ("MINIMUM_I/SIGMA", "50"),
+                   ("REFINE(CORRECT)", "")], True),
+                 ([("SPACE_GROUP_NUMBER", "19"), ("UNIT_CELL_CONSTANTS", "70.12 80.23 90.34 90.00 90.00 90.00")], False),
+                 ([("DELPHI", None)], False), # comment out only
+                 ([("JOB", "CORRECT")], True),
+                 ([("JOB", "CORRECT"), ("INCLUDE_RESOLUTION_RANGE", "50 1.80")], True)]
+
+def get_xdsinp_keyword_orig(xdsinp):
+    # get_xdsinp_keyword() before XdsInp was introduced
+    res = []
+    for l in open(xdsinp):
+        l = l[:l.find("!")] # Remove comment
+        res.extend(re_xds_kwd.findall(l))
+    return res
+
+def modify_xdsinp_orig(xdsinp, inp_params):
+    # modify_xdsinp() before XdsInp was introduced
+    kwds = get_xdsinp_keyword_orig(xdsinp)
+
+    ofs = open(xdsinp, "w")
+    for k, v in inp_params:
+        if v is None:
+            continue
+        ofs.write(" %s= %s\n" % (k, v))
+    ofs.write("\n")
+
+    for kwd, val in kwds:
+        if kwd in [k for k,v in inp_params]:
+            ofs.write("!")
+        ofs.write(" %s= %s\n" % (kwd,val))
+
+    ofs.close()
+
+def test_xdsinp_same_as_original_writer(tmpdir):
+    ref = str(tmpdir.join("ref.INP")) # edited by the original writer
+    new = str(tmpdir.join("new.INP")) # edited by XdsInp in memory
+    wrapper = str(tmpdir.join("wrapper.INP")) # edited by the current modify_xdsinp()
+    for f in (ref, new, wrapper): open(f, "w").write(xdsinp_str)
+
+    inp = XdsInp(new)
+    assert inp.keywords() == get_xdsinp_keyword_orig(ref)
+
+    for edit, do_write in edit_sequence:
+        if isinstance(edit, list):
+            modify_xdsinp_orig(ref, edit)
+            modify_xdsinp(wrapper, edit)
+            inp.modify(edit)
+        else:
+            for f in (ref, wrapper): open(f, "a").write(edit)
+            inp.append_str(edit)
+
+        assert inp.keywords() == get_xdsinp_keyword_orig(ref)
+        assert inp.as_str() == open(ref).read()
+        assert open(wrapper).read() == open(ref).read()
+        assert inp.get("JOB") == dict(get_xdsinp_keyword_orig(ref)).get("JOB")
+
+        if do_write:
+            inp.write()
+            assert open(new).read() == open(ref).read()
+
+    inp.write()
+    assert open(new).read() == open(ref).read()
+    assert get_xdsinp_keyword(new) == get_xdsinp_keyword_orig(ref)
+
+def test_xdsinp_write_only_when_modified(tmpdir):
+    xdsinp = str(tmpdir.join("XDS.INP"))
+    open(xdsinp, "w").write(xdsinp_str)
+    inp = XdsInp(xdsinp)
+
+    os.remove(xdsinp)
+    inp.write() # not modified; nothing written
+    assert not os.path.exists(xdsinp)
+
+    inp.modify([("JOB", "CORRECT")])
+    inp.write()
+    assert inp.get("JOB") == "CORRECT"
+    assert open(xdsinp).read().startswith(" JOB= CORRECT\n\n! JOB= XYCORR")
+
+def test_xdsinp_reload(tmpdir):
+    xdsinp = str(tmpdir.join("XDS.INP"))
+    open(xdsinp, "w").write(xdsinp_str)
+    inp = XdsInp(xdsinp)
+    inp.modify([("JOB", "IDXREF")])
+    inp.write()
+
+    modify_xdsinp_orig(xdsinp, [("JOB", "CORRECT")]) # changed by other programs
+    inp.reload()
+    assert inp.get("JOB") == "CORRECT"
+    assert inp.as_str() == open(xdsinp).read()
+    assert not inp.dirty
@@ -121,11 +121,15 @@ class BlendClusters(object):
             self.miller_sets = load_xds_data_only_indices(xac_files=self.files, d_min=self.d_min)
     # __init__()
 
-    def read_results(self):
-        self.clusters = {}
-
+    def read_files(self):
         lookup_table_txt = os.path.join(self.workdir, "xds_lookup_table.txt")
         self.files = [l.split()[1] for l in open(lookup_table_txt)]
+        return self.files
+    # read_files()
+
+    def read_results(self):
+        self.clusters = {}
+        self.read_files()
         
         clusters_txt = os.path.join(self.workdir, "CLUSTERS.txt")
         ifs = open(clusters_txt)
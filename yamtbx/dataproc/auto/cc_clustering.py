@@ -9,13 +9,15 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from cctbx.array_family import flex
 from cctbx import miller
-from libtbx import easy_mp
 from libtbx.utils import null_out
 from libtbx.utils import Sorry
 from yamtbx.util import call
 from yamtbx.dataproc.xds.xds_ascii import XDS_ASCII
 from yamtbx.dataproc.auto.blend import load_xds_data_only_indices
+from yamtbx.dataproc.cc_matrix import CCMatrix
 import os
+import shutil
+import pickle
 import numpy
 import collections
 import scipy.cluster
@@ -51,18 +53,68 @@ def read_xac_files(xac_files, d_min=None, d_max=None, min_ios=None):
 # read_xac_files()
 
 class CCClustering(object):
-    def __init__(self, wdir, xac_files, d_min=None, d_max=None, min_ios=None):
-        # self.arraysはXDS_ASCIIのarray(fobsをマージして格納したもの)
-        self.arrays = read_xac_files(xac_files, d_min=d_min, d_max=d_max, min_ios=min_ios)
+    result_files = ("cc_clustering.pkl", "CLUSTERS.txt", "cctable.dat", "cctable_notused.lst",
+                    "cctable_wilson_scales.dat", "tree.png", "tree.pdf", "dendro.json")
+
+    def __init__(self, wdir, xac_files, d_min=None, d_max=None, min_ios=None, read_data=True):
+        self.xac_files = list(xac_files)
+        self.d_min, self.d_max, self.min_ios = d_min, d_max, min_ios
         self.wdir = wdir
         self.clusters = {}
         self.all_cc = {} # {(i,j):cc, ...}
-        
+
+        if read_data:
+            self.load_data()
+        else: # data are not needed when reusing results
+            self.arrays = collections.OrderedDict([(f, None) for f in self.xac_files])
+
         if not os.path.exists(self.wdir): os.makedirs(self.wdir)
 
         open(os.path.join(self.wdir, "filenames.lst"), "w").write("\n".join(xac_files))
     # __init__()
 
+    def load_data(self):
+        # self.arraysはXDS_ASCIIのarray(fobsをマージして格納したもの)
+        self.arrays = read_xac_files(self.xac_files, d_min=self.d_min, d_max=self.d_max, min_ios=self.min_ios)
+    # load_data()
+
+    def result_key(self, b_scale, use_normalized, cluster_method, distance_eqn, min_common_refs):
+        # Everything that affects clustering result
+        return dict(files=self.xac_files, d_min=self.d_min, d_max=self.d_max, min_ios=self.min_ios,
+                    b_scale=b_scale, use_normalized=use_normalized, cluster_method=cluster_method,
+                    distance_eqn=distance_eqn, min_common_refs=min_common_refs)
+    # result_key()
+
+    def reuse_results(self, wdir_old, b_scale=False, use_normalized=False, cluster_method="ward", distance_eqn="sqrt(1-cc)", min_common_refs=3, html_maker=None):
+        """
+        Take over the result of do_clustering() in wdir_old if it was done with the same files and parameters.
+        Returns True if reused.
+        """
+        pklin = os.path.join(wdir_old, "cc_clustering.pkl")
+        if not os.path.isfile(pklin): return False
+
+        try:
+            saved = pickle.load(open(pklin, "rb"))
+        except:
+            return False
+
+        if saved["key"] != self.result_key(b_scale, use_normalized, cluster_method, distance_eqn, min_common_refs):
+            return False
+
+        self.clusters = saved["clusters"]
+        self.all_cc = saved["all_cc"]
+
+        if html_maker is not None:
+            html_maker.add_cc_clustering_details(saved["cc_data"])
+
+        if os.path.abspath(wdir_old) != os.path.abspath(self.wdir):
+            for f in self.result_files:
+                if os.path.isfile(os.path.join(wdir_old, f)):
+                    shutil.copy2(os.path.join(wdir_old, f), self.wdir)
+
+        return True
+    # reuse_results()
+
     def do_clustering(self, nproc=1, b_scale=False, use_normalized=False, cluster_method="ward", distance_eqn="sqrt(1-cc)", min_common_refs=3, html_maker=None):
         """
         Using correlation as distance metric (for hierarchical clustering)
@@ -75,6 +127,7 @@ class CCClustering(object):
         self.clusters = {}
         prefix = os.path.join(self.wdir, "cctable")
         assert (b_scale, use_normalized).count(True) <= 1
+        result_key = self.result_key(b_scale, use_normalized, cluster_method, distance_eqn, min_common_refs)
 
         # 距離マトリクスはここで定義している→オプションで指定することが可能
         distance_eqns = {"sqrt(1-cc)": lambda x: numpy.sqrt(1.-x),
@@ -128,22 +181,10 @@ class CCClustering(object):
                 for r in failed: msg += " %s\n%s\n" % (r, "\n".join(["  %s"%x for x in failed[r]]))
                 raise Sorry("intensity normalization failed by following reason(s):\n%s"%msg)
                     
-        # Prep 
-        # args: self.arraysに入っているarrayのindexの組み合わせを格納している
-        args = []
-        for i in range(len(self.arrays)-1):
-            for j in range(i+1, len(self.arrays)):
-                args.append((i,j))
-           
         # Calc all CC
-        # calc_ccという関数を呼び出すためのworkerという無名関数を定義しています。
-        # x: にはargsの要素が入るので最終的には (i, j)というのが入る
-        # 第一引数が i, 第二引数が j
-        # 結果: cc, nref の入った配列が返ってくる
-        worker = lambda x: calc_cc(list(self.arrays.values())[x[0]], list(self.arrays.values())[x[1]])
-        results = easy_mp.pool_map(fixed_func=worker,
-                                   args=args,
-                                   processes=nproc)
+        # args: self.arraysに入っているarrayのindexの組み合わせ (i, j) (i<j)
+        # 結果: cc, nref の入った配列が返ってくる (calc_cc()と同じ)
+        args, results = CCMatrix(list(self.arrays.values())).all_pairs(nproc=nproc)
 
         # Check NaN and decide which data to remove
         idx_bad = {}
@@ -283,7 +324,10 @@ class CCClustering(object):
             ofs.write("%04d %4d %7.3f %s\n" % (clid, ncount, dist, leavestr))
             self.clusters[int(clid)] = [float(dist), leaves]
         ofs.close()
-            
+
+        # Save for reuse_results()
+        pickle.dump(dict(key=result_key, clusters=self.clusters, all_cc=self.all_cc, cc_data=cc_data_for_html),
+                    open(os.path.join(self.wdir, "cc_clustering.pkl"), "wb"), -1)
     # do_clustering()
 
     def cluster_completeness(self, clno, anomalous_flag, d_min, calc_redundancy=True):
@@ -900,6 +900,7 @@ class WatchLogThread(object):
         self.parent = parent
         self.interval = 10
         self.thread = None
+        self.report_cache = html_report.KamoReportCache()
 
     def start(self, interval=None):
         self.stop()
@@ -975,7 +976,8 @@ class WatchLogThread(object):
             # Make html report # TODO Add DIALS support
             html_report.make_kamo_report(bssjobs, 
                                          topdir=config.params.topdir,
-                                         htmlout=os.path.join(config.params.workdir, "report.html"))
+                                         htmlout=os.path.join(config.params.workdir, "report.html"),
+                                         cache=self.report_cache)
             #print
             #print "Done. Open?"
             #print "firefox %s" % os.path.join(config.params.workdir, "report.html")
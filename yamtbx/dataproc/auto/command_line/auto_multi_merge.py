@@ -340,6 +340,7 @@ def auto_merge(workdir, topdirs, cell_method, ref_array, ref_sym, merge_params,
 
     merge_params.workdir = os.path.join(workdir, "%s_%.2fA"%(merge_params.clustering, merge_params.d_min))
     multi_merge.run(merge_params)
+    first_workdir = merge_params.workdir
 
     if rescut_params.auto:
         for cc_cut in (rescut_params.cc_one_half_min*.7, rescut_params.cc_one_half_min):
@@ -351,7 +352,11 @@ def auto_merge(workdir, topdirs, cell_method, ref_array, ref_sym, merge_params,
 
                 merge_params.workdir = tmp
                 merge_params.d_min = rescut
-                multi_merge.run(merge_params)
+                if merge_params.reuse.workdir is None: merge_params.reuse.workdir = first_workdir
+                reused = multi_merge.run(merge_params)
+                if reused is not None:
+                    log_out.write("Reused from %s: %s\n" % (merge_params.reuse.workdir,
+                                                            ", ".join(["%s= %s" % x for x in reused.items()]) if reused else "nothing"))
                 choose_best_result(os.path.join(merge_params.workdir, "cluster_summary.dat"), log_out)
             else:
                 break
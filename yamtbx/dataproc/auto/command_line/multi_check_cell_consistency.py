@@ -44,6 +44,20 @@ do_pointless = False
  .help = Run pointless for largest group data to determine symmetry
 """
 
+def cell_screening_index(p1cell):
+    """
+    Metric-invariant index for quick screening of cell pairs:
+    sorted a,b,c of given cell and sorted a,b,c of Niggli cell (= lengths of shortest lattice vectors).
+    """
+    ret = numpy.empty(6)
+    ret[:3] = sorted(p1cell.parameters()[:3])
+    try:
+        ret[3:] = sorted(p1cell.niggli_cell().parameters()[:3])
+    except RuntimeError:
+        ret[3:] = float("nan") # never screened out
+    return ret
+# cell_screening_index()
+
 class CellGraph(object):
     def __init__(self, tol_length=None, tol_angle=None):
         self.tol_length = tol_length if tol_length else 0.1
@@ -54,8 +68,46 @@ class CellGraph(object):
         self.dirs = {} # key->xdsdir
         self.symms = {} # key->symms
         self.cbops = {} # (key1,key2) = cbop
+        self.cell_indices = numpy.empty((0, 6)) # cell_screening_index() of nodes in the order of self.G.nodes()
+        self.n_indices = 0
     # __init__()
 
+    def _append_cell_index(self, p1cell):
+        if self.n_indices == len(self.cell_indices):
+            self.cell_indices = numpy.resize(self.cell_indices, (max(16, 2*self.n_indices), 6))
+        self.cell_indices[self.n_indices] = cell_screening_index(p1cell)
+        self.n_indices += 1
+    # _append_cell_index()
+
+    def candidate_nodes(self, p1cell):
+        """
+        Returns nodes possibly connected to p1cell, screened by cell lengths without calling reindexing_operators().
+        - other_cell.is_similar_to(p1cell) requires that sorted a,b,c agree within tol_length.
+        - reindexing_operators(other_cell, p1cell) requires a basis of p1cell lattice similar to Niggli cell of other_cell,
+          so the shortest lattice vectors of p1cell cannot be longer than those of other_cell beyond tol_length.
+          They can be shorter more than tol_length because of tol_angle; a generous margin is given for this direction.
+        """
+        nodes = list(self.G.nodes())
+        if not nodes: return nodes
+
+        idx = cell_screening_index(p1cell)
+        others = self.cell_indices[:self.n_indices]
+        eps = 1.e-6
+        tol_l = 1. - self.tol_length
+        tol_l_short = tol_l**2 * numpy.sqrt(max(0., 1. - 2.*numpy.sin(numpy.deg2rad(self.tol_angle))))
+
+        raw_min = numpy.minimum(others[:,:3], idx[:3])
+        raw_max = numpy.maximum(others[:,:3], idx[:3])
+        sel_similar = numpy.all(raw_min >= raw_max * tol_l - eps, axis=1)
+
+        with numpy.errstate(invalid="ignore"):
+            sel_reindex = numpy.all(idx[3:] * tol_l <= others[:,3:] + eps, axis=1)
+            sel_reindex &= numpy.all(idx[3:] >= others[:,3:] * tol_l_short - eps, axis=1)
+        sel_reindex |= numpy.isnan(others[:,3:]).any(axis=1) | numpy.isnan(idx[3:]).any()
+
+        return [nodes[i] for i in numpy.where(sel_similar | sel_reindex)[0]]
+    # candidate_nodes()
+
     def get_p1cell_and_symm(self, xdsdir):
         dials_hkl = os.path.join(xdsdir, "DIALS.HKL")
         xac_file = util.return_first_found_file(("XDS_ASCII.HKL", "XDS_ASCII.HKL.org",
@@ -111,7 +163,7 @@ class CellGraph(object):
 
         connected_nodes = []
 
-        for node in self.G.nodes():
+        for node in self.candidate_nodes(p1cell):
             other_cell = self.p1cells[node]
             if other_cell.is_similar_to(p1cell, self.tol_length, self.tol_angle):
                 connected_nodes.append(node)
@@ -126,6 +178,7 @@ class CellGraph(object):
 
         # Add nodes and edges
         self.G.add_node(key)
+        self._append_cell_index(p1cell)
         for node in connected_nodes:
             self.G.add_edge(node, key)
 
@@ -311,6 +364,7 @@ class CellGraph(object):
         copied_obj.dirs = dict((k, self.dirs[k]) for k in keys)
         copied_obj.symms = dict((k, self.symms[k]) for k in keys)
         copied_obj.cbops = dict((k, self.cbops[k]) for k in self.cbops if k[0] in keys or k[1] in keys) # XXX may be slow
+        for k in copied_obj.G.nodes(): copied_obj._append_cell_index(copied_obj.p1cells[k])
         return copied_obj
     # get_subgraph()
 # class CellGraph
@@ -39,6 +39,7 @@ import traceback
 import numpy
 import pickle 
 import itertools
+import shutil
 
 master_params_str = """
 lstin = None
@@ -220,6 +221,15 @@ resolution {
 
 }
 
+reuse {
+ workdir = None
+  .type = path
+  .help = "Previous workdir of multi_merge with the same input files (e.g. with different d_min). BLEND result and CC clustering result (when CC is calculated with the same parameters and d_min) are reused."
+ rejection = True
+  .type = bool
+  .help = "Also reuse rejected datasets and frames of the cluster with the same files (only when program=xscale). Rejection cycles are skipped."
+}
+
 batch {
  par_run = *deltacchalf merging
   .type = choice(multi=True)
@@ -238,7 +248,7 @@ batch {
 }
 """
 
-def merge_datasets(params, workdir, xds_files, cells, space_group):
+def merge_datasets(params, workdir, xds_files, cells, space_group, previous=None):
     if not os.path.exists(workdir): os.makedirs(workdir)
     out = open(os.path.join(workdir, "merge.log"), "w")
 
@@ -256,7 +266,8 @@ def merge_datasets(params, workdir, xds_files, cells, space_group):
                                                    out=out, nproc=params.nproc,
                                                    batch_params=params.batch)
 
-        unused_files, reasons = cycles.run_cycles(xds_files)
+        unused_files, reasons = cycles.run_cycles(xds_files, previous=previous)
+        cycles.save_rejections(os.path.join(workdir, "rejections.pkl"), xds_files)
         used_files = set(xds_files).difference(set(unused_files))
 
         print(file=out)
@@ -550,9 +561,26 @@ def run(params):
     try: html_report.add_cells_and_files(cells, list(laues.keys())[0])
     except: print(traceback.format_exc(), file=out)
 
+    reused = collections.OrderedDict() # what was taken from params.reuse.workdir
+    if params.reuse.workdir is not None:
+        params.reuse.workdir = os.path.abspath(params.reuse.workdir)
+        print("Reusing results in %s if possible" % params.reuse.workdir, file=out)
+
     data_for_merge = []
     if params.clustering == "blend":
-        if params.blend.use_old_result is None:
+        # BLEND analysis does not depend on d_min
+        blend_wdir_old, reuse_blend = None, False
+        if params.reuse.workdir and params.blend.use_old_result is None:
+            blend_wdir_old = os.path.join(params.reuse.workdir, "blend")
+            try: reuse_blend = blend.BlendClusters(workdir=blend_wdir_old, load_results=False).read_files() == xds_ascii_files
+            except: pass
+
+        if reuse_blend:
+            blend_wdir = os.path.join(params.workdir, "blend")
+            shutil.copytree(blend_wdir_old, blend_wdir, symlinks=True)
+            print("\nReusing BLEND result in %s" % blend_wdir_old, file=out)
+            reused["clustering"] = blend_wdir_old
+        elif params.blend.use_old_result is None:
             blend_wdir = os.path.join(params.workdir, "blend")
             os.mkdir(blend_wdir)
             blend.run_blend0R(blend_wdir, xds_ascii_files)
@@ -605,16 +633,22 @@ def run(params):
         os.mkdir(ccc_wdir)
         cc_clusters = cc_clustering.CCClustering(ccc_wdir, xds_ascii_files,
                                                  d_min=params.cc_clustering.d_min if params.cc_clustering.d_min is not None else params.d_min,
-                                                 min_ios=params.cc_clustering.min_ios)
-        print("\nRunning CC-based clustering", file=out)
-
-        cc_clusters.do_clustering(nproc=params.cc_clustering.nproc,
-                                  b_scale=params.cc_clustering.b_scale,
-                                  use_normalized=params.cc_clustering.use_normalized,
-                                  cluster_method=params.cc_clustering.method,
-                                  distance_eqn=params.cc_clustering.cc_to_distance,
-                                  min_common_refs=params.cc_clustering.min_common_refs,
-                                  html_maker=html_report)
+                                                 min_ios=params.cc_clustering.min_ios,
+                                                 read_data=False)
+        cc_kwds = dict(b_scale=params.cc_clustering.b_scale,
+                       use_normalized=params.cc_clustering.use_normalized,
+                       cluster_method=params.cc_clustering.method,
+                       distance_eqn=params.cc_clustering.cc_to_distance,
+                       min_common_refs=params.cc_clustering.min_common_refs)
+
+        ccc_wdir_old = os.path.join(params.reuse.workdir, "cc_clustering") if params.reuse.workdir else None
+        if ccc_wdir_old and cc_clusters.reuse_results(ccc_wdir_old, html_maker=html_report, **cc_kwds):
+            print("\nReusing CC-based clustering result in %s" % ccc_wdir_old, file=out)
+            reused["clustering"] = ccc_wdir_old
+        else:
+            print("\nRunning CC-based clustering", file=out)
+            cc_clusters.load_data()
+            cc_clusters.do_clustering(nproc=params.cc_clustering.nproc, html_maker=html_report, **cc_kwds)
         summary_out = os.path.join(ccc_wdir, "cc_cluster_summary.dat")
         clusters = cc_clusters.show_cluster_summary(d_min=params.d_min, out=open(summary_out, "w"))
         print("Clusters were summarized in %s" % summary_out, file=out)
@@ -716,13 +750,28 @@ def run(params):
         ofs_summary.flush()
     # write_ofs_summary()
 
+    # Rejections in the cluster with the same files
+    previous_rejections = {}
+    if params.reuse.workdir and params.reuse.rejection and params.program == "xscale":
+        tmp = multi_merging.xscale.read_rejection_records(params.reuse.workdir)
+        reject_method_org = [x for x in ("framecc", "lpstats", "delta_cc1/2") if x in params.reject_method]
+        for workdir, xds_files, LCV, aLCV, clh in data_for_merge:
+            rec = tmp.get(tuple(xds_files))
+            if rec is not None and rec["reject_method"] == reject_method_org:
+                previous_rejections[workdir] = rec
+
+        if data_for_merge:
+            reused["rejection"] = "%d/%d clusters (%d XSCALE cycles skipped)" % (len(previous_rejections), len(data_for_merge),
+                                                                              sum([x["n_cycles"]-1 for x in list(previous_rejections.values())]))
+
     if "merging" in params.batch.par_run:
         params.nproc = params.batch.nproc_each
         jobs = []
         for workdir, xds_files, LCV, aLCV, clh in data_for_merge:
             if not os.path.exists(workdir): os.makedirs(workdir)
             shname = "merge_%s.sh" % os.path.relpath(workdir, params.workdir)
-            pickle.dump((params, os.path.abspath(workdir), xds_files, cells, space_group), open(os.path.join(workdir, "args.pkl"), "wb"), -1)
+            pickle.dump((params, os.path.abspath(workdir), xds_files, cells, space_group, previous_rejections.get(workdir)),
+                        open(os.path.join(workdir, "args.pkl"), "wb"), -1)
             job = batchjob.Job(workdir, shname, nproc=params.batch.nproc_each)
             job.write_script("""\
 cd "%s" || exit 1
@@ -761,7 +810,7 @@ pickle.dump(ret, open("result.pkl","wb")); \
         for workdir, xds_files, LCV, aLCV, clh in data_for_merge:
             print("Merging %s..." % os.path.relpath(workdir, params.workdir), file=out)
             out.flush()
-            results = merge_datasets(params, workdir, xds_files, cells, space_group)
+            results = merge_datasets(params, workdir, xds_files, cells, space_group, previous_rejections.get(workdir))
             
             if len(results) == 0:
                 ofs_summary.write("#%s failed\n" % os.path.relpath(workdir, params.workdir))
@@ -778,10 +827,16 @@ pickle.dump(ret, open("result.pkl","wb")); \
 
     print("firefox %s" % os.path.join(html_report.root, "report.html"))
 
+    if params.reuse.workdir:
+        out.write("\nReused from %s:\n" % params.reuse.workdir)
+        out.write(" clustering: %s\n" % reused.get("clustering", "not reused"))
+        if params.program == "xscale":
+            out.write(" rejection: %s\n" % reused.get("rejection", "not reused"))
+
     out.write("\nNormal exit at %s\n" % time.strftime("%Y-%m-%d %H:%M:%S"))
     out.write("Total wall-clock time: %.2f sec.\n" % (time.time()-time_started))
 
-    return
+    return reused
 # run()
 
 def run_from_args(argv):
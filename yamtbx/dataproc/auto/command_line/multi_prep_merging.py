@@ -17,7 +17,6 @@ from yamtbx import util
 
 import iotbx.phil
 import libtbx.phil
-from libtbx import easy_mp
 from libtbx.utils import multi_out
 from cctbx.crystal import reindex
 from cctbx import crystal
@@ -32,6 +31,8 @@ import numpy
 import traceback
 import tempfile
 import glob
+import pickle
+import multiprocessing
 from io import StringIO
 
 master_params_str = """
@@ -61,6 +62,9 @@ prep_dials_files = True
  .type = bool
 copy_into_workdir = True
  .type = bool
+resume = False
+ .type = bool
+ .help = "Resume interrupted run in existing workdir. Directories already finished are not processed again."
 
 cell_grouping {
   tol_length = None
@@ -72,6 +76,124 @@ cell_grouping {
 }
 """
 
+def add_stage_time(stage_times, stage, t_start):
+    # Add elapsed time since t_start to stage_times[stage] and return current time
+    t = time.time()
+    if stage_times is not None: stage_times[stage] = stage_times.get(stage, 0.) + t - t_start
+    return t
+# add_stage_time()
+
+prep_merging_worker_dict = {} # constants for worker processes; set before fork
+
+def prep_merging_worker(task):
+    # Runs in worker process. Log is returned rather than written, so that it is not mixed with others.
+    d = prep_merging_worker_dict
+    out = StringIO()
+    stage_times = {}
+    try:
+        ret = d["worker"](task, out, stage_times, **d["kwargs"])
+    except:
+        print("Error in %s" % str(task), file=out)
+        print(traceback.format_exc(), file=out)
+        ret = None
+    return task, ret, out.getvalue(), stage_times
+# prep_merging_worker()
+
+class PrepMergingExecutor(object):
+    """
+    Runs per-directory worker (e.g. reindex_with_specified_symm_worker) for all directories using a process pool.
+    - Constants (reference symmetry etc) are given to worker processes only once (inherited at fork).
+    - Log of each directory is written as soon as it is finished.
+    - Finished results are saved in state_file as they come, and reused when run again with the same
+      constants (resume after interruption).
+    - Wall-clock time of each stage, summed over directories, is reported.
+
+    worker(task, log_out, stage_times, **kwargs) should return (key, result);
+    result is None if failed, otherwise (cell, filename).
+    """
+    def __init__(self, worker, kwargs, nproc, log_out, state_file=None, state_key=None):
+        self.worker = worker
+        self.kwargs = kwargs
+        self.nproc = nproc
+        self.log_out = log_out
+        self.state_file = state_file
+        self.state_key = state_key
+        self.stage_times = {}
+    # __init__()
+
+    def load_state(self):
+        # returns {task: ret} finished in the previous run with the same state_key
+        if not self.state_file or not os.path.isfile(self.state_file): return {}
+
+        done = {}
+        with open(self.state_file, "rb") as ifs:
+            try:
+                if pickle.load(ifs) != self.state_key: return {}
+                while True:
+                    task, ret = pickle.load(ifs)
+                    done[task] = ret
+            except EOFError:
+                pass
+            except:
+                print("Warning: failed to read %s. Ignoring the rest." % self.state_file, file=self.log_out)
+
+        # Check that the result file still exists
+        return dict([x for x in done.items() if x[1][1] is not None and os.path.isfile(x[1][1][1])])
+    # load_state()
+
+    def run(self, tasks):
+        st_time = time.time()
+        results = self.load_state()
+        if results:
+            print("Resuming: %d directories already finished." % len(results), file=self.log_out)
+
+        todo = [x for x in tasks if x not in results]
+
+        state_ofs = None
+        if self.state_file:
+            state_ofs = open(self.state_file, "wb")
+            pickle.dump(self.state_key, state_ofs, -1)
+            for task in results: pickle.dump((task, results[task]), state_ofs, -1)
+            state_ofs.flush()
+
+        def finished(task, ret, log_str, stage_times):
+            self.log_out.write(log_str)
+            self.log_out.flush()
+            for k in stage_times: self.stage_times[k] = self.stage_times.get(k, 0.) + stage_times[k]
+            results[task] = ret
+            if state_ofs is not None and ret is not None and ret[1] is not None:
+                pickle.dump((task, ret), state_ofs, -1)
+                state_ofs.flush()
+        # finished()
+
+        global prep_merging_worker_dict
+        prep_merging_worker_dict = dict(worker=self.worker, kwargs=self.kwargs)
+        try:
+            if self.nproc > 1 and len(todo) > 1:
+                pool = multiprocessing.Pool(min(self.nproc, len(todo)))
+                try:
+                    for r in pool.imap_unordered(prep_merging_worker, todo):
+                        finished(*r)
+                    pool.close()
+                finally:
+                    pool.terminate()
+                    pool.join()
+            else:
+                for task in todo:
+                    finished(*prep_merging_worker(task))
+        finally:
+            prep_merging_worker_dict = {}
+            if state_ofs is not None: state_ofs.close()
+
+        print("\nWall-clock time of each stage (sum over directories):", file=self.log_out)
+        for k in sorted(self.stage_times):
+            print(" %-8s %8.2f sec" % (k, self.stage_times[k]), file=self.log_out)
+        print("Total wall-clock time: %.2f sec (using %d cores)." % (time.time()-st_time, self.nproc), file=self.log_out)
+
+        return [results.get(x) for x in tasks]
+    # run()
+# class PrepMergingExecutor
+
 def prepare_dials_files(wd, out, space_group=None, reindex_op=None, moveto=None):
     try:
         from yamtbx.dataproc.dials.command_line import import_xds_for_refine
@@ -89,10 +211,12 @@ def prepare_dials_files(wd, out, space_group=None, reindex_op=None, moveto=None)
         print(traceback.format_exc(), file=out)
 # prepare_dials_files()
 
-def rescale_with_specified_symm_worker(sym_wd_wdr, topdir, log_out, reference_symm, sgnum, sgnum_laue, prep_dials_files=False):
+def rescale_with_specified_symm_worker(wd_wdr, log_out, stage_times, topdir, symms, reference_symm, sgnum, sgnum_laue, prep_dials_files=False):
     # XXX Unsafe if multiple processes run this function for the same target directory at the same time
 
-    sym, wd, wdr = sym_wd_wdr
+    wd, wdr = wd_wdr
+    sym = symms[wd]
+    t = time.time()
     out = StringIO()
     print(os.path.relpath(wd, topdir), end=' ', file=out)
 
@@ -110,6 +234,7 @@ def rescale_with_specified_symm_worker(sym_wd_wdr, topdir, log_out, reference_sy
     xac = XDS_ASCII(xac_file, read_data=False)
     print("%s %s (%s)" % (os.path.basename(xac_file), xac.symm.space_group_info(),
                                  ",".join(["%.2f"%x for x in xac.symm.unit_cell().parameters()])), file=out)
+    t = add_stage_time(stage_times, "read", t)
 
     if xac.symm.reflection_intensity_symmetry(False).space_group_info().type().number() == sgnum_laue:
         if xac.symm.unit_cell().is_similar_to(reference_symm.unit_cell(), 0.1, 10):
@@ -118,8 +243,10 @@ def rescale_with_specified_symm_worker(sym_wd_wdr, topdir, log_out, reference_sy
             log_out.flush()
 
             if wd != wdr: shutil.copy2(xac_file, wdr)
+            t = add_stage_time(stage_times, "copy", t)
 
             if prep_dials_files: prepare_dials_files(wd, out, moveto=wdr)
+            t = add_stage_time(stage_times, "dials", t)
             return (wdr, (numpy.array(xac.symm.unit_cell().parameters()),
                           os.path.join(wdr, os.path.basename(xac_file))))
 
@@ -151,12 +278,15 @@ def rescale_with_specified_symm_worker(sym_wd_wdr, topdir, log_out, reference_sy
                                       ("MINIMUM_I/SIGMA", None), # use default
                                       ("REFINE(CORRECT)", None), # use default
                                       ])
+    t = add_stage_time(stage_times, "read", t)
     run_xds(wd)
+    t = add_stage_time(stage_times, "correct", t)
     for f in ("XDS.INP", "CORRECT.LP", "XDS_ASCII.HKL", "GXPARM.XDS"):
         if os.path.exists(os.path.join(wd, f)):
             shutil.copyfile(os.path.join(wd, f), os.path.join(wdr, f+"_rescale"))
 
     revert_files(xds_files.generated_by_CORRECT, bk_prefix, wdir=wd, quiet=True)
+    t = add_stage_time(stage_times, "copy", t)
 
     new_xac = os.path.join(wdr, "XDS_ASCII.HKL_rescale")
 
@@ -165,6 +295,7 @@ def rescale_with_specified_symm_worker(sym_wd_wdr, topdir, log_out, reference_sy
                             space_group=reference_symm.space_group(),
                             reindex_op=cosets.combined_cb_ops()[0],
                             moveto=wdr)
+        t = add_stage_time(stage_times, "dials", t)
 
     ret = None
     if os.path.isfile(new_xac):
@@ -173,10 +304,12 @@ def rescale_with_specified_symm_worker(sym_wd_wdr, topdir, log_out, reference_sy
     else:
         print("Error: rescaling failed (Can't find XDS_ASCII.HKL)", file=out)
 
+    log_out.write(out.getvalue())
+    log_out.flush()
     return (wd, ret)
 # rescale_with_specified_symm_worker()
 
-def rescale_with_specified_symm(topdir, dirs, symms, out, sgnum=None, reference_symm=None, nproc=1, prep_dials_files=False, copyto_root=None):
+def rescale_with_specified_symm(topdir, dirs, symms, out, sgnum=None, reference_symm=None, nproc=1, prep_dials_files=False, copyto_root=None, state_file=None):
     assert (sgnum, reference_symm).count(None) == 1
 
     if sgnum is not None:
@@ -197,7 +330,6 @@ def rescale_with_specified_symm(topdir, dirs, symms, out, sgnum=None, reference_
     print(file=out)
     print(file=out)
     out.flush()
-    st_time = time.time()
     wd_ret = []
 
     if copyto_root:
@@ -210,14 +342,17 @@ def rescale_with_specified_symm(topdir, dirs, symms, out, sgnum=None, reference_
         wd_ret = dirs
 
 
-    ret = easy_mp.pool_map(fixed_func=lambda x: rescale_with_specified_symm_worker(x, topdir, out, reference_symm, sgnum, sgnum_laue, prep_dials_files),
-                           args=list(zip(symms, dirs, wd_ret)), processes=nproc)
-    cells = dict([x for x in ret if x[1] is not None]) # cell and file
-    print("\nTotal wall-clock time for reindexing: %.2f sec (using %d cores)." % (time.time()-st_time, nproc), file=out)
+    state_key = ("refine", str(reference_symm.space_group_info()), reference_symm.unit_cell().parameters(), prep_dials_files)
+    executor = PrepMergingExecutor(rescale_with_specified_symm_worker,
+                                   dict(topdir=topdir, symms=dict(zip(dirs, symms)), reference_symm=reference_symm,
+                                        sgnum=sgnum, sgnum_laue=sgnum_laue, prep_dials_files=prep_dials_files),
+                                   nproc=nproc, log_out=out, state_file=state_file, state_key=state_key)
+    ret = executor.run(list(zip(dirs, wd_ret)))
+    cells = dict([x for x in ret if x is not None and x[1] is not None]) # cell and file
     return cells, reference_symm
 # rescale_with_specified_symm()
 
-def reindex_with_specified_symm_worker(wd, wdr, topdir, log_out, reference_symm, sgnum_laue, prep_dials_files=False):
+def reindex_with_specified_symm_worker(wd_wdr, log_out, stage_times, topdir, reference_symm, sgnum_laue, prep_dials_files=False):
     """
     wd: directory where XDS file exists
     wdr: wd to return; a directory where transformed file should be saved.
@@ -225,6 +360,8 @@ def reindex_with_specified_symm_worker(wd, wdr, topdir, log_out, reference_symm,
     If wd!=wdr, files in wd/ are unchanged during procedure. Multiprocessing is unsafe when wd==wdr.
     """
 
+    wd, wdr = wd_wdr
+    t = time.time()
     out = StringIO()
     print("%s:" % os.path.relpath(wd, topdir), end=' ', file=out)
 
@@ -245,6 +382,7 @@ def reindex_with_specified_symm_worker(wd, wdr, topdir, log_out, reference_symm,
     xac = XDS_ASCII(xac_file, read_data=False)
     print("%s %s (%s)" % (os.path.basename(xac_file), xac.symm.space_group_info(),
                                ",".join(["%.2f"%x for x in xac.symm.unit_cell().parameters()])), file=out)
+    t = add_stage_time(stage_times, "read", t)
 
     if xac.symm.reflection_intensity_symmetry(False).space_group_info().type().number() == sgnum_laue:
         if xac.symm.unit_cell().is_similar_to(reference_symm.unit_cell(), 0.1, 10): # XXX Check unit cell consistency!!
@@ -253,9 +391,11 @@ def reindex_with_specified_symm_worker(wd, wdr, topdir, log_out, reference_symm,
             log_out.flush()
 
             if wd != wdr: shutil.copy2(xac_file, wdr)
+            t = add_stage_time(stage_times, "copy", t)
 
             if prep_dials_files and "DIALS.HKL" not in xac_file:
                 prepare_dials_files(wd, out, moveto=wdr)
+                t = add_stage_time(stage_times, "dials", t)
 
             return (wdr, (numpy.array(xac.symm.unit_cell().parameters()), 
                           os.path.join(wdr, os.path.basename(xac_file))))
@@ -281,6 +421,7 @@ def reindex_with_specified_symm_worker(wd, wdr, topdir, log_out, reference_symm,
     newcell = xac.write_reindexed(op=cosets.combined_cb_ops()[0],
                                   space_group=reference_symm.space_group(),
                                   hklout=hklout)
+    t = add_stage_time(stage_times, "reindex", t)
 
     if "DIALS.HKL" in os.path.basename(xac_file):
         outstr = 'output.experiments="%sreindexed_experiments.json" ' % os.path.join(dest, "")
@@ -297,6 +438,7 @@ def reindex_with_specified_symm_worker(wd, wdr, topdir, log_out, reference_symm,
                             space_group=reference_symm.space_group(),
                             reindex_op=cosets.combined_cb_ops()[0],
                             moveto=dest)
+    t = add_stage_time(stage_times, "dials", t)
 
     newcell_str = " ".join(["%.3f"%x for x in newcell.parameters()])
     print("  Reindexed to transformed cell: %s with %s" % (newcell_str, cosets.combined_cb_ops()[0].as_hkl()), file=out)
@@ -310,6 +452,7 @@ def reindex_with_specified_symm_worker(wd, wdr, topdir, log_out, reference_symm,
             os.rename(f, f_in_wd)
 
         shutil.rmtree(dest)
+        t = add_stage_time(stage_times, "copy", t)
         ret = (numpy.array(newcell.parameters()), 
                os.path.join(wd, os.path.basename(xac_file_out)))
     else:
@@ -319,7 +462,7 @@ def reindex_with_specified_symm_worker(wd, wdr, topdir, log_out, reference_symm,
     return (wdr, ret)
 # reindex_with_specified_symm_worker()
 
-def reindex_with_specified_symm(topdir, reference_symm, dirs, out, nproc=10, prep_dials_files=False, copyto_root=None):
+def reindex_with_specified_symm(topdir, reference_symm, dirs, out, nproc=10, prep_dials_files=False, copyto_root=None, state_file=None):
     print(file=out)
     print("Re-index to specified symmetry:", file=out)
     reference_symm.show_summary(out, "  ")
@@ -327,7 +470,6 @@ def reindex_with_specified_symm(topdir, reference_symm, dirs, out, nproc=10, pre
     print(file=out)
     out.flush()
 
-    st_time = time.time()
     wd_ret = []
 
     if copyto_root:
@@ -341,11 +483,13 @@ def reindex_with_specified_symm(topdir, reference_symm, dirs, out, nproc=10, pre
 
     sgnum_laue = reference_symm.space_group().build_derived_reflection_intensity_group(False).type().number()
 
-    ret = easy_mp.pool_map(fixed_func=lambda wd2: reindex_with_specified_symm_worker(wd2[0], wd2[1], topdir, out, reference_symm, sgnum_laue, prep_dials_files),
-                           args=list(zip(dirs, wd_ret)), processes=nproc)
-    cells = dict([x for x in ret if x[1] is not None]) # cell and file
-
-    print("\nTotal wall-clock time for reindexing: %.2f sec (using %d cores)." % (time.time()-st_time, nproc), file=out)
+    state_key = ("reindex", str(reference_symm.space_group_info()), reference_symm.unit_cell().parameters(), prep_dials_files)
+    executor = PrepMergingExecutor(reindex_with_specified_symm_worker,
+                                   dict(topdir=topdir, reference_symm=reference_symm, sgnum_laue=sgnum_laue,
+                                        prep_dials_files=prep_dials_files),
+                                   nproc=nproc, log_out=out, state_file=state_file, state_key=state_key)
+    ret = executor.run(list(zip(dirs, wd_ret)))
+    cells = dict([x for x in ret if x is not None and x[1] is not None]) # cell and file
 
     return cells
 # reindex_with_specified_symm()
@@ -364,7 +508,7 @@ class PrepMerging(object):
         return self.log_buffer
     # find_groups()
     
-    def prep_merging(self, workdir, group, symmidx=None, reference_symm=None, topdir=None, cell_method="reindex", nproc=1, prep_dials_files=True, into_workdir=True):
+    def prep_merging(self, workdir, group, symmidx=None, reference_symm=None, topdir=None, cell_method="reindex", nproc=1, prep_dials_files=True, into_workdir=True, resume=False):
         assert (symmidx, reference_symm).count(None) == 1
         
         from yamtbx.util.xtal import format_unit_cell
@@ -373,7 +517,7 @@ class PrepMerging(object):
         cm = self.cell_graph
         
         prep_log_out = multi_out()
-        prep_log_out.register("log", open(os.path.join(workdir, "prep_merge.log"), "w"), atexit_send_to=None)
+        prep_log_out.register("log", open(os.path.join(workdir, "prep_merge.log"), "a" if resume else "w"), atexit_send_to=None)
         prep_log_out.register("stdout", sys.stdout)
         prep_log_out.write(self.log_buffer)
         prep_log_out.flush()
@@ -390,17 +534,23 @@ class PrepMerging(object):
         copyto_root = os.path.join(workdir, "input_files") if into_workdir else None
 
         if not topdir: topdir = os.path.dirname(os.path.commonprefix(dirs))
+
+        # Finished results are recorded here, and used if resume=True
+        state_file = os.path.join(workdir, "prep_merge_state.pkl")
+        if not resume and os.path.isfile(state_file): os.remove(state_file)
         
         if cell_method == "reindex":
             self.cell_and_files = reindex_with_specified_symm(topdir, reference_symm, dirs,
                                                          out=prep_log_out, nproc=nproc,
-                                                         prep_dials_files=prep_dials_files, copyto_root=copyto_root)
+                                                         prep_dials_files=prep_dials_files, copyto_root=copyto_root,
+                                                         state_file=state_file)
         elif cell_method == "refine":
             self.cell_and_files, reference_symm = rescale_with_specified_symm(topdir, dirs, symms,
                                                                          reference_symm=reference_symm,
                                                                          out=prep_log_out, nproc=nproc,
                                                                          prep_dials_files=prep_dials_files,
-                                                                         copyto_root=copyto_root)
+                                                                         copyto_root=copyto_root,
+                                                                         state_file=state_file)
         else:
             raise "Don't know this choice: %s" % cell_method
 
@@ -562,7 +712,7 @@ def run(params):
     if not params.workdir:
         print("Give workdir=")
         return
-    if os.path.exists(params.workdir):
+    if os.path.exists(params.workdir) and not params.resume:
         print("workdir already exists:", params.workdir)
         return
 
@@ -622,12 +772,13 @@ def run(params):
         except ValueError:
             continue
 
-    os.mkdir(params.workdir)
+    if not os.path.exists(params.workdir): os.mkdir(params.workdir)
                 
     topdir = os.path.dirname(os.path.commonprefix(xds_dirs))
     
     pm.prep_merging(group=params.group_choice, symmidx=symmidx, workdir=params.workdir, topdir=topdir,
-                    cell_method=params.cell_method, nproc=params.nproc, prep_dials_files=params.prep_dials_files, into_workdir=params.copy_into_workdir)
+                    cell_method=params.cell_method, nproc=params.nproc, prep_dials_files=params.prep_dials_files, into_workdir=params.copy_into_workdir,
+                    resume=params.resume)
     pm.write_merging_scripts(params.workdir, "par", params.prep_dials_files)
 # run()
 
@@ -652,5 +803,4 @@ All parameters:
 # run_from_args()
 
 if __name__ == "__main__":
-    import sys
     run_from_args(sys.argv[1:])
@@ -21,6 +21,7 @@ import io
 
 from yamtbx.command_line import kamo_test_installation
 from yamtbx.dataproc.xds import get_xdsinp_keyword, modify_xdsinp, optimal_delphi_by_nproc, make_backup, revert_files, remove_backups
+from yamtbx.dataproc.xds import XdsInp
 from yamtbx.dataproc.xds import idxreflp
 from yamtbx.dataproc.xds.initlp import InitLp
 from yamtbx.dataproc.xds import correctlp
@@ -306,7 +307,8 @@ def xds_sequence(root, params):
     assert os.path.isfile(xdsinp)
     if params.cell_prior.force: assert params.cell_prior.check
     
-    xdsinp_dict = dict(get_xdsinp_keyword(xdsinp))
+    inp = XdsInp(xdsinp) # written to the file just before running XDS
+    xdsinp_dict = dict(inp.keywords())
 
     if params.cell_prior.sgnum > 0:
         xs_prior = crystal.symmetry(params.cell_prior.cell, params.cell_prior.sgnum)
@@ -337,37 +339,40 @@ def xds_sequence(root, params):
         if params.fast_delphi and (params.nproc is None or params.nproc > 1):
             delphi = optimal_delphi_by_nproc(xdsinp=xdsinp, nproc=params.nproc)
             print(" Setting delphi to ", delphi, file=decilog)
-            modify_xdsinp(xdsinp, inp_params=[("DELPHI", str(delphi)),
-                                              ])
+            inp.modify(inp_params=[("DELPHI", str(delphi)),
+                                   ])
 
         if params.nproc is not None and params.nproc > 1:
-            modify_xdsinp(xdsinp, inp_params=[("MAXIMUM_NUMBER_OF_PROCESSORS", str(params.nproc)),
-                                              ])
+            inp.modify(inp_params=[("MAXIMUM_NUMBER_OF_PROCESSORS", str(params.nproc)),
+                                   ])
 
         if params.mode == "initial":
-            modify_xdsinp(xdsinp, inp_params=[("JOB", "XYCORR INIT")])
+            inp.modify(inp_params=[("JOB", "XYCORR INIT")])
+            inp.write()
             run_xds(wdir=root, show_progress=params.show_progress)
             initlp = InitLp(init_lp)
             first_bad = initlp.check_bad_first_frames()
             if first_bad:
                 print(" first frames look bad (too weak) exposure:", first_bad, file=decilog)
-                new_data_range = list(map(int, dict(get_xdsinp_keyword(xdsinp))["DATA_RANGE"].split()))
+                new_data_range = list(map(int, inp.get("DATA_RANGE").split()))
                 new_data_range[0] = first_bad[-1]+1
                 print(" changing DATA_RANGE= to", new_data_range, file=decilog)
-                modify_xdsinp(xdsinp, inp_params=[("JOB", "INIT"),
-                                                  ("DATA_RANGE", "%d %d" % tuple(new_data_range))])
+                inp.modify(inp_params=[("JOB", "INIT"),
+                                       ("DATA_RANGE", "%d %d" % tuple(new_data_range))])
                 for f in xds_files.generated_by_INIT: util.rotate_file(os.path.join(root, f), copy=False)
+                inp.write()
                 run_xds(wdir=root, show_progress=params.show_progress)
 
             # Peak search
-            modify_xdsinp(xdsinp, inp_params=[("JOB", "COLSPOT")])
+            inp.modify(inp_params=[("JOB", "COLSPOT")])
+            inp.write()
             run_xds(wdir=root, show_progress=params.show_progress)
             if params.auto_frame_exclude_spot_based:
                 sx = idxreflp.SpotXds(spot_xds)
                 sx.set_xdsinp(xdsinp)
-                spots = [x for x in sx.collected_spots() if 5 < x[-1] < 30] # low-res (5 A)
-                frame_numbers = numpy.array([int(x[2])+1 for x in spots])
-                data_range = list(map(int, dict(get_xdsinp_keyword(xdsinp))["DATA_RANGE"].split()))
+                d = sx.resolutions()
+                frame_numbers = sx.frames[(5 < d) & (d < 30)] # low-res (5 A)
+                data_range = list(map(int, inp.get("DATA_RANGE").split()))
                 # XXX this assumes SPOT_RANGE equals to DATA_RANGE. Is this guaranteed?
                 h = numpy.histogram(frame_numbers,
                                     bins=numpy.arange(data_range[0], data_range[1]+2, step=1))
@@ -388,7 +393,7 @@ def xds_sequence(root, params):
 
                     # Edit XDS.INP
                     cut_inp_str = "".join(["EXCLUDE_DATA_RANGE= %6d %6d\n"%tuple(x) for x in cut_ranges])
-                    open(xdsinp, "a").write("\n"+cut_inp_str)
+                    inp.append_str("\n"+cut_inp_str)
 
                     # Edit SPOT.XDS
                     shutil.copyfile(spot_xds, spot_xds+".org")
@@ -396,14 +401,15 @@ def xds_sequence(root, params):
 
             # Indexing
             if params.cell_prior.method == "use_first":
-                modify_xdsinp(xdsinp, inp_params=[("JOB", "IDXREF"),
-                                                  ("UNIT_CELL_CONSTANTS",
-                                                   " ".join(["%.3f"%x for x in params.cell_prior.cell])),
-                                                  ("SPACE_GROUP_NUMBER", "%d"%params.cell_prior.sgnum),
-                                                  ])
+                inp.modify(inp_params=[("JOB", "IDXREF"),
+                                       ("UNIT_CELL_CONSTANTS",
+                                        " ".join(["%.3f"%x for x in params.cell_prior.cell])),
+                                       ("SPACE_GROUP_NUMBER", "%d"%params.cell_prior.sgnum),
+                                       ])
             else:
-                modify_xdsinp(xdsinp, inp_params=[("JOB", "IDXREF")])
+                inp.modify(inp_params=[("JOB", "IDXREF")])
 
+            inp.write()
             run_xds(wdir=root, show_progress=params.show_progress)
             print("", file=decilog) # TODO indexing stats like indexed percentage here.
 
@@ -413,6 +419,7 @@ def xds_sequence(root, params):
                                   known_cell=params.cell_prior.cell,
                                   tol_length=params.cell_prior.tol_length,
                                   tol_angle=params.cell_prior.tol_angle)
+                inp.reload()
 
             if not os.path.isfile(xparm):
                 print(" Indexing failed.", file=decilog)
@@ -433,14 +440,15 @@ def xds_sequence(root, params):
                 elif params.cell_prior.method == "symm_constraint_only":
                     cell = xsxds.unit_cell().change_basis(cosets.combined_cb_ops()[0])
                     print(" Trying symmetry-constrained cell parameter:", cell, file=decilog)
-                    modify_xdsinp(xdsinp, inp_params=[("JOB", "IDXREF"),
-                                                      ("UNIT_CELL_CONSTANTS",
-                                                       " ".join(["%.3f"%x for x in cell.parameters()])),
-                                                      ("SPACE_GROUP_NUMBER", "%d"%params.cell_prior.sgnum),
-                                                      ])
+                    inp.modify(inp_params=[("JOB", "IDXREF"),
+                                           ("UNIT_CELL_CONSTANTS",
+                                            " ".join(["%.3f"%x for x in cell.parameters()])),
+                                           ("SPACE_GROUP_NUMBER", "%d"%params.cell_prior.sgnum),
+                                           ])
                     for f in xds_files.generated_by_IDXREF:
                         util.rotate_file(os.path.join(root, f), copy=(f=="SPOT.XDS"))
 
+                    inp.write()
                     run_xds(wdir=root, show_progress=params.show_progress)
 
                     if not os.path.isfile(xparm):
@@ -463,8 +471,9 @@ def xds_sequence(root, params):
             raise "Unknown mode (%s)" % params.mode
 
         # To Integration
-        modify_xdsinp(xdsinp, inp_params=[("JOB", "DEFPIX INTEGRATE"),
-                                          ("INCLUDE_RESOLUTION_RANGE", "50 0")])
+        inp.modify(inp_params=[("JOB", "DEFPIX INTEGRATE"),
+                               ("INCLUDE_RESOLUTION_RANGE", "50 0")])
+        inp.write()
         run_xds(wdir=root, show_progress=params.show_progress)
         if os.path.isfile(integrate_lp):
             xds_plot_integrate.run(integrate_lp, os.path.join(root, "plot_integrate.log"))
@@ -477,14 +486,15 @@ def xds_sequence(root, params):
         if params.no_scaling:
             bk_prefix = make_backup(("XDS.INP",), wdir=root, quiet=True)
             xparm_obj = XPARM(xparm)
-            modify_xdsinp(xdsinp, inp_params=[("JOB", "CORRECT"),
-                                              ("CORRECTIONS", ""),
-                                              ("NBATCH", "1"),
-                                              ("MINIMUM_I/SIGMA", "50"),
-                                              ("REFINE(CORRECT)", ""),
-                                              ("UNIT_CELL_CONSTANTS", " ".join(["%.3f"%x for x in xparm_obj.unit_cell])),
-                                              ("SPACE_GROUP_NUMBER", "%d"%xparm_obj.spacegroup),])
+            inp.modify(inp_params=[("JOB", "CORRECT"),
+                                   ("CORRECTIONS", ""),
+                                   ("NBATCH", "1"),
+                                   ("MINIMUM_I/SIGMA", "50"),
+                                   ("REFINE(CORRECT)", ""),
+                                   ("UNIT_CELL_CONSTANTS", " ".join(["%.3f"%x for x in xparm_obj.unit_cell])),
+                                   ("SPACE_GROUP_NUMBER", "%d"%xparm_obj.spacegroup),])
             print(" running CORRECT without empirical scaling", file=decilog)
+            inp.write()
             run_xds(wdir=root, show_progress=params.show_progress)
             for f in xds_files.generated_by_CORRECT + ("XDS.INP",):
                 ff = os.path.join(root, f)
@@ -495,6 +505,7 @@ def xds_sequence(root, params):
                     os.rename(ff, ff+"_noscale")
 
             revert_files(("XDS.INP",), bk_prefix, wdir=root, quiet=True)
+            inp.reload()
 
         # Run pointless
         pointless_integrate = {}
@@ -515,17 +526,17 @@ def xds_sequence(root, params):
 
                 sgnum = symm.space_group_info().type().number()
                 cell = " ".join(["%.2f"%x for x in symm.unit_cell().parameters()])
-                modify_xdsinp(xdsinp, inp_params=[("SPACE_GROUP_NUMBER", "%d"%sgnum),
-                                                  ("UNIT_CELL_CONSTANTS", cell)])
+                inp.modify(inp_params=[("SPACE_GROUP_NUMBER", "%d"%sgnum),
+                                       ("UNIT_CELL_CONSTANTS", cell)])
             else:
                 print(" pointless failed.", file=decilog)
 
         flag_do_not_change_symm = False
         
         if xs_prior and params.cell_prior.force:
-            modify_xdsinp(xdsinp, inp_params=[("UNIT_CELL_CONSTANTS",
-                                               " ".join(["%.3f"%x for x in params.cell_prior.cell])),
-                                              ("SPACE_GROUP_NUMBER", "%d"%params.cell_prior.sgnum)])
+            inp.modify(inp_params=[("UNIT_CELL_CONSTANTS",
+                                    " ".join(["%.3f"%x for x in params.cell_prior.cell])),
+                                   ("SPACE_GROUP_NUMBER", "%d"%params.cell_prior.sgnum)])
             flag_do_not_change_symm = True
         elif params.cell_prior.method == "correct_only":
             xsxds = XPARM(xparm).crystal_symmetry()
@@ -534,9 +545,9 @@ def xds_sequence(root, params):
             if cosets.double_cosets is not None:
                 cell = xsxds.unit_cell().change_basis(cosets.combined_cb_ops()[0])
                 print(" Using given symmetry in CORRECT with symmetry constraints:", cell, file=decilog)
-                modify_xdsinp(xdsinp, inp_params=[("UNIT_CELL_CONSTANTS",
-                                                   " ".join(["%.3f"%x for x in cell.parameters()])),
-                                                  ("SPACE_GROUP_NUMBER", "%d"%params.cell_prior.sgnum),
+                inp.modify(inp_params=[("UNIT_CELL_CONSTANTS",
+                                        " ".join(["%.3f"%x for x in cell.parameters()])),
+                                       ("SPACE_GROUP_NUMBER", "%d"%params.cell_prior.sgnum),
                 ])
                 flag_do_not_change_symm = True
             else:
@@ -544,8 +555,9 @@ def xds_sequence(root, params):
 
 
         # Do Scaling
-        modify_xdsinp(xdsinp, inp_params=[("JOB", "CORRECT"),])
+        inp.modify(inp_params=[("JOB", "CORRECT"),])
 
+        inp.write()
         run_xds(wdir=root, show_progress=params.show_progress)
 
         if not os.path.isfile(xac_hkl):
@@ -561,11 +573,12 @@ def xds_sequence(root, params):
         if params.cut_resolution:
             if ret is not None and ret[0] is not None:
                 d_min = ret[0]
-                modify_xdsinp(xdsinp, inp_params=[("JOB", "CORRECT"),
-                                                  ("INCLUDE_RESOLUTION_RANGE", "50 %.2f"%d_min)])
+                inp.modify(inp_params=[("JOB", "CORRECT"),
+                                       ("INCLUDE_RESOLUTION_RANGE", "50 %.2f"%d_min)])
                 print(" Re-scale at %.2f A" % d_min, file=decilog)
                 os.rename(os.path.join(root, "CORRECT.LP"), os.path.join(root, "CORRECT_fullres.LP"))
                 os.rename(xac_hkl, os.path.join(root, "XDS_ASCII_fullres.HKL"))
+                inp.write()
                 run_xds(wdir=root, show_progress=params.show_progress)
                 print(" OK. ISa= %.2f" % correctlp.get_ISa(correct_lp, check_valid=True), file=decilog)
                 print(" (Original files are saved as *_fullres.*)", file=decilog)
@@ -616,11 +629,12 @@ def xds_sequence(root, params):
                 if need_rescale and not flag_do_not_change_symm:
                     sgnum = symm.space_group_info().type().number()
                     cell = " ".join(["%.2f"%x for x in symm.unit_cell().parameters()])
-                    modify_xdsinp(xdsinp, inp_params=[("JOB", "CORRECT"),
-                                                      ("SPACE_GROUP_NUMBER", "%d"%sgnum),
-                                                      ("UNIT_CELL_CONSTANTS", cell),
-                                                      ("INCLUDE_RESOLUTION_RANGE", "50 0")])
+                    inp.modify(inp_params=[("JOB", "CORRECT"),
+                                           ("SPACE_GROUP_NUMBER", "%d"%sgnum),
+                                           ("UNIT_CELL_CONSTANTS", cell),
+                                           ("INCLUDE_RESOLUTION_RANGE", "50 0")])
 
+                    inp.write()
                     run_xds(wdir=root, show_progress=params.show_progress)
 
                     ret = calc_merging_stats(xac_hkl)
@@ -628,11 +642,12 @@ def xds_sequence(root, params):
                     if params.cut_resolution:
                         if ret is not None and ret[0] is not None:
                             d_min = ret[0]
-                            modify_xdsinp(xdsinp, inp_params=[("JOB", "CORRECT"),
-                                                              ("INCLUDE_RESOLUTION_RANGE", "50 %.2f"%d_min)])
+                            inp.modify(inp_params=[("JOB", "CORRECT"),
+                                                   ("INCLUDE_RESOLUTION_RANGE", "50 %.2f"%d_min)])
                             print(" Re-scale at %.2f A" % d_min, file=decilog)
                             os.rename(os.path.join(root, "CORRECT.LP"), os.path.join(root, "CORRECT_fullres.LP"))
                             os.rename(xac_hkl, os.path.join(root, "XDS_ASCII_fullres.HKL"))
+                            inp.write()
                             run_xds(wdir=root, show_progress=params.show_progress)
                             print(" OK. ISa= %.2f" % correctlp.get_ISa(correct_lp, check_valid=True), file=decilog)
                             print(" (Original files are saved as *_fullres.*)", file=decilog)
@@ -665,6 +680,7 @@ def xds_sequence(root, params):
     except:
         print(traceback.format_exc(), file=decilog)
     finally:
+        inp.write() # does nothing unless there are unsaved changes
         print("\nxds_sequence finished at %s" % time.strftime("%Y-%m-%d %H:%M:%S"), file=decilog)
         decilog.close()
 # xds_sequence()
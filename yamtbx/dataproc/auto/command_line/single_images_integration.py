@@ -17,9 +17,11 @@ import numpy
 import glob
 import time
 import tempfile
+import hashlib
 
 from yamtbx.dataproc.xds import xds_inp
 from yamtbx.dataproc.xds import modify_xdsinp
+from yamtbx.dataproc.xds import files as xds_files
 from yamtbx.dataproc.xds.xparm import XPARM
 from yamtbx.dataproc.xds import integrate_hkl_as_flex
 from yamtbx.dataproc.xds import xds_ascii
@@ -47,6 +49,9 @@ lstin = None
 nproc = 1
  .type = int
  .help = number of processors
+batch_size = 1
+ .type = int
+ .help = number of images processed in turn by one worker. XYCORR is run only once per batch (if XDS.INP is the same).
 split_num = 100
  .type = int
  .help = split working directory to prevent having too many directories 
@@ -246,6 +251,44 @@ def remove_heavy_unuseful_files(wdir, keep_files=[]):
             os.remove(f)
 # remove_heavy_unuseful_files
 
+class XycorrCache(object):
+    """
+    XYCORR does not read images, so its results can be shared by the images whose XDS.INP are identical.
+    XYCORR is run once for each distinct XDS.INP in cachedir, and the results are copied to each working directory.
+    """
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+        self.results = {} # sha1 of XDS.INP: directory (None if failed)
+        self.n_reused = 0
+    # __init__()
+
+    def prepare(self, xdsinp, wdir):
+        # Returns True if XYCORR results are copied to wdir
+        inp_str = open(xdsinp, "rb").read()
+        key = hashlib.sha1(inp_str).hexdigest()
+
+        if key not in self.results:
+            cdir = os.path.join(self.cachedir, "xycorr_%.3d" % len(self.results))
+            os.mkdir(cdir)
+            for f in glob.glob(os.path.join(wdir, "data_10000*")):
+                os.symlink(os.path.abspath(f), os.path.join(cdir, os.path.basename(f)))
+            open(os.path.join(cdir, "XDS.INP"), "wb").write(inp_str)
+            modify_xdsinp(os.path.join(cdir, "XDS.INP"), inp_params=[("JOB", "XYCORR")])
+            run_xds(wdir=cdir, show_progress=False)
+            ok = all([os.path.isfile(os.path.join(cdir, f)) for f in xds_files.generated_by_XYCORR])
+            self.results[key] = cdir if ok else None
+        else:
+            self.n_reused += 1
+
+        cdir = self.results[key]
+        if cdir is None: return False
+
+        for f in xds_files.generated_by_XYCORR + ("xds_raw_output.log",):
+            shutil.copyfile(os.path.join(cdir, f), os.path.join(wdir, f))
+        return True
+    # prepare()
+# class XycorrCache
+
 def check_reidx(params, xs):
     assert params.checkcell.check and params.sgnum > 0
     xsref = crystal.symmetry(params.cell, params.sgnum)
@@ -266,7 +309,7 @@ def check_cell(params, xs):
                                      absolute_angle_tolerance=params.checkcell.tol_angle)
 # check_cell()
 
-def xds_sequence(img_in, topdir, data_root_dir, params):
+def xds_sequence(img_in, topdir, data_root_dir, params, xycorr_cache=None):
     relpath = os.path.relpath(os.path.dirname(img_in), data_root_dir)
     workdir = os.path.abspath(os.path.join(topdir, relpath, os.path.splitext(os.path.basename(img_in))[0]))
     print(workdir)
@@ -355,7 +398,14 @@ def xds_sequence(img_in, topdir, data_root_dir, params):
             ofs.write("\n%s\n" % "\n".join(params.extra_inp_str))
             ofs.close()
 
-        run_xds(wdir=tmpdir, show_progress=False)
+        if xycorr_cache is not None and xycorr_cache.prepare(xdsinp, tmpdir):
+            # XYCORR results were copied. XDS.INP is restored after the run so that the files are the same as usual.
+            xdsinp_org = open(xdsinp).read()
+            modify_xdsinp(xdsinp, inp_params=[("JOB", "INIT COLSPOT IDXREF")])
+            run_xds(wdir=tmpdir, show_progress=False)
+            open(xdsinp, "w").write(xdsinp_org)
+        else:
+            run_xds(wdir=tmpdir, show_progress=False)
 
         if params.tryhard:
             try_indexing_hard(tmpdir, show_progress=True, decilog=decilog)
@@ -490,6 +540,25 @@ def xds_sequence(img_in, topdir, data_root_dir, params):
 
 # xds_sequence()
 
+def xds_sequence_batch(args, data_root_dir, params):
+    """
+    Process images [(img_in, topdir), ..] in turn in one process, sharing XYCORR results.
+    Returns number of images and elapsed time.
+    """
+    startt = time.time()
+    scratch_root = params.tmpdir if params.tmpdir is not None else params.topdir
+    if not os.path.exists(scratch_root): os.makedirs(scratch_root)
+    cachedir = tempfile.mkdtemp(prefix="xycorr", dir=scratch_root)
+    xycorr_cache = XycorrCache(cachedir)
+    try:
+        for img_in, topdir in args:
+            xds_sequence(img_in, topdir, data_root_dir, params, xycorr_cache=xycorr_cache)
+    finally:
+        shutil.rmtree(cachedir)
+
+    return len(args), xycorr_cache.n_reused, time.time() - startt
+# xds_sequence_batch()
+
 def get_file_list(lstin):
     ret = []
     for l in open(lstin):
@@ -505,13 +574,29 @@ def run(params):
 
     data_root_dir = os.path.dirname(os.path.commonprefix(input_files))
 
-    fun_local = lambda x: xds_sequence(x[0], x[1],  data_root_dir, params)
+    args = list(zip(input_files, top_dirs))
+    startt = time.time()
+
+    if params.batch_size > 1:
+        batches = [args[i:i+params.batch_size] for i in range(0, len(args), params.batch_size)]
+        fun_batch = lambda x: xds_sequence_batch(x, data_root_dir, params)
+        ret = easy_mp.pool_map(fixed_func=fun_batch,
+                               args=batches,
+                               processes=params.nproc)
+        n_reused = sum([x[1] for x in ret if x is not None])
+        print("%d batches of up to %d images. XYCORR results reused for %d images." % (len(batches), params.batch_size, n_reused))
+    else:
+        fun_local = lambda x: xds_sequence(x[0], x[1],  data_root_dir, params)
+
+        #for arg in input_files: fun_local(arg)
 
-    #for arg in input_files: fun_local(arg)
+        easy_mp.pool_map(fixed_func=fun_local,
+                         args=args,
+                         processes=params.nproc)
 
-    easy_mp.pool_map(fixed_func=fun_local,
-                     args=list(zip(input_files, top_dirs)),
-                     processes=params.nproc)
+    eltime = time.time() - startt
+    print("Processed %d images in %.1f sec with nproc=%d (%.1f images/min)" % (len(args), eltime, params.nproc,
+                                                                             len(args)/eltime*60. if eltime > 0 else float("nan")))
 # run()
 
 def run_from_args(argv):
@@ -692,7 +692,51 @@ def find_problems(xds_wd):
     return problems
 # find_problems()
 
-def make_kamo_report(bssjobs, topdir, htmlout):
+class KamoReportCache(object):
+    """
+    Per-dataset cache for make_kamo_report().
+    Results that need parsing of log files (find_problems() and indexed lattice fraction) are kept
+    with modification times of the files, and recalculated only when any of them changed.
+    """
+    source_files = ("IDXREF.LP", "XPARM.XDS", "INTEGRATE.LP", "CORRECT.LP", "XDSSTAT.LP")
+
+    def __init__(self):
+        self.cache = {} # wd -> (mtimes, (problems, lattp))
+        self.n_updated = 0
+
+    def get_mtimes(self, wd):
+        ret = []
+        for f in self.source_files:
+            try: ret.append(os.path.getmtime(os.path.join(wd, f)))
+            except OSError: ret.append(None)
+        return tuple(ret)
+    # get_mtimes()
+
+    def get(self, wd):
+        # Take mtimes before reading files so that files modified during parsing are read again next time
+        mtimes = self.get_mtimes(wd)
+        if wd in self.cache and self.cache[wd][0] == mtimes:
+            return self.cache[wd][1]
+
+        problems = find_problems(wd)
+        lattp = float("nan")
+        idxref_lp = os.path.join(wd, "IDXREF.LP")
+        if os.path.isfile(idxref_lp):
+            lpobj = idxreflp.IdxrefLp(idxref_lp)
+            lattp = lpobj.first_subtree_fraction()*100.
+
+        self.cache[wd] = (mtimes, (problems, lattp))
+        self.n_updated += 1
+        return problems, lattp
+    # get()
+# class KamoReportCache
+
+def make_kamo_report(bssjobs, topdir, htmlout, cache=None):
+    """
+    If cache (KamoReportCache) is given, only datasets with updated files are analyzed again.
+    """
+    if cache is None: cache = KamoReportCache()
+
     report_html = """\
 <html>
 <head>
@@ -749,7 +793,6 @@ created on %s
         dsname = os.path.basename(wd).replace("xds_", "")
         correct_lp = os.path.join(wd, "CORRECT.LP")
         spot_xds = os.path.join(wd, "SPOT.XDS")
-        idxref_lp = os.path.join(wd, "IDXREF.LP")
         xds_inp = os.path.join(wd, "XDS.INP")
         stats_pkl = os.path.join(wd, "merging_stats.pkl")
 
@@ -757,9 +800,9 @@ created on %s
         wavelen = job.wavelength
         deltaphi = job.osc_step
 
-        lattp, ISa, resn, cmpl, sg = float("nan"), float("nan"), float("nan"), float("nan"), "?"
+        ISa, resn, cmpl, sg = float("nan"), float("nan"), float("nan"), "?"
 
-        problems = find_problems(wd)
+        problems, lattp = cache.get(wd)
         indiv_html = os.path.join(relwd, "report.html")
         problems_str = "OK"
         if len(problems) > 0:
@@ -767,10 +810,6 @@ created on %s
 
         totalphi = job.osc_end - job.osc_start
 
-        if os.path.isfile(idxref_lp):
-            lpobj = idxreflp.IdxrefLp(idxref_lp)
-            lattp = lpobj.first_subtree_fraction()*100.
-
         lp = bssjobs._load_if_chached("correctlp", correct_lp)
         if lp is not None:
             ISa = lp.get_ISa() if lp.is_ISa_valid() else float("nan")
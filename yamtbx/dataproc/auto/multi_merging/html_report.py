@@ -18,8 +18,17 @@ from cctbx import sgtbx
 import time
 import os
 import shutil
+import json
 
 class HtmlReportMulti(object):
+    """
+    report.html only contains small fixed parts; per-dataset and per-cluster data are written to
+    javascript files in report_data/ (JSON wrapped with kamoReportData() so that they can be loaded from file:// URL),
+    which are loaded when the page is opened or a section is expanded.
+    Merging results are appended to report_data/merge.js as each cluster finishes.
+    """
+    DATADIR = "report_data"
+
     def __init__(self, root):
         self.root = root
 
@@ -30,6 +39,10 @@ class HtmlReportMulti(object):
 
         shutil.copytree(d3path, jsdir)
 
+        self.datadir = os.path.join(self.root, self.DATADIR)
+        if not os.path.isdir(self.datadir): os.mkdir(self.datadir)
+        open(self.data_file("merge"), "w").close() # appended by add_merge_result()
+
         self.html_head = """\
 <!DOCTYPE html>
 <html>
@@ -63,6 +76,29 @@ class HtmlReportMulti(object):
     }
   }
 
+  // Data in report_data/<key>.js. A file may contain more than one kamoReportData() call.
+  var report_data = {};
+  var report_data_callbacks = {};
+  var kamoReportData = function(key, data) {
+    report_data[key].push(data);
+    var cbs = report_data_callbacks[key];
+    for (var i = 0; i < cbs.length; i++) cbs[i](data);
+  }
+
+  // Call callback(data) for each data in report_data/<key>.js. The file is loaded only once.
+  var loadReportData = function(key, callback) {
+    if (key in report_data) {
+      report_data_callbacks[key].push(callback);
+      report_data[key].forEach(callback);
+      return;
+    }
+    report_data[key] = [];
+    report_data_callbacks[key] = [callback];
+    var s = document.createElement("script");
+    s.src = "%(datadir)s/" + key + ".js?v=" + Date.now();
+    document.head.appendChild(s);
+  }
+
   var show_or_hide = function(caller_id, obj_id, flag) { 
     var trg = document.getElementById(obj_id);
     if (flag) { 
@@ -198,18 +234,31 @@ workdir: %(wd)s<br />
 created on %(cdate)s
 </div>
 <hr>
-""" % dict(wd=self.root, cdate=time.strftime("%Y-%m-%d %H:%M:%S"), amcharts_root=amcharts_root)
+""" % dict(wd=self.root, cdate=time.strftime("%Y-%m-%d %H:%M:%S"), amcharts_root=amcharts_root,
+           datadir=self.DATADIR)
 
         self.html_params = ""
         self.html_inputfiles = ""
         self.html_clustering = ""
         self._html_clustering_details = ""
-        self.html_merge_results = []
-        self.html_merge_plot_data = []
+        self.n_merge_results = 0
         self.params = None
         self.cells = None
     # __init__()
 
+    def data_file(self, key): return os.path.join(self.datadir, "%s.js" % key)
+
+    def write_data(self, key, data, append=False):
+        line = "kamoReportData(%s, %s);\n" % (json.dumps(key), json.dumps(data, separators=(",", ":")))
+        if append:
+            with open(self.data_file(key), "a") as ofs: ofs.write(line)
+            return
+
+        tmp = self.data_file(key) + ".tmp"
+        with open(tmp, "w") as ofs: ofs.write(line)
+        os.rename(tmp, self.data_file(key))
+    # write_data()
+
     def add_params(self, params, master_params_str):
         self.params = params
         self.html_params = """
@@ -227,13 +276,7 @@ created on %(cdate)s
     def add_cells_and_files(self, cells, symm_str):
         self.cells = cells
         # Table
-        table_str = ""
-        for idx, xac in enumerate(cells):
-            cell = cells[xac]
-            table_str += "<tr>\n"
-            table_str += " <td>%.4d</td><td>%s</td>" % (idx+1, xac) # idx, file
-            table_str += "".join(["<td>%.2f</td>"%x for x in cell])
-            table_str += "\n</tr>\n"
+        self.write_data("cells", [[idx+1, xac] + [round(float(x), 2) for x in cells[xac]] for idx, xac in enumerate(cells)])
 
         # Hist
         cellconstr = CellConstraints(sgtbx.space_group_info(symm_str).group())
@@ -317,16 +360,34 @@ created on %(cdate)s
 </table>
 
 <h3>Files</h3>
-<a href="#" onClick="toggle_show('div-input-files'); return false;">Show/Hide</a>
+<a href="#" onClick="show_input_files(); return false;">Show/Hide</a>
 <div id="div-input-files" style="display:none;">
 <table class="cells">
+<tbody id="input-files-body">
 <tr>
  <th>idx</th> <th>file</th> <th>a</th> <th>b</th> <th>c</th> <th>&alpha;</th> <th>&beta;</th> <th>&gamma;</th>
 </tr>
-%s
+</tbody>
 </table>
 </div>
-""" % (len(cells), symm_str, hist_str, table_str)
+<script>
+  var show_input_files = function() {
+    toggle_show('div-input-files');
+    loadReportData("cells", function(rows) {
+      var tbody = document.getElementById("input-files-body");
+      if (tbody.rows.length > 1) return;
+      rows.forEach(function(r) {
+        var tr = tbody.insertRow(-1);
+        var idx = String(r[0]);
+        while (idx.length < 4) idx = "0" + idx;
+        tr.insertCell(-1).textContent = idx;
+        tr.insertCell(-1).textContent = r[1];
+        for (var i = 2; i < 8; i++) tr.insertCell(-1).textContent = r[i].toFixed(2);
+      });
+    });
+  }
+</script>
+""" % (len(cells), symm_str, hist_str)
         self.write_html()
     # add_files()
 
@@ -341,31 +402,35 @@ created on %(cdate)s
             clsdat = os.path.join(self.root, "blend", "blend_cluster_summary.dat")
             
         header = None
-        data = ""
+        rows = []
         for l in open(clsdat):
             if header is None and not l.startswith("#"):
-                header = "".join(["<th>%s</th>" % x for x in l.split()])
+                header = l.split()
             elif header is not None:
-                data += "<tr>%s</tr>" % "".join(["<td>%s</td>" % x for x in l.split()])
+                rows.append(l.split())
 
         treejson = os.path.join(self.root, method, "dendro.json")
-        treedata = open(treejson).read() if os.path.isfile(treejson) else ""
+        treedata = json.load(open(treejson)) if os.path.isfile(treejson) else None
 
-        cluster_descr, file_descr = [], []
+        cluster_descr, file_descr = {}, {}
         IDs_set = set()
         for vv in clusters:
             if method == "cc_clustering":
                 clno, IDs, clh, cmpl, redun, acmpl, aredun, ccmean, ccmin = vv
-                cluster_descr.append('"%s":"Cluster_%.4d (%d files)<br />ClH: %5.2f<br />Cmpl= %5.1f%%, Redun=%5.1f<br />ACmpl= %5.1f%%, ARedun=%5.1f<br />CCmean=%.4f, CCmin=%.4f"' % (clno, clno, len(IDs), clh, cmpl, redun, acmpl, aredun, ccmean, ccmin))
+                cluster_descr["%s"%clno] = "Cluster_%.4d (%d files)<br />ClH: %5.2f<br />Cmpl= %5.1f%%, Redun=%5.1f<br />ACmpl= %5.1f%%, ARedun=%5.1f<br />CCmean=%.4f, CCmin=%.4f" % (clno, len(IDs), clh, cmpl, redun, acmpl, aredun, ccmean, ccmin)
             else:
                 clno, IDs, clh, cmpl, redun, acmpl, aredun, LCV, aLCV = vv
-                cluster_descr.append('"%s":"Cluster_%.4d (%d files)<br />ClH: %5.2f, LCV: %5.2f%%, aLCV: %5.2f &Aring;<br />Cmpl= %5.1f%%, Redun=%5.1f<br />ACmpl= %5.1f%%, ARedun=%5.1f"' % (clno, clno, len(IDs), clh, LCV, aLCV, cmpl, redun, acmpl, aredun))
+                cluster_descr["%s"%clno] = "Cluster_%.4d (%d files)<br />ClH: %5.2f, LCV: %5.2f%%, aLCV: %5.2f &Aring;<br />Cmpl= %5.1f%%, Redun=%5.1f<br />ACmpl= %5.1f%%, ARedun=%5.1f" % (clno, len(IDs), clh, LCV, aLCV, cmpl, redun, acmpl, aredun)
 
             IDs_set.update(IDs)
 
         xac_files = list(self.cells.keys())
         for idx in IDs_set:
-            file_descr.append('%s:"%s"' % (idx, xac_files[idx-1]))
+            file_descr["%s"%idx] = xac_files[idx-1]
+
+        self.write_data("clusters", dict(tree=treedata, merged_clusters=["%s"%x[0] for x in clusters],
+                                         cluster_descr=cluster_descr, file_descr=file_descr,
+                                         header=header, rows=rows))
 
         if method == "cc_clustering":
             self.html_clustering = "<h2>CC-based clustering</h2>"
@@ -377,15 +442,13 @@ created on %(cdate)s
         self.html_clustering += """
 <a href="%(method)s/tree.png">See original cluster dendrogram</a>
 <div id="tree-svg-div">
-<script type="application/json" id="treedata">%(treedata)s</script>
 <script>
-  
-  var data = document.getElementById('treedata').innerHTML;
-  root = JSON.parse(data);
-  
-  var merged_clusters = [%(merged_clusters)s];
-  var cluster_descr = {%(cluster_descr)s};
-  var file_descr = {%(file_descr)s};
+loadReportData("clusters", function(clsdata) {
+  if (clsdata.tree === null) return;
+  var root = clsdata.tree;
+  var merged_clusters = clsdata.merged_clusters;
+  var cluster_descr = clsdata.cluster_descr;
+  var file_descr = clsdata.file_descr;
 
   var width = 1500, height = 600;
   var cluster = d3.layout.cluster()
@@ -462,17 +525,31 @@ function mouseouted(d) {
 }
 
   d3.select(self.frameElement).style("height", height + "px");
+});
 </script></div>
-<a href="#" onClick="toggle_show('div-cc-clusters'); return false;">Show/Hide cluster list</a>
+<a href="#" onClick="show_cluster_list(); return false;">Show/Hide cluster list</a>
 <div id="div-cc-clusters" style="display:none;">
 <table class="cells">
-<tr>%(header)s</tr>
-%(data)s
+<tbody id="cluster-list-body">
+</tbody>
 </table>
 </div>
-""" % dict(treedata=treedata, merged_clusters=",".join(['"%s"'%x[0] for x in clusters]),
-           file_descr=",".join(file_descr), cluster_descr=",".join(cluster_descr),
-           header=header, data=data, method=method)
+<script>
+  var show_cluster_list = function() {
+    toggle_show('div-cc-clusters');
+    loadReportData("clusters", function(clsdata) {
+      var tbody = document.getElementById("cluster-list-body");
+      if (tbody.rows.length > 0 || clsdata.header === null) return;
+      var tr = tbody.insertRow(-1);
+      clsdata.header.forEach(function(x) { tr.appendChild(document.createElement("th")).textContent = x; });
+      clsdata.rows.forEach(function(r) {
+        tr = tbody.insertRow(-1);
+        r.forEach(function(x) { tr.insertCell(-1).textContent = x; });
+      });
+    });
+  }
+</script>
+""" % dict(method=method)
         self.write_html()
     # add_clutering_result()
 
@@ -481,17 +558,17 @@ function mouseouted(d) {
         cc_data = [(i,j,cc,nref),...]
         """
 
-        ccvalues = ",".join(["%.4f"%x[2] for x in [y for y in cc_data if y[2]==y[2]]])
-        ccdata = ",".join(["{i:%d,j:%d,cc:%.4f,n:%d}"%(x[0]+1,x[1]+1,x[2],x[3]) for x in cc_data])
-        ccdata = ccdata.replace("nan", "NaN")
         ncols = max([max(x[0],x[1]) for x in cc_data]) + 1
+        self.write_data("cc_data", dict(ncols=int(ncols),
+                                        cc=[[int(x[0])+1, int(x[1])+1, round(float(x[2]), 4), int(x[3])] for x in cc_data]))
 
         # Histogram
         self._html_clustering_details = """
 <div id="cchist"></div>
 <script>
+loadReportData("cc_data", function(ccd) {
 // Reference: http://bl.ocks.org/mbostock/3048450
-var ccvalues = [%(ccvalues)s];
+var ccvalues = ccd.cc.filter(function(x) { return x[2]==x[2]; }).map(function(x) { return x[2]; });
 var margin = {top: 10, right: 30, bottom: 30, left: 30},
     width = 800 - margin.left - margin.right,
     height = 400 - margin.top - margin.bottom;
@@ -542,18 +619,20 @@ svg.append("g")
     .append('text')
      .text("CC")
      .attr('transform','translate('+(width+10)+',0)');
+});
 </script>
-""" % dict(ccvalues=ccvalues)
+"""
 
     # Matrix heatmap
         self._html_clustering_details += """
 <div id="ccheatmap"></div>
 <script>
+loadReportData("cc_data", function(ccd) {
   // Reference: Day / Hour Heatmap http://bl.ocks.org/tjdecke/5558084
   //            Days-Hours Heatmap http://bl.ocks.org/oyyd/859fafc8122977a3afd6
   //            Method: Hierarchical clustering with SciPy and visualization in D3.js http://blog.nextgenetics.net/?e=44
-  var ccdata = [%(ccdata)s];
-  var ncols = %(ncols)d;
+  var ccdata = ccd.cc.map(function(x) { return {i:x[0], j:x[1], cc:x[2], n:x[3]}; });
+  var ncols = ccd.ncols;
   var margin = { top: 50, right: 0, bottom: 100, left: 30 },
       width = 800 - margin.left - margin.right,
       height = 800 - margin.top - margin.bottom,
@@ -640,9 +719,10 @@ svg.append("g")
             .attr('stroke','none')
          tipmat.hide();
       });
+});
 </script>
 
-""" % dict(ccdata=ccdata, ncols=ncols)
+"""
     # add_cc_clustering_details()
 
     def _make_merge_table_framework(self):
@@ -650,6 +730,7 @@ svg.append("g")
 <h2>Merging summary</h2>
 
 <table class="merge">
+<tbody id="merge-results-body">
  <tr>
   <th rowspan="2" colspan="2">cluster</th><th rowspan="2" title="Cluster height">ClH</th><th rowspan="2" title="Linear Cell Variation defined in BLEND">LCV</th><th rowspan="2" title="absolute Linear Cell Variation defined in BLEND">aLCV</th><th rowspan="2" title="Number of all datasets in the cluster">#DS<br />all</th><th rowspan="2" title="Number of actually merged datasets in the cluster">#DS<br />used</th>
   <th colspan="5">Overall</th>
@@ -665,8 +746,27 @@ svg.append("g")
   <th>Cmpl</th><th>Redun</th><th>I/&sigma;(I)</th><th><i>R</i><sub>meas</sub></th><th>CC<sub>1/2</sub></th><th>SigAno</th><th>CC<sub>ano</sub></th>
   <th>best</th><th>wrst</th>
  </tr>
- %s
+</tbody>
 </table>
+<script>
+  var load_merge_detail = function(idno) {
+    loadReportData("merge_detail_" + idno, function(snip) {
+      document.getElementById("merge-td-" + idno).firstChild.textContent = snip;
+    });
+  }
+
+  var toggle_merge_detail = function(caller, idno) {
+    load_merge_detail(idno);
+    toggle_show2(caller, "merge-td-" + idno);
+  }
+
+  var show_or_hide_all_merge = function(flag) {
+    report_data["merge"].forEach(function(d) {
+      if (!flag) load_merge_detail(d.id);
+      show_or_hide("merge-td-mark-" + d.id, "merge-td-" + d.id, flag);
+    });
+  }
+</script>
 """
     # _make_merge_table_framework()
 
@@ -693,7 +793,7 @@ svg.append("g")
     "legend": {
         "useGraphSettings": true,
     },
-    "dataProvider": [%(data)s],
+    "dataProvider": [],
     "valueAxes": [{
         "position":"bottom",
         "axisAlpha": 0,
@@ -735,9 +835,40 @@ svg.append("g")
 </tr>
 </table>
 </form>
-""" % dict(axis_opts_x="\n".join(axis_opts_x), axis_opts_y="\n".join(axis_opts_y), data="%s")
+""" % dict(axis_opts_x="\n".join(axis_opts_x), axis_opts_y="\n".join(axis_opts_y))
     # _make_merge_plot_framework()
 
+    def _make_merge_loader(self):
+        # Rows are added as results are appended to merge.js; reload the page to see new results.
+        return """
+<script>
+  var merge_plot_timer = null;
+  loadReportData("merge", function(d) {
+    var tbody = document.getElementById("merge-results-body");
+    var tr = tbody.insertRow(-1);
+    var td = tr.insertCell(-1);
+    td.id = "merge-td-mark-" + d.id;
+    td.innerHTML = "&#x25bc;";
+    td.onclick = function() { toggle_merge_detail(this, d.id); };
+    d.row.forEach(function(x) { tr.insertCell(-1).textContent = x; });
+
+    tr = tbody.insertRow(-1);
+    tr.insertCell(-1).style.padding = "0px";
+    td = tr.insertCell(-1);
+    td.id = "merge-td-" + d.id;
+    td.colSpan = 27;
+    td.style.display = "none";
+    td.style.padding = "0px";
+    td.appendChild(document.createElement("pre"));
+
+    chart_merge.dataProvider.push(d.plot);
+    if (merge_plot_timer === null)
+      merge_plot_timer = setTimeout(function() { merge_plot_timer = null; chart_merge.validateData(); }, 100);
+  });
+</script>
+"""
+    # _make_merge_loader()
+
     def add_merge_result(self, workdir, clh, LCV, aLCV, xds_files, num_files, stats):
         axis_opts = "cls ClH   LCV aLCV ds.all ds.used  Cmpl Redun I/sigI Rmeas CC1/2 Cmpl.ou Red.ou I/sig.ou Rmeas.ou CC1/2.ou Cmpl.in Red.in I/sig.in Rmeas.in CC1/2.in SigAno.in CCano.in WilsonB aniso.best aniso.worst dmin.est".split()
 
@@ -769,12 +900,12 @@ svg.append("g")
                        stats["dmin_est"],
                        )
 
-        tmptmp = tmps.replace("nan",'"nan"').split()
-        tmptmp[0] = '"%s"' % tmptmp[0]
-        self.html_merge_plot_data.append("{%s}"%",".join(['"%s":%s'%tuple(x) for x in zip(axis_opts, tmptmp)]))
+        tmptmp = tmps.split()
+        plot_data = dict(cls=tmptmp[0])
+        for k, v in zip(axis_opts[1:], tmptmp[1:]):
+            plot_data[k] = "nan" if "nan" in v else float(v)
 
-        tmps = "".join(["<td>%s</td>"%x for x in tmps.split()])
-        idno = len(self.html_merge_results)
+        idno = self.n_merge_results
         if self.params.program == "xscale":
             table_snip = xscalelp.snip_symm_and_cell(stats["lp"]) + "\n"
             table_snip += xscalelp.snip_stats_table(stats["lp"])
@@ -793,11 +924,9 @@ svg.append("g")
                     
         else:
             table_snip = ""
-        tmps2 = """ <tr><td onClick="toggle_show2(this, 'merge-td-%d');" id="merge-td-mark-%d"">&#x25bc;</td>%s</tr>\n""" %(idno,idno,tmps)
-        tmps2 += """ <tr><td style="padding: 0px;"><td colspan="27" style="display:none;padding:0px;" id="merge-td-%d"><pre>%s</pre></td></tr>""" % (idno, table_snip)
-
-        self.html_merge_results.append(tmps2)
-        
+        self.write_data("merge_detail_%d" % idno, table_snip)
+        self.write_data("merge", dict(id=idno, row=tmptmp, plot=plot_data), append=True)
+        self.n_merge_results += 1
     # add_merge_result()
 
     def write_html(self):
@@ -808,14 +937,13 @@ svg.append("g")
         ofs.write(self.html_clustering)
 
         # merging table
-        ofs.write(self._make_merge_table_framework()%"".join(self.html_merge_results))
-        tmps = ";".join(["show_or_hide('merge-td-mark-%d', 'merge-td-%d', 0)"%(x,x) for x in range(len(self.html_merge_results))])
-        ofs.write("""<a href="#" onClick="%s;return false;">Expand all</a> / """ % tmps)
-        tmps = ";".join(["show_or_hide('merge-td-mark-%d', 'merge-td-%d', 1)"%(x,x) for x in range(len(self.html_merge_results))])
-        ofs.write("""<a href="#" onClick="%s;return false;">Collapse all</a>\n""" % tmps)
+        ofs.write(self._make_merge_table_framework())
+        ofs.write("""<a href="#" onClick="show_or_hide_all_merge(0);return false;">Expand all</a> / """)
+        ofs.write("""<a href="#" onClick="show_or_hide_all_merge(1);return false;">Collapse all</a>\n""")
 
         # merging plot
-        ofs.write(self._make_merge_plot_framework()%",".join(self.html_merge_plot_data))
+        ofs.write(self._make_merge_plot_framework())
+        ofs.write(self._make_merge_loader())
 
         ofs.write("\n</body></html>")
         ofs.close()
@@ -22,6 +22,7 @@ import collections
 import shutil
 import os
 import glob
+import pickle
 import traceback
 import networkx as nx
 import numpy
@@ -36,6 +37,18 @@ def make_bin_str(d_min, d_max, nbins=9):
     return "RESOLUTION_SHELLS= %s\n" % rshells
 # make_bin_str()
 
+def read_rejection_records(workdir):
+    # returns {tuple(files): record} of XscaleCycles.save_rejections() in cluster directories
+    ret = {}
+    for pklin in glob.glob(os.path.join(workdir, "*", "rejections.pkl")):
+        try:
+            rec = pickle.load(open(pklin, "rb"))
+        except:
+            continue
+        ret[tuple(rec["files"])] = rec
+    return ret
+# read_rejection_records()
+
 class XscaleCycles(object):
     def __init__(self, workdir, anomalous_flag, d_min, d_max,
                  reject_method, reject_params, xscale_params, res_params,
@@ -74,6 +87,7 @@ class XscaleCycles(object):
         if "framecc" in reject_method: self.reject_method.append("framecc")
         if "lpstats" in reject_method: self.reject_method.append("lpstats")
         if "delta_cc1/2" in reject_method: self.reject_method.append("delta_cc1/2")
+        self.reject_method_org = list(self.reject_method)
 
         self.workdir = self.request_next_workdir()
         self.xscale_inp_head = ""
@@ -211,11 +225,43 @@ class XscaleCycles(object):
         self.dmin_est_at_cycles[cycle_number] = d_min_est
     # estimate_resolution()
 
-    def run_cycles(self, xds_ascii_files):
+    def save_rejections(self, pklout, xds_ascii_files):
+        # Rejected files and frames, which can be given to run_cycles() of another run with different d_min
+        pickle.dump(dict(workdir=os.path.abspath(self.workdir_org), files=list(xds_ascii_files), d_min=self.d_min,
+                         reject_method=self.reject_method_org, n_cycles=self.get_last_cycle_number(),
+                         removed_files=self.removed_files, removed_reason=self.removed_reason,
+                         altfile=dict([(k, os.path.abspath(v)) for k, v in self.altfile.items()])),
+                    open(pklout, "wb"), -1)
+    # save_rejections()
+
+    def apply_rejections(self, xds_ascii_files, previous):
+        """
+        Take over rejected files and frames (record of save_rejections()) and skip rejection cycles.
+        Returns files to be merged.
+        """
+        print("Reusing rejections in %s (d_min= %s)" % (previous["workdir"], previous["d_min"]), file=self.out)
+        for f in previous["removed_files"]:
+            if f in self.removed_files: continue
+            self.removed_files.append(f)
+            self.removed_reason[f] = previous["removed_reason"].get(f, "unknown")
+
+        for f in previous["altfile"]:
+            if f in self.removed_files: continue
+            shutil.copyfile(previous["altfile"][f], self.request_file_modify(f))
+
+        print(" %d files rejected, frames extracted in %d files" % (len(self.removed_files), len(self.altfile)), file=self.out)
+        self.reject_method = []
+        return [x for x in xds_ascii_files if x not in self.removed_files]
+    # apply_rejections()
+
+    def run_cycles(self, xds_ascii_files, previous=None):
         self.all_data_root = os.path.dirname(os.path.commonprefix(xds_ascii_files))
         self.removed_files = []
         self.removed_reason = {}
         print("********************* START FUNCTION ***********************", file=self.out)
+        if previous is not None:
+            xds_ascii_files = self.apply_rejections(xds_ascii_files, previous)
+
         if self.reference_file:
             self.run_cycle([self.reference_file,]+xds_ascii_files)
         else:
@@ -10,6 +10,8 @@ from __future__ import print_function
 import sys
 from libtbx import slots_getstate_setstate
 from iotbx import merging_statistics
+from cctbx import miller
+from cctbx.array_family import flex
 from libtbx.utils import null_out
 from libtbx import adopt_init_args
 import numpy
@@ -64,24 +66,112 @@ def fit_curve_for_cchalf(s2_list, cc_list, log_out, verbose=True):
     return lsq.x
 # fit_curve_for_cchalf()
 
-def initial_estimate_byfit_cchalf(i_obs, cc_half_min, anomalous_flag, log_out):
+class cc_half_in_shells(object):
+  """
+  CC1/2 in resolution shells, giving the same values as merging_statistics.merging_stats() on
+  the reflections selected by binner.
+
+  Reflections are mapped to ASU and sorted by index (as merging_stats does) and by d*^2 only once.
+  For each shell, the reflections are found by bisection and only they are passed to split_unmerged(),
+  so the cost does not depend on the size of whole data.
+  Note that the random half-dataset split depends on which reflections are in the shell
+  (one random number sequence is shared by all indices), so CC1/2 cannot be accumulated per index.
+  """
+  def __init__(self, i_obs, anomalous=False):
+    self.i_obs = i_obs
+    self.anomalous = anomalous
+    self.unit_cell = i_obs.unit_cell()
+
+    # Lower resolution limit of binner is determined by this index
+    d_star_sq_all = self.unit_cell.d_star_sq(i_obs.indices())
+    self.h_lowres = flex.miller_index([i_obs.indices()[flex.min_index(d_star_sq_all)]])
+
+    # The same preparation as merging_stats. Sort is stable, so subset of sorted array is also sorted.
+    array = i_obs.select(i_obs.sigmas() > 0)
+    d_star_sq = self.unit_cell.d_star_sq(array.indices()) # before map_to_asu, as binner does
+    array = array.customized_copy(anomalous_flag=anomalous).map_to_asu()
+    perm = array.sort_permutation(by_value="packed_indices")
+    self.array = array.select(perm)
+    d_star_sq = d_star_sq.select(perm)
+
+    # position in sorted array, in ascending order of d*^2
+    self.perm_d = flex.sort_permutation(d_star_sq, stable=True)
+    self.d_star_sq = list(d_star_sq.select(self.perm_d))
+  # __init__()
+
+  def binning(self, n_bins, d_min=0):
+    if d_min > 0: return miller.binning(self.unit_cell, n_bins, self.h_lowres, 0, d_min)
+    return miller.binning(self.unit_cell, n_bins, self.i_obs.indices(), 0, 0)
+  # binning()
+
+  def select_bin(self, binning, i_bin):
+    # bisect_left with key; binning.get_i_bin() is what binner uses
+    def first_with_bin_from(i_min):
+      lo, hi = 0, len(self.d_star_sq)
+      while lo < hi:
+        mid = (lo+hi)//2
+        if binning.get_i_bin(self.d_star_sq[mid]) < i_min: lo = mid+1
+        else: hi = mid
+      return lo
+    # first_with_bin_from()
+
+    sel = self.perm_d[first_with_bin_from(i_bin):first_with_bin_from(i_bin+1)]
+    return sel.select(flex.sort_permutation(sel))
+  # select_bin()
+
+  def merging_stats(self, binning, i_bin):
+    # Original (slow) way. Used when the bin is empty to behave exactly the same.
+    self.i_obs.use_binning(binning)
+    return merging_statistics.merging_stats(self.i_obs.select(self.i_obs.binner().selection(i_bin)),
+                                            anomalous=self.anomalous)
+  # merging_stats()
+
+  def cc_one_half(self, sel):
+    split = miller.split_unmerged(unmerged_indices=self.array.indices().select(sel),
+                                  unmerged_data=self.array.data().select(sel),
+                                  unmerged_sigmas=self.array.sigmas().select(sel))
+    return flex.linear_correlation(split.data_1, split.data_2).coefficient()
+  # cc_one_half()
+
+  def outer_shell(self, d_min, n_bins):
+    # CC1/2 in the last bin of i_obs.setup_binner(d_min=d_min, n_bins=n_bins)
+    binning = self.binning(n_bins, d_min)
+    i_bin = binning.range_used()[-1]
+    sel = self.select_bin(binning, i_bin)
+    if sel.size() == 0: return self.merging_stats(binning, i_bin).cc_one_half
+    return self.cc_one_half(sel)
+  # outer_shell()
+
+  def all_shells(self, n_bins):
+    # d_min and CC1/2 in bins of i_obs.setup_binner(n_bins=n_bins)
+    binning = self.binning(n_bins)
+    ret = []
+    for i_bin in binning.range_used():
+      sel = self.select_bin(binning, i_bin)
+      if sel.size() == 0:
+        try:
+          bin_stats = self.merging_stats(binning, i_bin)
+        except RuntimeError: # complains that no reflections left after sigma-filtering.
+          continue
+        ret.append((bin_stats.d_min, bin_stats.cc_one_half))
+      else:
+        ret.append((self.array.select(sel).d_min(), self.cc_one_half(sel)))
+    return ret
+  # all_shells()
+# class cc_half_in_shells
+
+def initial_estimate_byfit_cchalf(i_obs, cc_half_min, anomalous_flag, log_out, shells=None):
     # Up to 200 bins. If few reflections, 50 reflections per bin. At least 9 shells.
     n_bins = max(min(int(i_obs.size()/50. + .5), 200), 9)
     log_out.write("Using %d bins for initial estimate\n" % n_bins)
 
-    i_obs.setup_binner(n_bins=n_bins)
-    bins = []
+    if shells is None: shells = cc_half_in_shells(i_obs, anomalous=anomalous_flag)
+    assert shells.anomalous == anomalous_flag
 
     s_list, cc_list = [], []
-    for bin in i_obs.binner().range_used():
-      unmerged = i_obs.select(i_obs.binner().selection(bin))
-      try:
-        bin_stats = merging_statistics.merging_stats(unmerged,
-                                                     anomalous=anomalous_flag)
-        s_list.append(1./bin_stats.d_min**2)
-        cc_list.append(bin_stats.cc_one_half)
-      except RuntimeError: # complains that no reflections left after sigma-filtering.
-        continue
+    for d_min, cc in shells.all_shells(n_bins):
+      s_list.append(1./d_min**2)
+      cc_list.append(cc)
 
     d0, r = fit_curve_for_cchalf(s_list, cc_list, log_out)
     shells_and_fit = (s_list, cc_list, (d0, r))
@@ -127,9 +217,7 @@ class estimate_resolution_based_on_cc_half(object):
   # show_plot()
 
   def cc_outer_shell(self, d_min):
-    binner = self.i_obs.setup_binner(d_min=d_min, n_bins=self.n_bins)
-    bin_stats = merging_statistics.merging_stats(self.i_obs.select(binner.selection(binner.range_used()[-1])), anomalous=False)
-    return bin_stats.cc_one_half
+    return self.shells.outer_shell(d_min, self.n_bins)
   # cc_outer_shell()
 
   def estimate_resolution(self):
@@ -137,7 +225,10 @@ class estimate_resolution_based_on_cc_half(object):
       self.log_out.write("No reflections.\n")
       return None, None
 
-    d_min, self.shells_and_fit = initial_estimate_byfit_cchalf(self.i_obs, self.cc_half_min, self.anomalous_flag, self.log_out)
+    self.shells = cc_half_in_shells(self.i_obs) # anomalous=False for outer shell
+    initial_shells = self.shells if not self.anomalous_flag else None
+    d_min, self.shells_and_fit = initial_estimate_byfit_cchalf(self.i_obs, self.cc_half_min, self.anomalous_flag, self.log_out,
+                                                               shells=initial_shells)
     d_min = float("%.2f"%d_min)
     
     if d_min < self.d_min_data:
@@ -62,157 +62,215 @@ class ScanInfo(object):
 # class ScanInfo
 
 class BssDiffscanLog(object):
+    """
+    Parser of BSS diffscan.log.
+
+    The log is read incrementally: parse() only reads the bytes appended since the last call
+    and continues the scan being read, so calling it repeatedly on a growing log (as SHIKA does)
+    costs in proportion to the appended lines, not to the size of the log.
+    Everything is reread when the file was replaced or truncated, when the last read ended in the middle of a line,
+    or when scans were removed by remove_overwritten_scans().
+    """
+    re_scanstart = re.compile("Diffraction scan \(([0-9A-Za-z/:\[\] ]+)\)")
+    re_nums = re.compile("([0-9]+) +([\-0-9\.]+|dummy) +([\-0-9\.]+|dummy) +([\-0-9\.]+|dummy)")
+    re_point_step = re.compile("point: *([0-9]+) *step: *([0-9\.]+)")
+    re_osc = re.compile("Oscillation start: ([-0-9\.]+) \[deg\], step: ([-0-9\.]+) \[deg\]")
+    re_att = re.compile("Attenuator: +([^ ]+) +([0-9]+)um")
+    re_att2 = re.compile("Attenuator transmission: +([^ ]+) +\(([^ ]+) attenuator: ([0-9]+)\[um\]\)")
+    re_exp = re.compile("Exp\. time: ([\.0-9]+) ")
+    re_beam = re.compile("hor\. beam size: +([\.0-9]+)\[um\], ver\. beamsize: +([\.0-9]+)\[um\]") # old bss, wrong (need to swap h/v)
+    re_beam2 = re.compile("horizontal size: +([\.0-9]+)\[um\], vertical size: +([\.0-9]+)\[um\]") # new bss (2015-Apr), correct
+    re_fixed_spindle = re.compile("Fixed spindle angle: ([-0-9\.]+) \[deg\]")
+    re_frame_rate = re.compile("Frame rate: ([-0-9\.]+) \[frame/s\]")
+    # Every header line handled in parse_line() contains one of these; other lines can only be image lines.
+    re_header = re.compile("|".join([re.escape(x) for x in ("Diffraction scan (", "Oscillation start: ", "Exp. time: ",
+                                                             "hor. beam size:", "horizontal size:", "Fixed spindle angle: ",
+                                                             "Frame rate: ", "dummy image", "Dummy image", "Scan direction:",
+                                                             "Scan path:", "Wavelength: ", "Attenuator", "Cameralength: ",
+                                                             "FILE_NAME = ", "Vertical   scan", "Horizontal scan")]))
+
     def __init__(self, scanlog):
         self.scanlog = scanlog
-        self.parse()
+        self.reset()
+        self.parse(partial_line=True)
         #for scan in self.scans:
         #    print scan.date, scan.filename_template
     # __init__()
 
-    def parse(self):
-        re_scanstart = re.compile("Diffraction scan \(([0-9A-Za-z/:\[\] ]+)\)")
-        re_nums = re.compile("([0-9]+) +([\-0-9\.]+|dummy) +([\-0-9\.]+|dummy) +([\-0-9\.]+|dummy)")
-        re_point_step = re.compile("point: *([0-9]+) *step: *([0-9\.]+)")
-        re_osc = re.compile("Oscillation start: ([-0-9\.]+) \[deg\], step: ([-0-9\.]+) \[deg\]")
-        re_att = re.compile("Attenuator: +([^ ]+) +([0-9]+)um")
-        re_att2 = re.compile("Attenuator transmission: +([^ ]+) +\(([^ ]+) attenuator: ([0-9]+)\[um\]\)")
-        re_exp = re.compile("Exp\. time: ([\.0-9]+) ")
-        re_beam = re.compile("hor\. beam size: +([\.0-9]+)\[um\], ver\. beamsize: +([\.0-9]+)\[um\]") # old bss, wrong (need to swap h/v)
-        re_beam2 = re.compile("horizontal size: +([\.0-9]+)\[um\], vertical size: +([\.0-9]+)\[um\]") # new bss (2015-Apr), correct
-        re_fixed_spindle = re.compile("Fixed spindle angle: ([-0-9\.]+) \[deg\]")
-        re_frame_rate = re.compile("Frame rate: ([-0-9\.]+) \[frame/s\]")
-
+    def reset(self):
         self.scans = []
         self.filename_gonio_gc = OrderedDict()
+        self._file_id = None # (st_dev, st_ino) of the file read
+        self._offset = 0 # bytes already parsed
+        self._line_complete = True # False if the last parsed line did not end with newline
+    # reset()
 
-        for l in open(self.scanlog):
-            r_scanstart = re_scanstart.search(l)
-            if r_scanstart:
-                datestr = re.sub("\[[A-Za-z]+\] ", "", r_scanstart.group(1))
-                if datestr.count(":") == 3: datestr = datestr[:datestr.rindex(":")] # from bss jan29-2015, millisec time is recorded; but we discard it here.
-                date = datetime.datetime.strptime(datestr, "%Y/%m/%d %H:%M:%S")
-                self.scans.append(ScanInfo())
-                self.scans[-1].date = date
-                continue
-
-            r_osc = re_osc.search(l)
-            if r_osc:
-                self.scans[-1].osc_start = float(r_osc.group(1))
-                self.scans[-1].osc_step = float(r_osc.group(2))
-                continue
-
-            r_exp = re_exp.search(l)
-            if r_exp:
-                self.scans[-1].exp_time = float(r_exp.group(1))
-                continue
-
-            r_beam = re_beam.search(l)
-            if r_beam:
-                self.scans[-1].beam_hsize = float(r_beam.group(2))
-                self.scans[-1].beam_vsize = float(r_beam.group(1))
-                continue
-
-            r_beam2 = re_beam2.search(l)
-            if r_beam2:
-                self.scans[-1].beam_hsize = float(r_beam2.group(1))
-                self.scans[-1].beam_vsize = float(r_beam2.group(2))
-                continue
-
-            r_fspindle = re_fixed_spindle.search(l)
-            if r_fspindle:
-                self.scans[-1].fixed_spindle = float(r_fspindle.group(1))
-                continue
-
-            r_frate = re_frame_rate.search(l)
-            if r_frate:
-                self.scans[-1].frame_rate = float(r_frate.group(1))
-                continue
-
-            if "No dummy image generated in each scan" in l:
-                # this scan does not have dummy images.
-                self.scans[-1].has_extra_images = False
-                self.scans[-1].need_treatment_on_image_numbers = False
-                continue
-
-            if "Dummy images generated in each scan!" in l:
-                # this scan actually has dummy images but diffscan.log has "dummy" lines
-                self.scans[-1].has_extra_images = True
-                self.scans[-1].need_treatment_on_image_numbers = False
-                continue
-
-            if "Scan direction:" in l:
-                self.scans[-1].scan_direction = l[l.index(":")+1:].strip()
-                continue                
-
-            if "Scan path:" in l:
-                self.scans[-1].scan_path = l[l.index(":")+1:].strip()
-                continue
-
-            if "Wavelength: " in l:
-                self.scans[-1].wavelength = float(l.strip().split()[1])
-                continue
-
-            if "Attenuator" in l:
-                r_att = re_att.search(l)
-                r_att2 = re_att2.search(l)
-                if r_att:
-                    self.scans[-1].attenuator = (r_att.group(1), int(r_att.group(2)))
-                elif r_att2:
-                    self.scans[-1].attenuator = (r_att2.group(2), int(r_att2.group(3))) # (1) is transmisttance
-                continue
-
-            if "Cameralength: " in l:
-                self.scans[-1].distance = float(l.strip().split()[1])
-                continue
-
-            if "FILE_NAME = " in l:
-                self.scans[-1].filename_template =  os.path.basename(l[l.index("FILE_NAME = ")+12:].strip())
-
-                # VERY DIRTY FIX!
-                # Explanation: if diffscan.log contains ".h5", we assume it's Eiger hdf5 and hit-finding is done by streaming mode.
-                if self.scans[-1].filename_template.endswith(".h5"):
-                    self.scans[-1].filename_template = self.scans[-1].filename_template[:-3] + ".img"
-                continue
-
-            if "Vertical   scan" in l:
-                vpoint, vstep = re_point_step.search(l.strip()).groups()
-                self.scans[-1].vpoints, self.scans[-1].vstep = int(vpoint), float(vstep)
-                continue
-
-            if "Horizontal scan" in l:
-                hpoint, hstep = re_point_step.search(l.strip()).groups()
-                self.scans[-1].hpoints, self.scans[-1].hstep = int(hpoint), float(hstep)
-                continue
-
-            r = re_nums.search(l)
-            if r:
-                if "dummy" in r.groups():
-                    assert not self.scans[-1].need_treatment_on_image_numbers
-                    continue
-                else:
-                    gonio = tuple([float(x) for x in r.groups()[1:]])
-
-                num = int(r.group(1))
-                if self.scans[-1].need_treatment_on_image_numbers and self.scans[-1].is_shutterless() and self.scans[-1].hpoints > 1:
-                    # This if section is not needed *if* BSS no longer creates such non-sense files.
-                    # this should be an option.
-                    num += int(math.ceil(float(num)/self.scans[-1].hpoints)) - 1
-
-                filename = template_to_filenames(self.scans[-1].filename_template, num, num)[0]
-
-                grid_coord = self.get_grid_coord_internal(self.scans[-1].vpoints, self.scans[-1].vstep,
-                                                          self.scans[-1].hpoints, self.scans[-1].hstep,
-                                                          num, self.scans[-1].is_shutterless() and self.scans[-1].has_extra_images,
-                                                          self.scans[-1].scan_direction, self.scans[-1].scan_path)
-
-                # XXX Need to check if the filename is already registered (file is overwritten!!)
-                self.scans[-1].filename_coords.append((filename, (gonio, grid_coord)))
-                self.scans[-1].filename_idxes.append((filename, num))
-                if len(l.split())==5: # for SACLA
-                    self.scans[-1].filename_tags.append((filename, int(l.split()[-1])))
-                self.filename_gonio_gc[os.path.basename(filename)] = (gonio, grid_coord)
+    def parse(self, partial_line=False):
+        """
+        Read lines appended since the last call.
+        The last line not ending with newline (may be being written) is left for the next call,
+        unless partial_line=True; then it is parsed now and everything is reread next time.
+        """
+        st = os.stat(self.scanlog)
+        file_id = (st.st_dev, st.st_ino)
+        if file_id != self._file_id or st.st_size < self._offset or not self._line_complete:
+            self.reset()
+            self._file_id = file_id
+
+        if st.st_size == self._offset: return
+
+        with open(self.scanlog, "rb") as f:
+            f.seek(self._offset)
+            data = f.read()
+
+        if not partial_line:
+            data = data[:data.rfind(b"\n")+1]
+
+        self._offset += len(data)
+        self._line_complete = data.endswith(b"\n") or not data
+
+        for l in data.decode("utf-8", "replace").splitlines(True):
+            self.parse_line(l)
     # parse()
 
+    def parse_line(self, l):
+        if not self.re_header.search(l):
+            self.parse_image_line(l)
+            return
+
+        r_scanstart = self.re_scanstart.search(l)
+        if r_scanstart:
+            datestr = re.sub("\[[A-Za-z]+\] ", "", r_scanstart.group(1))
+            if datestr.count(":") == 3: datestr = datestr[:datestr.rindex(":")] # from bss jan29-2015, millisec time is recorded; but we discard it here.
+            date = datetime.datetime.strptime(datestr, "%Y/%m/%d %H:%M:%S")
+            self.scans.append(ScanInfo())
+            self.scans[-1].date = date
+            return
+
+        scan = self.scans[-1]
+        r_osc = self.re_osc.search(l)
+        if r_osc:
+            scan.osc_start = float(r_osc.group(1))
+            scan.osc_step = float(r_osc.group(2))
+            return
+
+        r_exp = self.re_exp.search(l)
+        if r_exp:
+            scan.exp_time = float(r_exp.group(1))
+            return
+
+        r_beam = self.re_beam.search(l)
+        if r_beam:
+            scan.beam_hsize = float(r_beam.group(2))
+            scan.beam_vsize = float(r_beam.group(1))
+            return
+
+        r_beam2 = self.re_beam2.search(l)
+        if r_beam2:
+            scan.beam_hsize = float(r_beam2.group(1))
+            scan.beam_vsize = float(r_beam2.group(2))
+            return
+
+        r_fspindle = self.re_fixed_spindle.search(l)
+        if r_fspindle:
+            scan.fixed_spindle = float(r_fspindle.group(1))
+            return
+
+        r_frate = self.re_frame_rate.search(l)
+        if r_frate:
+            scan.frame_rate = float(r_frate.group(1))
+            return
+
+        if "No dummy image generated in each scan" in l:
+            # this scan does not have dummy images.
+            scan.has_extra_images = False
+            scan.need_treatment_on_image_numbers = False
+            return
+
+        if "Dummy images generated in each scan!" in l:
+            # this scan actually has dummy images but diffscan.log has "dummy" lines
+            scan.has_extra_images = True
+            scan.need_treatment_on_image_numbers = False
+            return
+
+        if "Scan direction:" in l:
+            scan.scan_direction = l[l.index(":")+1:].strip()
+            return
+
+        if "Scan path:" in l:
+            scan.scan_path = l[l.index(":")+1:].strip()
+            return
+
+        if "Wavelength: " in l:
+            scan.wavelength = float(l.strip().split()[1])
+            return
+
+        if "Attenuator" in l:
+            r_att = self.re_att.search(l)
+            r_att2 = self.re_att2.search(l)
+            if r_att:
+                scan.attenuator = (r_att.group(1), int(r_att.group(2)))
+            elif r_att2:
+                scan.attenuator = (r_att2.group(2), int(r_att2.group(3))) # (1) is transmisttance
+            return
+
+        if "Cameralength: " in l:
+            scan.distance = float(l.strip().split()[1])
+            return
+
+        if "FILE_NAME = " in l:
+            scan.filename_template =  os.path.basename(l[l.index("FILE_NAME = ")+12:].strip())
+
+            # VERY DIRTY FIX!
+            # Explanation: if diffscan.log contains ".h5", we assume it's Eiger hdf5 and hit-finding is done by streaming mode.
+            if scan.filename_template.endswith(".h5"):
+                scan.filename_template = scan.filename_template[:-3] + ".img"
+            return
+
+        if "Vertical   scan" in l:
+            vpoint, vstep = self.re_point_step.search(l.strip()).groups()
+            scan.vpoints, scan.vstep = int(vpoint), float(vstep)
+            return
+
+        if "Horizontal scan" in l:
+            hpoint, hstep = self.re_point_step.search(l.strip()).groups()
+            scan.hpoints, scan.hstep = int(hpoint), float(hstep)
+            return
+
+        self.parse_image_line(l)
+    # parse_line()
+
+    def parse_image_line(self, l):
+        r = self.re_nums.search(l)
+        if r:
+            scan = self.scans[-1]
+            if "dummy" in r.groups():
+                assert not scan.need_treatment_on_image_numbers
+                return
+            else:
+                gonio = tuple([float(x) for x in r.groups()[1:]])
+
+            num = int(r.group(1))
+            if scan.need_treatment_on_image_numbers and scan.is_shutterless() and scan.hpoints > 1:
+                # This if section is not needed *if* BSS no longer creates such non-sense files.
+                # this should be an option.
+                num += int(math.ceil(float(num)/scan.hpoints)) - 1
+
+            filename = template_to_filenames(scan.filename_template, num, num)[0]
+
+            grid_coord = self.get_grid_coord_internal(scan.vpoints, scan.vstep,
+                                                      scan.hpoints, scan.hstep,
+                                                      num, scan.is_shutterless() and scan.has_extra_images,
+                                                      scan.scan_direction, scan.scan_path)
+
+            # XXX Need to check if the filename is already registered (file is overwritten!!)
+            scan.filename_coords.append((filename, (gonio, grid_coord)))
+            scan.filename_idxes.append((filename, num))
+            if len(l.split())==5: # for SACLA
+                scan.filename_tags.append((filename, int(l.split()[-1])))
+            self.filename_gonio_gc[os.path.basename(filename)] = (gonio, grid_coord)
+    # parse_image_line()
+
     def __getitem__(self, filename):
         for scan in reversed(self.scans):
             print(scan.filename_coords)
@@ -315,6 +373,8 @@ class BssDiffscanLog(object):
         rem_idxes = reduce(lambda x,y:x+y, rem_idxes) 
         for i in sorted(rem_idxes, reverse=True):
             del self.scans[i]
+
+        self._line_complete = False # removed scans may be continued in the log. Reread everything next time.
     # remove_overwritten_scan()
 # class BssDiffscanLog
 
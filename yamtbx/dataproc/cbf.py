@@ -6,10 +6,218 @@ This software is released under the new BSD License; see LICENSE.
 """
 from __future__ import absolute_import, division, print_function, generators
 import os
+import re
+import bz2
+import base64
+import hashlib
 import pycbf
 import numpy
 from cbflib_adaptbx import cbf_binary_adaptor, CBFWriteAdaptor
 
+CBF_BINARY_START = b"\x0c\x1a\x04\xd5"
+CBF_BINARY_SECTION = b"--CIF-BINARY-FORMAT-SECTION--"
+
+def byte_offset_decode(buf, nelements, dtype=numpy.int32):
+    """
+    Decode CBF byte_offset compressed data with numpy.
+    Only the escape markers (0x80) are walked in python loop; all other bytes are handled as arrays.
+    """
+    a = numpy.frombuffer(buf, dtype=numpy.uint8)
+    n = len(a)
+    a_pad = numpy.concatenate([a, numpy.zeros(16, dtype=numpy.uint8)]) # for reading beyond the end
+
+    def read_le(pos, nbytes): # little endian signed integers at arbitrary byte positions
+        v = numpy.zeros(len(pos), dtype=numpy.uint64)
+        for i in range(nbytes):
+            v |= a_pad[pos+i].astype(numpy.uint64) << numpy.uint64(8*i)
+        return v.view(numpy.int64) if nbytes == 8 else (v.astype(numpy.int64) ^ (1<<(8*nbytes-1))) - (1<<(8*nbytes-1))
+
+    # Token length assuming each 0x80 is an escape. 1+2, 1+2+4, or 1+2+4+8 bytes.
+    cand = numpy.nonzero(a == 0x80)[0]
+    v16 = read_le(cand+1, 2)
+    v32 = read_le(cand+3, 4)
+    v64 = read_le(cand+7, 8)
+    is32 = v16 == -0x8000
+    is64 = is32 & (v32 == -0x80000000)
+    tlen = numpy.where(is64, 15, numpy.where(is32, 7, 3))
+
+    # Drop 0x80 bytes which are a part of the preceding escaped value.
+    keep = numpy.zeros(len(cand), dtype=bool)
+    next_free = 0
+    for i, (p, l) in enumerate(zip(cand.tolist(), tlen.tolist())):
+        if p < next_free: continue
+        keep[i] = True
+        next_free = p + l
+
+    cand, tlen = cand[keep], tlen[keep]
+    esc_val = numpy.where(is64[keep], v64[keep], numpy.where(is32[keep], v32[keep], v16[keep]))
+
+    # Bytes belonging to escaped values are not tokens.
+    inside = numpy.zeros(n + 16, dtype=numpy.int32)
+    inside[cand+1] += 1 # positions are unique for non-overlapping escapes
+    inside[cand+tlen] -= 1
+    is_token = numpy.cumsum(inside[:n]) == 0
+
+    delta = a.view(numpy.int8)[is_token].astype(numpy.int64)
+    delta[numpy.cumsum(is_token)[cand] - 1] = esc_val
+    if len(delta) < nelements:
+        raise RuntimeError("byte_offset data too short: %d elements found, %d expected" % (len(delta), nelements))
+
+    return numpy.cumsum(delta[:nelements]).astype(dtype)
+# byte_offset_decode()
+
+def byte_offset_encode(data):
+    """
+    Encode integer array in CBF byte_offset compression with numpy. Returns bytes.
+    """
+    data = numpy.asarray(data)
+    d = data.astype(numpy.int64).ravel()
+    d[1:] -= d[:-1].copy()
+    if data.dtype.itemsize <= 4: # differences wrap around as 32-bit integers, as CBFlib does
+        d = (d + 0x80000000) % 0x100000000 - 0x80000000
+    # no abs() here; it overflows for -2**63. -0x80, -0x8000 and -0x80000000 are escape markers.
+    size = numpy.where((d > -0x80) & (d < 0x80), 1,
+                       numpy.where((d > -0x8000) & (d < 0x8000), 3,
+                                   numpy.where((d > -0x80000000) & (d < 0x80000000), 7, 15)))
+    pos = numpy.cumsum(size) - size
+    out = numpy.zeros(int(size.sum()), dtype=numpy.uint8)
+
+    def put_le(p, v, nbytes):
+        v = v.astype(numpy.uint64) if nbytes == 8 else v & ((1<<(8*nbytes))-1)
+        for i in range(nbytes):
+            out[p+i] = (v >> (8*i)) & 0xff
+
+    sel = size == 1
+    out[pos[sel]] = d[sel] & 0xff
+    sel = size > 1
+    out[pos[sel]] = 0x80
+    sel = size == 3
+    put_le(pos[sel]+1, d[sel], 2)
+    sel = size > 3
+    put_le(pos[sel]+1, numpy.full(sel.sum(), 0x8000, dtype=numpy.int64), 2)
+    sel = size == 7
+    put_le(pos[sel]+3, d[sel], 4)
+    sel = size == 15
+    put_le(pos[sel]+3, numpy.full(sel.sum(), 0x80000000, dtype=numpy.int64), 4)
+    put_le(pos[sel]+7, d[sel], 8)
+    return out.tobytes()
+# byte_offset_encode()
+
+def read_minicbf_header(filein, chunk_size=8192):
+    """
+    Read text part of minicbf (before the binary starts).
+    For .bz2 files, only the beginning is decompressed.
+    Returns (text, the rest of already-read data after the binary start).
+    If the binary section is not found, text is the whole file and the rest is b"".
+    """
+    dec = bz2.BZ2Decompressor() if filein.endswith(".bz2") else None
+
+    buf = b""
+    with open(filein, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk: break
+            if dec is not None:
+                chunk = dec.decompress(chunk) # data come out per bzip2 block (<= 900 kB)
+                if not chunk: continue
+            buf += chunk
+            idx = buf.find(CBF_BINARY_START, max(0, len(buf)-len(chunk)-len(CBF_BINARY_START)))
+            if idx >= 0:
+                return buf[:idx], buf[idx+len(CBF_BINARY_START):]
+    return buf, b""
+# read_minicbf_header()
+
+def parse_minicbf_binary_header(text):
+    """
+    Parse MIME header of binary section, e.g.
+    X-Binary-Size-Fastest-Dimension: 2463
+    Returns dict with lowercase keys.
+    """
+    ret = {}
+    idx = text.rfind(CBF_BINARY_SECTION)
+    if idx < 0: return ret
+    for l in text[idx+len(CBF_BINARY_SECTION):].decode("latin-1").splitlines():
+        if ":" not in l: continue
+        k, v = l.split(":", 1)
+        ret[k.strip().lower()] = v.strip()
+    r = re.search('conversions="([^"]*)"', text[idx:].decode("latin-1"))
+    if r: ret["conversions"] = r.group(1)
+    return ret
+# parse_minicbf_binary_header()
+
+def read_minicbf_fast(filein):
+    """
+    Read byte_offset-compressed minicbf with numpy only.
+    Returns (data, ndimfast, ndimmid, ndimslow, header_text).
+    Raises RuntimeError if the file is not supported or Content-MD5 does not match.
+    """
+    f = bz2.BZ2File(filein) if filein.endswith(".bz2") else open(filein, "rb")
+    with f:
+        data = f.read()
+    idx = data.find(CBF_BINARY_START)
+    if idx < 0: raise RuntimeError("binary section not found in %s" % filein)
+    text, binary = data[:idx], data[idx+len(CBF_BINARY_START):]
+    hdr = parse_minicbf_binary_header(text)
+    if hdr.get("conversions") != "x-CBF_BYTE_OFFSET":
+        raise RuntimeError("unsupported compression in %s: %s" % (filein, hdr.get("conversions")))
+
+    eltype = hdr.get("x-binary-element-type", '"signed 32-bit integer"').strip('"')
+    r = re.search("^(signed|unsigned) (8|16|32|64)-bit integer$", eltype)
+    if not r: raise RuntimeError("unsupported element type in %s: %s" % (filein, eltype))
+    dtype = numpy.dtype("%sint%s" % ("" if r.group(1) == "signed" else "u", r.group(2)))
+
+    nel = int(hdr["x-binary-number-of-elements"])
+    ndimfast = int(hdr.get("x-binary-size-fastest-dimension", nel))
+    ndimmid = int(hdr.get("x-binary-size-second-dimension", 1))
+    ndimslow = int(hdr.get("x-binary-size-third-dimension", 1))
+    size = int(hdr.get("x-binary-size", len(binary)))
+    if "content-md5" in hdr:
+        md5 = base64.b64encode(hashlib.md5(binary[:size]).digest()).decode()
+        if md5 != hdr["content-md5"]:
+            raise RuntimeError("Content-MD5 mismatch in %s: %s (expected %s)" % (filein, md5, hdr["content-md5"]))
+
+    arr = byte_offset_decode(binary[:size], nel, dtype)
+    return arr, ndimfast, ndimmid, ndimslow, text
+# read_minicbf_fast()
+
+def write_minicbf_fast(data, size1, size2, title, cbfout, pilatus_header=None, header_convention="PILATUS_1.2"):
+    """
+    Write byte_offset-compressed minicbf (same layout as pycbf with MIME_HEADERS|MSG_DIGEST|PAD_4K)
+    """
+    assert data.dtype.kind in "iu"
+    compressed = byte_offset_encode(data)
+    padding = 4095
+    elname = "%ssigned %d-bit integer" % ("" if data.dtype.kind == "i" else "un", data.dtype.itemsize*8)
+
+    out = [b"###CBF: VERSION 1.5, CBFlib v0.7.8 - SLS/DECTRIS PILATUS detectors\r\n\r\n"]
+    out.append(("data_%s\r\n\r\n" % title).encode("utf-8"))
+    if pilatus_header is not None:
+        out.append(('_array_data.header_convention "%s"\r\n' % header_convention).encode("utf-8"))
+        out.append(b"_array_data.header_contents\r\n;\r\n")
+        out.append(pilatus_header.strip("\r\n").replace("\r\n", "\n").replace("\n", "\r\n").encode("utf-8"))
+        out.append(b"\r\n;\r\n\r\n")
+    out.append(b"_array_data.data\r\n;\r\n")
+    out.append(CBF_BINARY_SECTION + b"\r\n")
+    out.append(b'Content-Type: application/octet-stream;\r\n     conversions="x-CBF_BYTE_OFFSET"\r\n')
+    out.append(b"Content-Transfer-Encoding: BINARY\r\n")
+    out.append(("X-Binary-Size: %d\r\n" % len(compressed)).encode("utf-8"))
+    out.append(b"X-Binary-ID: 1\r\n")
+    out.append(('X-Binary-Element-Type: "%s"\r\n' % elname).encode("utf-8"))
+    out.append(b"X-Binary-Element-Byte-Order: LITTLE_ENDIAN\r\n")
+    out.append(b"Content-MD5: " + base64.b64encode(hashlib.md5(compressed).digest()) + b"\r\n")
+    out.append(("X-Binary-Number-of-Elements: %d\r\n" % data.size).encode("utf-8"))
+    out.append(("X-Binary-Size-Fastest-Dimension: %d\r\n" % size1).encode("utf-8"))
+    out.append(("X-Binary-Size-Second-Dimension: %d\r\n" % size2).encode("utf-8"))
+    out.append(("X-Binary-Size-Padding: %d\r\n\r\n" % padding).encode("utf-8"))
+    out.append(CBF_BINARY_START)
+    out.append(compressed)
+    out.append(b"\x00" * padding)
+    out.append(b"\r\n" + CBF_BINARY_SECTION + b"--\r\n;\r\n\r\n")
+
+    with open(cbfout, "wb") as ofs:
+        ofs.write(b"".join(out))
+# write_minicbf_fast()
+
 def load_cbf_as_numpy(filein, quiet=True):
     assert os.path.isfile(filein)
     if not quiet:
@@ -25,6 +233,17 @@ def load_minicbf_as_numpy(filein, quiet=True): # This can also read XDS special
     assert os.path.isfile(filein)
     if not quiet:
         print("reading", filein, "as minicbf")
+
+    try:
+        arr, ndimfast, ndimmid, ndimslow, _ = read_minicbf_fast(filein)
+    except (RuntimeError, KeyError, ValueError) as e:
+        if not quiet: print(" numpy reader failed (%s). reading with pycbf" % e)
+    else:
+        assert arr.dtype.itemsize in (4, 8)
+        assert arr.dtype.kind == "i"
+        assert ndimslow <= 1
+        return arr, ndimfast, ndimmid
+
     h = pycbf.cbf_handle_struct()
     h.read_file(filein.encode("utf-8"), pycbf.MSG_DIGEST)
     h.require_category(b"array_data")
@@ -59,29 +278,7 @@ def load_xds_special(cbfin):
 # load_xds_special()
 
 def save_numpy_data_as_cbf(data, size1, size2, title, cbfout, pilatus_header=None, header_convention="PILATUS_1.2"):
-    h = pycbf.cbf_handle_struct()
-    h.new_datablock(title.encode("utf-8"))
-
-    h.require_category(b'array_data')
-
-    if pilatus_header is not None:
-        h.require_column(b'header_convention')
-        h.set_value(b'"%s"'%header_convention.encode("utf-8"))
-        h.require_column(b'header_contents')
-        h.set_value(pilatus_header.encode("utf-8"))
-
-
-    h.require_category(b'array_data')
-    h.require_column(b'data')
-
-    assert data.dtype.kind in "iu"
-    elsigned = 1 if data.dtype.kind == "i" else 0
-
-    h.set_integerarray_wdims_fs(pycbf.CBF_BYTE_OFFSET, 1, data.tostring(), data.dtype.itemsize,
-                                elsigned, len(data), b"little_endian",
-                                size1, size2, 1, 0)
-    h.write_file(cbfout.encode("utf-8"), pycbf.CBF,
-                 pycbf.MIME_HEADERS|pycbf.MSG_DIGEST|pycbf.PAD_4K, pycbf.ENC_NONE)
+    write_minicbf_fast(data, size1, size2, title, cbfout, pilatus_header, header_convention)
 # save_numpy_data_as_cbf()
 
 def save_flex_int_as_cbf(data, cbfout):
@@ -90,11 +287,16 @@ def save_flex_int_as_cbf(data, cbfout):
 # save_flex_int_as_cbf()
 
 def get_pilatus_header(cbfin):
+    # Only read (and bunzip2) until the binary section starts
+    text, _ = read_minicbf_header(cbfin)
+    r = re.search(br"_array_data\.header_contents\s*\n;(.*?)\r?\n;", text, re.DOTALL)
+    if r:
+        return r.group(1).replace(b"\r\n", b"\n").decode()
+
+    # Fallback for non-standard files
     h = pycbf.cbf_handle_struct()
     if cbfin.endswith(".bz2"):
-        # TODO to speed up, better only bunzip2 the first part of file..
         import tempfile
-        import bz2
         junk, tmpf = tempfile.mkstemp()
         os.close(junk)
         open(tmpf, "wb").write(bz2.BZ2File(cbfin).read())
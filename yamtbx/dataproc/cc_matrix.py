@@ -0,0 +1,122 @@
+"""
+(c) RIKEN 2015. All rights reserved.
+Author: Keitaro Yamashita
+
+This software is released under the new BSD License; see LICENSE.
+"""
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import multiprocessing
+import numpy
+from libtbx import easy_mp
+
+def miller_index_keys(indices):
+    """
+    Miller indices (flex.miller_index) to int64 keys, for numpy.unique etc.
+    """
+    hkl = indices.as_vec3_double().as_double().as_numpy_array().astype(numpy.int64).reshape(-1, 3) + 2**20
+    return (hkl[:,0] * 2**21 + hkl[:,1]) * 2**21 + hkl[:,2]
+# miller_index_keys()
+
+class CCMatrix(object):
+    """
+    Correlation coefficients and numbers of common reflections for all pairs of merged arrays,
+    equivalent to calc_cc() (linear correlation of common_sets) called for each pair.
+
+    Every array is mapped onto a common reflection index once. The values (standardized in each array, which
+    does not change correlation) are kept in a (n_arrays x n_reflections) matrix in shared memory with NaN for
+    missing reflections, and sums needed for CC on common reflections are obtained for blocks of arrays by
+    matrix products. Blocks are processed in parallel by forked processes reading the shared matrix.
+    Reflections observed in only one array are not stored.
+    """
+    def __init__(self, arrays, block_size=64):
+        self.n = len(arrays)
+        self.block_size = block_size
+
+        keys = [miller_index_keys(a.indices()) for a in arrays]
+        all_keys = numpy.concatenate(keys) if keys else numpy.zeros(0, dtype=numpy.int64)
+        uniq, inv, counts = numpy.unique(all_keys, return_inverse=True, return_counts=True)
+        col = numpy.cumsum(counts >= 2) - 1 # new column for common reflections
+        self.n_refl = int(numpy.sum(counts >= 2))
+
+        self.raw = multiprocessing.RawArray("d", self.n * self.n_refl)
+        mat = self.matrix()
+        mat[:] = numpy.nan
+
+        start = 0
+        for i, a in enumerate(arrays):
+            x = a.data().as_numpy_array()
+            if x.size > 0:
+                x = x - x.mean()
+                sd = x.std()
+                if sd > 0: x = x / sd
+            idx = inv[start:start+x.size]
+            start += x.size
+            sel = counts[idx] >= 2
+            mat[i, col[idx[sel]]] = x[sel]
+    # __init__()
+
+    def matrix(self):
+        return numpy.frombuffer(self.raw, dtype=numpy.float64).reshape(self.n, self.n_refl)
+    # matrix()
+
+    def calc_block(self, i0, i1, j0, j1):
+        """
+        Returns CC and number of common reflections between arrays i0..i1-1 and j0..j1-1.
+        As flex.linear_correlation, CC is nan if no common reflections, and 0 if either is constant.
+        """
+        mat = self.matrix()
+        xi, xj = mat[i0:i1], mat[j0:j1]
+        mi, mj = (~numpy.isnan(xi)).astype(numpy.float64), (~numpy.isnan(xj)).astype(numpy.float64)
+        xi, xj = numpy.where(mi > 0, xi, 0.), numpy.where(mj > 0, xj, 0.)
+
+        n = numpy.dot(mi, mj.T)
+        sx, sy = numpy.dot(xi, mj.T), numpy.dot(mi, xj.T)
+        sxx, syy = numpy.dot(xi**2, mj.T), numpy.dot(mi, (xj**2).T)
+        sxy = numpy.dot(xi, xj.T)
+
+        num = n*sxy - sx*sy
+        dx, dy = n*sxx - sx**2, n*syy - sy**2
+        dx[dx <= 1.e-12*n*sxx] = 0. # constant in common set
+        dy[dy <= 1.e-12*n*syy] = 0.
+        den = numpy.sqrt(dx*dy)
+
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            cc = numpy.where(den > 0, num/den, 0.)
+        cc[n == 0] = numpy.nan
+        return cc, n.astype(numpy.int64)
+    # calc_block()
+
+    def calc_all(self, nproc=1):
+        """
+        Returns CC matrix and number of common reflections matrix (n x n; lower triangle is the same as upper)
+        """
+        bs = self.block_size
+        blocks = [(i0, min(i0+bs, self.n), j0, min(j0+bs, self.n))
+                  for i0 in range(0, self.n, bs) for j0 in range(i0, self.n, bs)]
+
+        results = easy_mp.pool_map(fixed_func=lambda x: self.calc_block(*x),
+                                   args=blocks,
+                                   processes=nproc)
+
+        cc, nref = numpy.zeros((self.n, self.n)), numpy.zeros((self.n, self.n), dtype=numpy.int64)
+        for (i0, i1, j0, j1), (c, n) in zip(blocks, results):
+            cc[i0:i1, j0:j1], nref[i0:i1, j0:j1] = c, n
+            cc[j0:j1, i0:i1], nref[j0:j1, i0:i1] = c.T, n.T
+        return cc, nref
+    # calc_all()
+
+    def all_pairs(self, nproc=1):
+        """
+        Returns pairs [(i,j), ..] for i<j and results [(cc, nref), ..] in the same order as nested loops over i and j.
+        """
+        cc, nref = self.calc_all(nproc)
+        args, results = [], []
+        for i in range(self.n-1):
+            for j in range(i+1, self.n):
+                args.append((i,j))
+                results.append((float(cc[i,j]), int(nref[i,j])))
+        return args, results
+    # all_pairs()
+# class CCMatrix
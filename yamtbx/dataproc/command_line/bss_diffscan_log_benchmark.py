@@ -0,0 +1,124 @@
+#!/usr/bin/env yamtbx.python
+"""
+(c) RIKEN 2015. All rights reserved.
+Author: Keitaro Yamashita
+
+This software is released under the new BSD License; see LICENSE.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+"""
+bss_diffscan_log_benchmark.py : grow a synthetic BSS diffscan.log and time BssDiffscanLog.parse() after adding one scan
+at several log sizes (best of 3). The cost should stay constant as the log grows (incremental parsing).
+In the end, the incrementally updated object is checked to be the same as the one made by reading the whole log.
+
+Usage: yamtbx.python bss_diffscan_log_benchmark.py [max_mb=100] [step_mb=10] [npoints=2000]
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import hashlib
+import tempfile
+
+import iotbx.phil
+from yamtbx.dataproc.bl_logfiles import BssDiffscanLog
+
+master_params_str = """\
+max_mb = 100
+ .type = float
+ .help = "Final size of the log (MB)"
+step_mb = 10
+ .type = float
+ .help = "Time an update at every step_mb"
+npoints = 2000
+ .type = int(value_min=1)
+ .help = "Number of images in a scan"
+workdir = None
+ .type = path
+ .help = "Directory for the log. Default: system temporary directory"
+seed = 1234
+ .type = int
+"""
+
+def scan_text(i, npoints, rs):
+    hpoints = 50 if npoints >= 50 else npoints
+    s = ["Diffraction scan (2016/01/%.2d 12:%.2d:%.2d:123)" % (i%28+1, i%60, i%60),
+         "FILE_NAME = /data/scan%.4d_??????.h5" % i,
+         "Vertical   scan point: %d step: 10.0 [um]" % (npoints//hpoints),
+         "Horizontal scan point: %d step: 5.0 [um]" % hpoints,
+         "Oscillation start: 10.0 [deg], step: 0.1 [deg]",
+         "Exp. time: 0.02 [sec]",
+         "horizontal size: 10.0[um], vertical size: 5.0[um]",
+         "Fixed spindle angle: 0.0 [deg]",
+         "Frame rate: 50.0 [frame/s]",
+         "Wavelength: 1.0000 [A]",
+         "Attenuator: Al 100um",
+         "Cameralength: 300.0 [mm]",
+         "Scan direction: horizontal",
+         "Scan path: zig-zag",
+         "Dummy images generated in each scan!" if i%2 else "No dummy image generated in each scan"]
+    for n in range(1, npoints+1):
+        s.append("%6d  %.4f %.4f %.4f" % (n, rs.random(), rs.random(), rs.random()))
+    return "\n".join(s) + "\n"
+# scan_text()
+
+def scans_digest(bdl):
+    # digest instead of keeping two parsed logs of 100 MB in memory
+    h = hashlib.sha1()
+    for k, v in bdl.filename_gonio_gc.items(): h.update(repr((k, v)).encode())
+    for scan in bdl.scans: h.update(repr(sorted(scan.__dict__.items())).encode())
+    return len(bdl.scans), h.hexdigest()
+# scans_digest()
+
+def run(params, out=sys.stdout):
+    rs = random.Random(params.seed)
+    tmpdir = tempfile.mkdtemp(prefix="bss_diffscan_log_benchmark", dir=params.workdir)
+    scanlog = os.path.join(tmpdir, "diffscan.log")
+
+    try:
+        open(scanlog, "w").close()
+        bdl = BssDiffscanLog(scanlog)
+        i_scan = 0
+        next_mb = 1.
+        print("%9s %9s %16s" % ("size(MB)", "scans", "update time(s)"), file=out) # best of 3 updates adding a scan
+        with open(scanlog, "a") as ofs:
+            while os.path.getsize(scanlog) < params.max_mb * 1024**2:
+                ofs.write("".join([scan_text(i, params.npoints, rs) for i in range(i_scan, i_scan+10)]))
+                ofs.flush()
+                i_scan += 10
+                if os.path.getsize(scanlog) < next_mb * 1024**2: continue
+
+                next_mb += params.step_mb
+                bdl.parse() # catch up with what has been written (not timed)
+                times = []
+                for k in range(3):
+                    ofs.write(scan_text(i_scan, params.npoints, rs))
+                    ofs.flush()
+                    i_scan += 1
+                    t0 = time.time()
+                    bdl.parse()
+                    times.append(time.time() - t0)
+                print("%9.1f %9d %16.4f" % (os.path.getsize(scanlog)/1024.**2, len(bdl.scans), min(times)), file=out)
+
+        bdl.parse()
+        digest = scans_digest(bdl)
+        del bdl
+        t0 = time.time()
+        bdl_full = BssDiffscanLog(scanlog)
+        print("Reading the whole log (%.1f MB): %.2f s" % (os.path.getsize(scanlog)/1024.**2, time.time()-t0), file=out)
+        same = scans_digest(bdl_full) == digest
+        print("Incremental result same as whole read: %s" % ("yes" if same else "NO"), file=out)
+        return same
+    finally:
+        shutil.rmtree(tmpdir)
+# run()
+
+if __name__ == "__main__":
+    cmdline = iotbx.phil.process_command_line(args=sys.argv[1:],
+                                              master_string=master_params_str)
+    params = cmdline.work.extract()
+    if not run(params): sys.exit(1)
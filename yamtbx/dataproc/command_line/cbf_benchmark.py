@@ -0,0 +1,127 @@
+#!/usr/bin/env yamtbx.python
+"""
+(c) RIKEN 2015. All rights reserved.
+Author: Keitaro Yamashita
+
+This software is released under the new BSD License; see LICENSE.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+"""
+cbf_benchmark.py : time numpy byte_offset codec and minicbf reader/writer in yamtbx.dataproc.cbf
+on synthetic Pilatus-sized frames (6M and 16M pixels by default), and check that data survive the round trip.
+If pycbf can read the files, its reading time and result are also compared.
+
+Usage: yamtbx.python cbf_benchmark.py [frame_sizes=2463,2527,4150,4371] [repeat=3] [workdir=]
+"""
+
+import os
+import sys
+import bz2
+import time
+import shutil
+import tempfile
+import numpy
+
+import iotbx.phil
+from yamtbx.dataproc import cbf
+
+master_params_str = """\
+frame_sizes = 2463 2527 4150 4371
+ .type = ints
+ .help = "Pairs of fast and slow dimensions (default: Pilatus 6M and EIGER 16M)"
+repeat = 3
+ .type = int(value_min=1)
+ .help = "Number of runs. The shortest time is reported."
+workdir = None
+ .type = path
+ .help = "Directory for temporary files. Default: system temporary directory"
+seed = 1234
+ .type = int
+"""
+
+def make_frame(size1, size2, seed):
+    """
+    Poisson background with a few strong pixels, overloads (2**20-1), gaps (-1) and 32-bit extremes,
+    so that all escape lengths of byte_offset are used.
+    """
+    rs = numpy.random.RandomState(seed)
+    data = rs.poisson(3, size1*size2).astype(numpy.int32)
+    n = len(data)
+    data[rs.randint(0, n, n//1000)] = rs.randint(200, 30000, n//1000)
+    data[rs.randint(0, n, n//10000)] = 2**20-1
+    data.reshape(size2, size1)[::size2//10] = -1
+    data[:4] = [2**31-1, -2**31, 2**31-1, 0]
+    return data
+# make_frame()
+
+def best_time(func, repeat):
+    times = []
+    for i in range(repeat):
+        t0 = time.time()
+        ret = func()
+        times.append(time.time() - t0)
+    return min(times), ret
+# best_time()
+
+def read_with_pycbf(cbfin):
+    try:
+        import pycbf
+        h = pycbf.cbf_handle_struct()
+        h.read_file(cbfin.encode("utf-8"), pycbf.MSG_DIGEST)
+        h.require_category(b"array_data")
+        h.find_column(b"data")
+        return numpy.frombuffer(h.get_integerarray_as_string(), dtype=numpy.int32)
+    except Exception:
+        return None
+# read_with_pycbf()
+
+def run(params, out=sys.stdout):
+    assert len(params.frame_sizes) % 2 == 0
+    tmpdir = tempfile.mkdtemp(prefix="cbf_benchmark", dir=params.workdir)
+
+    try:
+        print("%-11s %8s %8s %8s %8s %8s %8s %8s" % ("frame", "MB", "encode", "decode", "write", "read",
+                                                    "hdr.bz2", "pycbf"), file=out)
+        for i in range(0, len(params.frame_sizes), 2):
+            size1, size2 = params.frame_sizes[i:i+2]
+            data = make_frame(size1, size2, params.seed)
+            cbfout = os.path.join(tmpdir, "test_%dx%d.cbf" % (size1, size2))
+
+            t_enc, enc = best_time(lambda: cbf.byte_offset_encode(data), params.repeat)
+            t_dec, dec = best_time(lambda: cbf.byte_offset_decode(enc, len(data)), params.repeat)
+            assert numpy.array_equal(dec, data), "byte_offset round trip failed"
+
+            t_write, _ = best_time(lambda: cbf.write_minicbf_fast(data, size1, size2, "test", cbfout,
+                                                                  pilatus_header="# Exposure_time 0.1 s"),
+                                   params.repeat)
+            t_read, ret = best_time(lambda: cbf.read_minicbf_fast(cbfout), params.repeat)
+            assert numpy.array_equal(ret[0], data), "minicbf round trip failed"
+            assert ret[1:4] == (size1, size2, 1)
+
+            with open(cbfout, "rb") as f: raw = f.read()
+            with open(cbfout+".bz2", "wb") as f: f.write(bz2.compress(raw))
+            t_hdr, hdr = best_time(lambda: cbf.get_pilatus_header(cbfout+".bz2"), params.repeat)
+            assert "Exposure_time" in hdr
+
+            t_pycbf, arr = best_time(lambda: read_with_pycbf(cbfout), params.repeat)
+            if arr is None: pycbf_str = "n/a"
+            else:
+                assert numpy.array_equal(arr, data), "pycbf read different data"
+                pycbf_str = "%8.3f" % t_pycbf
+
+            print("%-11s %8.1f %8.3f %8.3f %8.3f %8.3f %8.3f %8s" % ("%dx%d" % (size1, size2), len(raw)/1024.**2,
+                                                                   t_enc, t_dec, t_write, t_read, t_hdr, pycbf_str),
+                  file=out)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print("(times in sec; best of %d)" % params.repeat, file=out)
+# run()
+
+if __name__ == "__main__":
+    cmdline = iotbx.phil.process_command_line(args=sys.argv[1:],
+                                              master_string=master_params_str)
+    params = cmdline.work.extract()
+    run(params)
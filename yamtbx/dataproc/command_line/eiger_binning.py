@@ -1,11 +1,14 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 import iotbx.phil
-from libtbx import easy_mp
 from yamtbx.dataproc import eiger
 import h5py
 import numpy
 import os
+import time
+import itertools
+import threading
+import multiprocessing
 from functools import reduce
 master_params_str = """\
 bin = 4
@@ -16,14 +19,16 @@ dead_area_treatment = 0
  .help = "0: treat as zero, 1: treat as -inf"
 nproc = 1
  .type = int(value_min=1)
+memory_limit = 1024
+ .type = float(value_min=1)
+ .help = "Memory (MB) for data in each process. Frames are read and binned in blocks to fit this."
 """
 
-def software_binning(data, binning, dead_area_treatment):
-    assert dead_area_treatment in (0, 1)
-
+def crop_range(shape, binning):
+    # pixels not fitting in binning are discarded equally from both ends
     u = l = 0
     b = r = None
-    nframes, dimy, dimx = data.shape
+    dimy, dimx = shape[-2:]
     if dimy%binning > 0:
         res = dimy%binning
         u = res//2 # upper
@@ -33,6 +38,32 @@ def software_binning(data, binning, dead_area_treatment):
         l = res//2
         r = -(res - l)
 
+    return u, b, l, r
+# crop_range()
+
+def dead_area_mask(frame, binning):
+    # Number of dead (saturated-valued) pixels in each bin, judged from the given (first) frame
+    u, b, l, r = crop_range(frame.shape, binning)
+    frame = frame[u:b, l:r]
+    ny, nx = frame.shape[0]//binning, frame.shape[1]//binning
+    mask = numpy.zeros(ny*nx*binning*binning, dtype=numpy.uint16).reshape(ny*binning,nx*binning)
+    mask[frame==2**(frame.dtype.itemsize*8)-1] = 1
+    mask = mask.reshape(ny, binning, nx, -1).sum(3).sum(1).astype(numpy.uint16)
+    return mask
+# dead_area_mask()
+
+def software_binning(data, binning, dead_area_treatment, mask=None):
+    """
+    mask should be given by dead_area_mask() when data is a part of frames;
+    otherwise it is calculated from the first frame of data.
+    """
+    assert dead_area_treatment in (0, 1)
+
+    u, b, l, r = crop_range(data.shape, binning)
+    nframes, dimy, dimx = data.shape
+
+    if mask is None: mask = dead_area_mask(data[0], binning)
+
     newdata = data[:, u:b, l:r]
     
     # https://gist.github.com/derricw/95eab740e1b08b78c03f
@@ -40,10 +71,6 @@ def software_binning(data, binning, dead_area_treatment):
     compression_pairs = [(nframes, 1), (dimy//binning, binning), (dimx//binning, binning)]
     flattened = reduce(lambda x,y:x+y, compression_pairs)
 
-    mask = numpy.zeros(newshape[1]*newshape[2]*binning*binning, dtype=numpy.uint16).reshape(newshape[1]*binning,newshape[2]*binning)
-    mask[newdata[0,]==2**(newdata.dtype.itemsize*8)-1] = 1
-    mask = mask.reshape(newshape[1], binning, newshape[2], -1).sum(3).sum(1).astype(numpy.uint16)
-
     if dead_area_treatment == 0:
         newdata[newdata==2**(newdata.dtype.itemsize*8)-1] = 0
 
@@ -58,6 +85,18 @@ def software_binning(data, binning, dead_area_treatment):
     return newdata, u, l
 # software_binning()
 
+binning_worker_dict = {} # constants for worker processes; set before fork
+
+def binning_worker(task):
+    d = binning_worker_dict
+    k, i0, i1 = task
+    h5in = h5py.File(d["h5file"], "r")
+    data = h5in["/entry/data"][k][i0:i1]
+    h5in.close()
+    data, u, l = software_binning(data, d["bin"], d["dead_area_treatment"], d["masks"][k])
+    return data
+# binning_worker()
+
 def run(params, h5file):
     outfile = os.path.splitext(h5file)[0] + "_bin%d.h5" % params.bin
     h5 = h5py.File(h5file, "r")
@@ -69,23 +108,79 @@ def run(params, h5file):
     h5out.create_group("/entry/data")
     h5out["/entry/data"].attrs["NX_class"] = "NXdata"
 
-    def worker(k):
-        print("Converting %s" % k)
-        data = h5["/entry/data"][k][:]
-        data, u, l = software_binning(data, params.bin, params.dead_area_treatment)
-        dfile = os.path.splitext(h5["/entry/data"].get(k, getlink=True).filename)[0]+"_bin%d.h5"%params.bin
-        eiger.create_data_file(os.path.join(os.path.dirname(outfile), dfile),
-                               data, (1, data.shape[1], data.shape[2]),
-                               h5["/entry/data"][k].attrs["image_nr_low"],
-                               h5["/entry/data"][k].attrs["image_nr_high"])
-        return u, l
-    # worker()
-
-    map_res = easy_mp.pool_map(fixed_func=worker,
-                               args=list(h5["/entry/data"].keys()),
-                               processes=params.nproc)
-
-    f_xyconv = lambda x,y: ((x-map_res[0][0])/params.bin, (y-map_res[0][1])/params.bin)
+    data_keys = list(h5["/entry/data"].keys())
+    masks, shapes = {}, {}
+    for k in data_keys:
+        ds = h5["/entry/data"][k]
+        masks[k] = dead_area_mask(ds[0], params.bin)
+        shapes[k] = ds.shape
+
+    # Frames are processed in blocks to limit memory usage. Estimated memory per frame:
+    # input, its cropped copy when reshaped, boolean for dead pixels, and partially summed data.
+    nframes, dimy, dimx = shapes[data_keys[0]]
+    itemsize = h5["/entry/data"][data_keys[0]].dtype.itemsize
+    bytes_per_frame = dimy*dimx*(2*itemsize + 1 + 4./params.bin)
+    frames_per_block = max(1, int(params.memory_limit*1024**2/bytes_per_frame))
+    print("Processing %d frames in each block" % frames_per_block)
+
+    tasks = []
+    for k in data_keys:
+        for i in range(0, shapes[k][0], frames_per_block):
+            tasks.append((k, i, min(i+frames_per_block, shapes[k][0])))
+
+    def binned_blocks():
+        # Each block is a task for parallel processing, so small data files are also processed in parallel.
+        # Results are given in the order of tasks to be written sequentially. A task is given to the pool only
+        # while fewer than 2*nproc blocks are read ahead of writing, so that memory usage stays bounded.
+        global binning_worker_dict
+        binning_worker_dict = dict(h5file=h5file, bin=params.bin, dead_area_treatment=params.dead_area_treatment, masks=masks)
+
+        if params.nproc == 1:
+            for task in tasks:
+                yield task[0], (task[1], binning_worker(task))
+            binning_worker_dict = {}
+            return
+
+        ahead = threading.Semaphore(2*params.nproc)
+        def feed():
+            for task in tasks:
+                ahead.acquire()
+                yield task
+        # feed()
+
+        pool = multiprocessing.Pool(params.nproc)
+        try:
+            for (k, i0, i1), data in zip(tasks, pool.imap(binning_worker, feed())):
+                yield k, (i0, data)
+                ahead.release() # the block has been written
+            pool.close()
+        finally:
+            for i in range(len(tasks)): ahead.release() # not to leave the feeder blocked
+            pool.terminate()
+            pool.join()
+            binning_worker_dict = {}
+    # binned_blocks()
+
+    t_start = time.time()
+    n_frames_done = 0
+    blocks_iter = binned_blocks()
+    try:
+        for k, blocks in itertools.groupby(blocks_iter, key=lambda x: x[0]):
+            print("Converting %s" % k)
+            shape = (shapes[k][0],) + masks[k].shape
+            dfile = os.path.splitext(h5["/entry/data"].get(k, getlink=True).filename)[0]+"_bin%d.h5"%params.bin
+            eiger.create_data_file_from_blocks(os.path.join(os.path.dirname(outfile), dfile),
+                                               shape, numpy.uint32, (x[1] for x in blocks), (1, shape[1], shape[2]),
+                                               h5["/entry/data"][k].attrs["image_nr_low"],
+                                               h5["/entry/data"][k].attrs["image_nr_high"])
+            n_frames_done += shape[0]
+            eltime = time.time() - t_start
+            print(" %d frames done in %.1f sec (%.1f frames/s)" % (n_frames_done, eltime, n_frames_done/eltime))
+    finally:
+        blocks_iter.close() # terminates the pool also when writing failed
+
+    u, b, l, r = crop_range(shapes[data_keys[0]], params.bin)
+    f_xyconv = lambda x,y: ((x-u)/params.bin, (y-l)/params.bin)
 
     for k in h5["/entry/data"]:
         dfile = os.path.splitext(h5["/entry/data"].get(k, getlink=True).filename)[0]+"_bin%d.h5"%params.bin
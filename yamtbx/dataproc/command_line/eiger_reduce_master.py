@@ -4,14 +4,19 @@ Author: Keitaro Yamashita
 
 This software is released under the new BSD License; see LICENSE.
 """
+from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
 import iotbx.phil
+from libtbx import easy_mp
 import os
 import subprocess
 import tempfile
 import shutil
+import hashlib
+import time
+import traceback
 import h5py
 import bitshuffle.h5
 
@@ -37,8 +42,16 @@ remove_detectorModule_data = flatfield pixel_mask trimbit
 remove_overall = flatfield pixel_mask
  .type = choice(multi=True)
  .help = "Optionally remove flatfield and pixel_mask data in /entry/instrument/detector/detectorSpecific/. NOTE they (especially pixel_mask) may be necessary data."
+skip_reduced = True
+ .type = bool
+ .help = "Skip files already reduced with the same parameters. Checksum of the original file and parameters are recorded in the output file."
+nproc = 1
+ .type = int(value_min=1)
+ .help = "Number of files processed concurrently when multiple files are given"
 """
 
+FINGERPRINT_ATTR = "yamtbx_reduce_master"
+
 class ReduceMaster(object):
     def __init__(self, h5in):
         self.h = h5py.File(h5in, "a")
@@ -104,32 +117,96 @@ class ReduceMaster(object):
     def close(self): self.h.close()
 # class ReduceMaster
 
-def run(params):
-    print("Parameters:")
-    iotbx.phil.parse(master_params_str).format(params).show(prefix="  ")
-    print()
-
-    master_size_org = os.path.getsize(params.h5in)
-
-    if params.replace:
-        shutil.copyfile(params.h5in, params.h5in+".org")
-        params.h5out = params.h5in
-
-    tmpfd, tmpout = tempfile.mkstemp(prefix=os.path.basename(params.h5out)+".tmp", dir=os.path.dirname(params.h5out))
-    os.close(tmpfd)
+def reduce_params_str(params):
+    return "remove_filters_first=%s compress=%s remove_detectorModule_data=%s remove_overall=%s" % (params.remove_filters_first, params.compress,
+                                                                                                   "+".join(params.remove_detectorModule_data),
+                                                                                                   "+".join(params.remove_overall))
+# reduce_params_str()
+
+def file_fingerprint(h5file, params):
+    # checksum of file content and parameters
+    h = hashlib.sha1()
+    with open(h5file, "rb") as f:
+        while True:
+            buf = f.read(1024**2)
+            if not buf: break
+            h.update(buf)
+
+    h.update(reduce_params_str(params).encode("utf-8"))
+    return h.hexdigest()
+# file_fingerprint()
+
+def read_fingerprint(h5file):
+    # returns None if h5file does not exist or was not written by this script
+    if not os.path.isfile(h5file): return None
+    try:
+        h = h5py.File(h5file, "r")
+        ret = h.attrs.get(FINGERPRINT_ATTR)
+        h.close()
+    except (IOError, OSError):
+        return None
 
-    if params.remove_filters_first:
-        try:
-            p = subprocess.Popen(["h5repack","-f","NONE",params.h5in,tmpout], shell=False)
-            p.wait()
-        except OSError:
-            print("h5repack failed. Is h5repack installed?")
-            return
-    else:
-        shutil.copyfile(params.h5in, tmpout)
+    if isinstance(ret, bytes): ret = ret.decode("utf-8")
+    return ret
+# read_fingerprint()
 
+def h5repack(args):
     try:
-        redmas = ReduceMaster(tmpout)
+        p = subprocess.Popen(["h5repack"]+args, shell=False)
+        p.wait()
+    except OSError:
+        print("h5repack failed. Is h5repack installed?")
+        return False
+
+    if p.returncode != 0:
+        print("h5repack failed with %s" % " ".join(args))
+        return False
+
+    return True
+# h5repack()
+
+def reduce_master(h5in, h5out, params):
+    """
+    h5out is written via temporary files and renamed at the end, so h5out is never left incomplete.
+    If h5in == h5out, original file is kept as h5in.org.
+    Returns dict of h5in, h5out, size_org, size_after, and status (done, skipped, or failed).
+    """
+    replace = os.path.abspath(h5in) == os.path.abspath(h5out)
+    ret = dict(h5in=h5in, h5out=h5out, size_org=os.path.getsize(h5in), size_after=0, status="skipped")
+
+    src = h5in
+    if replace and os.path.isfile(h5in+".org") and read_fingerprint(h5in) is not None:
+        # h5in was already replaced with reduced file. Use the original.
+        src = h5in+".org"
+        ret["size_org"] = os.path.getsize(src)
+    elif not replace and params.skip_reduced and read_fingerprint(h5in) is not None:
+        print("Skipping %s (reduced file)" % h5in)
+        return ret
+
+    fingerprint = file_fingerprint(src, params)
+    if params.skip_reduced and read_fingerprint(h5out) == fingerprint:
+        print("Skipping %s (already reduced with the same parameters: %s)" % (h5in, h5out))
+        ret["size_after"] = os.path.getsize(h5out)
+        return ret
+
+    if replace and src == h5in:
+        shutil.copyfile(h5in, h5in+".org.tmp")
+        os.rename(h5in+".org.tmp", h5in+".org")
+
+    tmpouts = []
+    for i in range(2):
+        tmpfd, tmpout = tempfile.mkstemp(prefix=os.path.basename(h5out)+".tmp", dir=os.path.dirname(os.path.abspath(h5out)))
+        os.close(tmpfd)
+        tmpouts.append(tmpout)
+
+    ret["status"] = "failed"
+    try:
+        if params.remove_filters_first:
+            if not h5repack(["-f","NONE",src,tmpouts[0]]): return ret
+        else:
+            shutil.copyfile(src, tmpouts[0])
+
+        redmas = ReduceMaster(tmpouts[0])
 
         if params.remove_detectorModule_data:
             redmas.remove_redundant(params.remove_detectorModule_data)
@@ -140,25 +217,73 @@ def run(params):
         if params.compress:
             redmas.compress_large_datasets(params.compress)
 
+        redmas.h.attrs[FINGERPRINT_ATTR] = fingerprint
         redmas.close()
         
         # Run h5repack to clean up the removed space
-        try:
-            p = subprocess.Popen(["h5repack",tmpout,params.h5out], shell=False)
-            p.wait()
-        except OSError:
-            print("h5repack failed. Is h5repack installed?")
+        if not h5repack([tmpouts[0],tmpouts[1]]): return ret
+        os.rename(tmpouts[1], h5out)
     finally:
-        os.remove(tmpout)
+        for f in tmpouts:
+            if os.path.isfile(f): os.remove(f)
 
-    master_size_after = os.path.getsize(params.h5out)
+    ret["status"] = "done"
+    ret["size_after"] = os.path.getsize(h5out)
+    return ret
+# reduce_master()
+
+def run(params):
+    print("Parameters:")
+    iotbx.phil.parse(master_params_str).format(params).show(prefix="  ")
+    print()
+
+    if params.replace:
+        params.h5out = params.h5in
+
+    ret = reduce_master(params.h5in, params.h5out, params)
+    if ret["status"] != "done": return
 
     print()
     print("Finished.")
-    print("  Original file: %s (%.2f MB)" % (params.h5in, master_size_org/1024**2))
-    print(" Generated file: %s (%.2f MB)" % (params.h5out, master_size_after/1024**2))
+    print("  Original file: %s (%.2f MB)" % (params.h5in, ret["size_org"]/1024**2))
+    print(" Generated file: %s (%.2f MB)" % (params.h5out, ret["size_after"]/1024**2))
 # run()
 
+def run_batch(params, h5files):
+    print("Parameters:")
+    iotbx.phil.parse(master_params_str).format(params).show(prefix="  ")
+    print()
+
+    def work(h5in):
+        h5out = h5in if params.replace else os.path.splitext(h5in)[0] + "_reduce.h5"
+        try:
+            return reduce_master(h5in, h5out, params)
+        except:
+            print("Error in processing %s" % h5in)
+            print(traceback.format_exc())
+            return dict(h5in=h5in, h5out=h5out, size_org=0, size_after=0, status="failed")
+    # work()
+
+    t_start = time.time()
+    results = easy_mp.pool_map(fixed_func=work, args=h5files, processes=params.nproc)
+    eltime = time.time() - t_start
+
+    done = [x for x in results if x["status"] == "done"]
+    size_org = sum([x["size_org"] for x in done])/1024**2
+    size_after = sum([x["size_after"] for x in done])/1024**2
+
+    print()
+    print("Finished.")
+    for x in results:
+        print(" %7s %s (%.2f MB -> %.2f MB)" % (x["status"], x["h5out"], x["size_org"]/1024**2, x["size_after"]/1024**2))
+    print()
+    print(" %d files reduced, %d skipped, %d failed in %.1f sec with nproc=%d" % (len(done),
+                                                                                 len([x for x in results if x["status"] == "skipped"]),
+                                                                                 len([x for x in results if x["status"] == "failed"]),
+                                                                                 eltime, params.nproc))
+    print(" %.2f MB -> %.2f MB (%.2f files/s, %.2f MB/s)" % (size_org, size_after, len(done)/eltime, size_org/eltime))
+# run_batch()
+
 def print_help(command_name):
     print("""\
 This script (re)modifies master.h5 file of EIGER detectors written by DECTRIS software.
@@ -173,6 +298,9 @@ You need h5repack program. You also need phenix-1.11 or later if you use phenix.
 * Usage:
 %(command_name)s yours_master.h5 [h5out=yours_master_reduced.h5] [remove_filters_first=True] [compress=bslz4_and_gzipshuf] [remove_detectorModule_data=flatfield+pixel_mask+trimbit]
 
+* Multiple files can be processed at once (output is *_reduce.h5 unless replace=true). Files already reduced are skipped:
+%(command_name)s /data/*/*_master.h5 nproc=8
+
 * In case you're BL32XU user, collected data before 2017, and want to use Neggia plugin for XDS (and reduce file size anyway):
 mv yours_master.h5 yours_master.h5.org
 %(command_name)s yours_master.h5.org h5out=yours_master.h5 compress=bslz4 remove_detectorModule_data=flatfield+pixel_mask+trimbit
@@ -192,18 +320,28 @@ def run_from_args(argv, command_name="phenix.python this-script"):
     params = cmdline.work.extract()
     args = cmdline.remaining_args
 
+    h5files = [params.h5in] if params.h5in else []
     for arg in args:
         if not os.path.isfile(arg):
             print("File not found: %s" % arg)
             return
 
-        if params.h5in is None and arg.endswith(".h5"):
-            params.h5in = arg
+        if arg.endswith(".h5") and arg not in h5files:
+            h5files.append(arg)
 
-    if params.h5in is None:
+    if not h5files:
         print("Please give _master.h5 file.")
         return
 
+    if len(h5files) > 1:
+        if params.h5out is not None:
+            print("h5out= cannot be used with multiple files.")
+            return
+        run_batch(params, h5files)
+        return
+
+    params.h5in = h5files[0]
+
     if params.h5out is None:
         params.h5out = os.path.splitext(params.h5in)[0] + "_reduce.h5"
 
@@ -1,8 +1,11 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 import os
+import sys
+import time
 import pickle
 import math
+import multiprocessing
 from yamtbx.dataproc import crystfel
 import iotbx.phil
 import iotbx.file_reader
@@ -39,6 +42,10 @@ hklref_label = None
 d_min = None
  .type = float
 
+nproc = 1
+ .type = int
+ .help = "Number of processors. If >1, the stream is split into blocks at chunk boundaries, which are processed in parallel."
+
 stats = *reslimit *ioversigma *resnatsnr1 *pr *wilsonb *abdist ccref
  .type = choice(multi=True)
  .help = "statistics. reslimit: diffraction_resolution_limit reported by CrystFEL; ioversigma: <I/sigma(I)> in each pattern; resnatsnr1: resolution where <I/sigma(I)>_bin drops below 1; pr: profile_radius reported by CrystFEL; wilsonb: ML-estimate of Wilson B value; abdist: Andrews-Bernstein distance (unit cell dissimilarity)"
@@ -116,96 +123,163 @@ def set_chunk_stats(chunk, stats, stat_choice, n_residues=None, ref_cell=None, s
         stats["wilsonb"].append(float("nan"))
 # set_chunk_stats()
 
-def run(params):
-    import sys
-
-    if params.pklout is None: params.pklout = os.path.basename(params.streamin)+".pkl"
-    if params.datout is None: params.datout = os.path.basename(params.streamin)+".dat"
-
-    ifs = open(params.streamin)
-    ofs_dat = open(params.datout, "w")
+stat_keys = ("reslimit", "ioversigma", "resnatsnr1", "abdist", "pr", "wilsonb", "ccref")
 
-    ref_data = None
-    if params.hklref:
-        server = iotbx.file_reader.any_file(params.hklref, force_type="hkl").file_server
-        ref_data = server.get_xray_data(file_name=None,
-                                        labels=params.hklref_label,
-                                        ignore_all_zeros=True,
-                                        parameter_scope="",
-                                        prefer_anomalous=False,
-                                        prefer_amplitudes=False)
-        ofs_dat.write("#reference data: %s %s\n" % (params.hklref, ref_data.info().label_string()))
-        ref_data = ref_data.as_intensity_array()
+def process_range(streamin, start, end, params, ref_data, ofs_dat=None, show_progress=False):
+    """
+    Calculate statistics of indexed chunks whose "Begin chunk" line starts in [start, end) bytes of streamin.
+    The last chunk is read beyond end until it is closed. end=None means the end of file.
+    Returns chunk_ranges, stats and lines for dat file (written to ofs_dat instead, if given).
+    """
+    chunk_ranges = []
+    stats = dict([(k, []) for k in stat_keys])
+    dat_lines = []
 
-    ofs_dat.write("#d_min= %s\n" % params.d_min)
-    ofs_dat.write("#ref_cell= %s space_group= %s n_residues= %s\n" % (params.ref_cell, params.space_group, params.n_residues))
-    ofs_dat.write("file event indexed_by reslimit ioversigma resnatsnr1 pr wilsonb abdist ccref a b c al be ga\n")
+    ifs = open(streamin, "rb")
+    pos = 0
+    if start > 0:
+        # skip to the beginning of the first line starting at or after start
+        ifs.seek(start-1)
+        pos = start-1 + len(ifs.readline())
 
-    tell_p, tell_c = 0, 0
     read_flag = False
     chunk = None
-
-    chunk_ranges = []
-    stats = dict(reslimit=[],
-                 ioversigma=[],
-                 resnatsnr1=[],
-                 abdist=[],
-                 pr=[],
-                 wilsonb=[],
-                 ccref=[],
-                 )
+    t_start = time.time()
 
     while True:
         l = ifs.readline()
-        if l == "": break
-        tell_p, tell_c = tell_c, ifs.tell()
+        if l == b"": break
+        line_start = pos
+        pos += len(l)
 
-        if "----- Begin chunk -----" in l:
+        is_begin = b"----- Begin chunk -----" in l
+        if end is not None and line_start >= end and (is_begin or not read_flag):
+            break # rest is for next block
+
+        if is_begin:
             if read_flag: del chunk_ranges[-1] # in case chunk is not properly closed
             read_flag = True
             chunk = crystfel.stream.Chunk()
-            chunk_ranges.append([tell_p+1,0])
-        elif read_flag and "----- End chunk -----" in l:
+            chunk_ranges.append([line_start+1,0])
+        elif read_flag and b"----- End chunk -----" in l:
             read_flag = False
             if chunk.indexed_by is not None:
-                chunk_ranges[-1][1] = tell_c
-                sys.stdout.write("%.6d processed\r" % len(chunk_ranges))
+                chunk_ranges[-1][1] = pos
+                if show_progress:
+                    sys.stdout.write("%.6d processed (%.1f chunks/sec)\r" % (len(chunk_ranges), len(chunk_ranges)/(time.time()-t_start)))
                 set_chunk_stats(chunk, stats, params.stats,
                                 n_residues=params.n_residues,
                                 ref_cell=params.ref_cell,
                                 space_group=params.space_group,
                                 d_min=params.d_min,
                                 ref_data=ref_data)
-                ofs_dat.write("%s %s %s %.3f %.3f %.3f %.3e %.3f %.3f %.5f "%(chunk.filename, chunk.event, chunk.indexed_by, chunk.res_lim, 
-                                                                              stats["ioversigma"][-1], stats["resnatsnr1"][-1], stats["pr"][-1], stats["wilsonb"][-1], stats["abdist"][-1],
-                                                                              stats["ccref"][-1]))
-                ofs_dat.write("%.3f %.3f %.3f %.2f %.2f %.2f\n" % chunk.cell)
-                #ofs_dat.flush()
+                dat_line = "%s %s %s %.3f %.3f %.3f %.3e %.3f %.3f %.5f "%(chunk.filename, chunk.event, chunk.indexed_by, chunk.res_lim, 
+                                                                           stats["ioversigma"][-1], stats["resnatsnr1"][-1], stats["pr"][-1], stats["wilsonb"][-1], stats["abdist"][-1],
+                                                                           stats["ccref"][-1])
+                dat_line += "%.3f %.3f %.3f %.2f %.2f %.2f\n" % chunk.cell
+                if ofs_dat is not None: ofs_dat.write(dat_line)
+                else: dat_lines.append(dat_line)
             else:
                 del chunk_ranges[-1]
 
         elif read_flag:
-            try: chunk.parse_line(l)
+            try: chunk.parse_line(l.decode())
             except:
                 print("\nError in reading line: '%s'" % l)
                 read_flag = False
                 
     if read_flag: #  Unfinished chunk
-        print("\nWarning: unclosed chunk.")
+        if end is None: print("\nWarning: unclosed chunk.")
         del chunk_ranges[-1]
-    
+
+    return chunk_ranges, stats, dat_lines
+# process_range()
+
+process_range_worker_dict = {} # constants for worker processes; set before fork
+
+def process_range_worker(se):
+    d = process_range_worker_dict
+    return process_range(d["streamin"], se[0], se[1], d["params"], d["ref_data"])
+# process_range_worker()
+
+def run_parallel(params, ref_data, ofs_dat):
+    """
+    Split the stream into blocks (several times more than nproc, for load balancing) and process them in parallel.
+    Results are collected in the original order of chunks.
+    """
+    global process_range_worker_dict
+
+    fsize = os.path.getsize(params.streamin)
+    nblocks = params.nproc * 8
+    blocks = [(fsize*i//nblocks, fsize*(i+1)//nblocks) for i in range(nblocks)]
+    blocks[-1] = (blocks[-1][0], None)
+
+    chunk_ranges = []
+    stats = dict([(k, []) for k in stat_keys])
+    t_start = time.time()
+
+    process_range_worker_dict = dict(streamin=params.streamin, params=params, ref_data=ref_data)
+    pool = multiprocessing.Pool(params.nproc)
+    try:
+        for i, (cr, st, dat_lines) in enumerate(pool.imap(process_range_worker, blocks)):
+            chunk_ranges.extend(cr)
+            for k in stat_keys: stats[k].extend(st[k])
+            ofs_dat.write("".join(dat_lines))
+            t = time.time() - t_start
+            done = (blocks[i][1] if blocks[i][1] is not None else fsize) / 1024.**2
+            sys.stdout.write("%d/%d blocks; %.6d processed (%.1f chunks/sec, %.1f MB/sec)\r" % (i+1, nblocks, len(chunk_ranges),
+                                                                                                   len(chunk_ranges)/t, done/t))
+            sys.stdout.flush()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        process_range_worker_dict = {}
+
+    return chunk_ranges, stats
+# run_parallel()
+
+def run(params):
+    if params.pklout is None: params.pklout = os.path.basename(params.streamin)+".pkl"
+    if params.datout is None: params.datout = os.path.basename(params.streamin)+".dat"
+
+    ofs_dat = open(params.datout, "w")
+
+    ref_data = None
+    if params.hklref:
+        server = iotbx.file_reader.any_file(params.hklref, force_type="hkl").file_server
+        ref_data = server.get_xray_data(file_name=None,
+                                        labels=params.hklref_label,
+                                        ignore_all_zeros=True,
+                                        parameter_scope="",
+                                        prefer_anomalous=False,
+                                        prefer_amplitudes=False)
+        ofs_dat.write("#reference data: %s %s\n" % (params.hklref, ref_data.info().label_string()))
+        ref_data = ref_data.as_intensity_array()
+
+    ofs_dat.write("#d_min= %s\n" % params.d_min)
+    ofs_dat.write("#ref_cell= %s space_group= %s n_residues= %s\n" % (params.ref_cell, params.space_group, params.n_residues))
+    ofs_dat.write("file event indexed_by reslimit ioversigma resnatsnr1 pr wilsonb abdist ccref a b c al be ga\n")
+
+    t_start = time.time()
+    if params.nproc > 1:
+        chunk_ranges, stats = run_parallel(params, ref_data, ofs_dat)
+    else:
+        chunk_ranges, stats, _ = process_range(params.streamin, 0, None, params, ref_data,
+                                               ofs_dat=ofs_dat, show_progress=True)
+
+    ofs_dat.close()
     stats["chunk_ranges"] = chunk_ranges
     pickle.dump(stats, open(params.pklout,"wb"), -1)
 
     print()
+    print("%d indexed chunks processed in %.1f sec using %d cores." % (len(chunk_ranges), time.time()-t_start, params.nproc))
     print()
     print("Use sort_stream.py %s %s ioversigma-"%(params.streamin, params.pklout))
     print("The suffix -: sort by descending order +: sort by ascending order")
 # run()
 
 if __name__ == "__main__":
-    import sys
-
     if "-h" in sys.argv[1:] or "--help" in sys.argv[1:]:
         print("All parameters:\n")
         iotbx.phil.parse(master_params_str).show(prefix="  ", attributes_level=1)
@@ -2,34 +2,170 @@ from __future__ import print_function
 from __future__ import unicode_literals
 import pickle
 import os
+import sys
+import time
+import heapq
+import shutil
+import tempfile
+from yamtbx import util
 
-def run(streamin, pklin, key, stop_after=None, streamout=None):
-    if streamout is None:
-        streamout = os.path.splitext(os.path.basename(streamin))[0] + "_sort_%s.stream" % key
+class SortedChunkWriter(object):
+    """
+    Write chunks given in arbitrary order to streamout in order of rank, using bounded memory.
+    Chunks are kept in memory until flush_run() is called; then they are sorted and written to a temporary
+    file (run). At finish(), runs are merged reading each of them sequentially.
+    If everything fits in memory, no temporary file is made.
+    """
+    def __init__(self, streamout, header, tmpdir_func):
+        self.streamout = streamout
+        self.header = header
+        self.tmpdir_func = tmpdir_func # called when a temporary directory is needed for the first time
+        self.buffer = [] # [(rank, data), ..]
+        self.nbytes = 0 # in buffer
+        self.runs = [] # [(filename, [(rank, length), ..]), ..]
+        self.n_written = 0
+        self.n_runs = 0
+    # __init__()
+
+    def add(self, rank, data):
+        self.buffer.append((rank, data))
+        self.nbytes += len(data)
+    # add()
+
+    def flush_run(self):
+        if not self.buffer: return
+        self.buffer.sort(key=lambda x: x[0])
+        runfile = os.path.join(self.tmpdir_func(), "run_%s_%.4d" % (os.path.basename(self.streamout), len(self.runs)))
+        with open(runfile, "wb") as ofs:
+            for rank, data in self.buffer: ofs.write(data)
+
+        self.runs.append((runfile, [(rank, len(data)) for rank, data in self.buffer]))
+        self.buffer, self.nbytes = [], 0
+    # flush_run()
+
+    def finish(self, read_buffer_size):
+        ofs = open(self.streamout+".tmp", "wb")
+        ofs.write(self.header)
+
+        if not self.runs:
+            self.buffer.sort(key=lambda x: x[0])
+            for rank, data in self.buffer: ofs.write(data)
+            self.n_written = len(self.buffer)
+        else:
+            self.flush_run()
+            self.n_runs = len(self.runs)
+            bufsize = max(1024**2, read_buffer_size//len(self.runs))
+            ifs_runs = [open(f, "rb", bufsize) for f, _ in self.runs]
+            iters = [[(rank, i, length) for rank, length in idx] for i, (_, idx) in enumerate(self.runs)]
+            for rank, i, length in heapq.merge(*iters):
+                ofs.write(ifs_runs[i].read(length))
+                self.n_written += 1
+            for f in ifs_runs: f.close()
+            for f, _ in self.runs: os.remove(f)
+
+        self.buffer, self.nbytes, self.runs = [], 0, []
+        ofs.close()
+        os.rename(self.streamout+".tmp", self.streamout)
+    # finish()
+# class SortedChunkWriter
+
+def parse_key(key):
+    """
+    key: name+ (increasing order) or name- (decreasing order), optionally followed by :N (write only first N chunks).
+    Returns name, reverse_order, N
+    """
+    stop_after = None
+    if ":" in key:
+        key, stop_after = key.split(":")
+        stop_after = int(stop_after)
 
     assert key[-1] in ("+","-") # + for increasing order, - for decreasing order
-    rev_order = key[-1] == "-"
-    key = key[:-1]
+    return key[:-1], key[-1] == "-", stop_after
+# parse_key()
+
+def run(streamin, pklin, key, stop_after=None, streamout=None, max_memory_mb=1024, buffer_mb=64):
+    """
+    Write chunks of streamin in order of key. key can be a list to write several sorted streams
+    (streamout should then be None) in one pass over streamin.
+    The input is read sequentially in file order; chunks are reordered in memory (up to max_memory_mb in total),
+    and the rest are merged via temporary files.
+    """
+    keys = [key] if not isinstance(key, (list, tuple)) else key
+    assert len(keys) == 1 or streamout is None
 
     stats = pickle.load(open(pklin, "rb"))
-    sorted_indices = sorted(list(range(len(stats["chunk_ranges"]))),
-                            key=lambda x: stats[key][x],
-                            reverse=rev_order)
+    chunk_ranges = stats["chunk_ranges"]
+
+    tmpdir = []
+    def get_tmpdir():
+        if not tmpdir:
+            # local disk is preferred; output directory if there is not enough space
+            outdir = os.path.dirname(os.path.abspath(keys_out[0][2]))
+            tmpd = util.get_temp_local_dir("sort_stream", min_bytes=total_bytes_to_write, additional_tmpd=outdir,
+                                           use_ramdisk=False) # runs can be as large as the stream itself
+            if tmpd is None: tmpd = tempfile.mkdtemp(prefix="sort_stream", dir=outdir)
+            tmpdir.append(tmpd)
+        return tmpdir[0]
+    # get_tmpdir()
 
-    ifs = open(streamin)
-    ofs = open(streamout, "w")
-    ofs.write(ifs.readline())
+    ifs = open(streamin, "rb", buffer_mb*1024**2)
+    header = ifs.readline()
 
-    for i, idx in enumerate(sorted_indices):
-        print("writing", stats[key][idx])
-        s, e = stats["chunk_ranges"][idx]
-        ifs.seek(s-1)
-        ofs.write(ifs.read(e-s+1))
-        if stop_after is not None and i+1 >= stop_after: break
+    # ranks[i][idx] = position of chunk idx in output i (None if not written)
+    keys_out, ranks, writers = [], [], []
+    total_bytes_to_write = 0
+    for k in keys:
+        name, rev_order, n = parse_key(k)
+        if n is None: n = stop_after
+        out = streamout
+        if out is None:
+            out = os.path.splitext(os.path.basename(streamin))[0] + "_sort_%s" % k.replace(":", "_top")
+            out += ".stream"
 
+        sorted_indices = sorted(list(range(len(chunk_ranges))),
+                                key=lambda x: stats[name][x],
+                                reverse=rev_order)
+        if n is not None: sorted_indices = sorted_indices[:n]
+        r = [None] * len(chunk_ranges)
+        for i, idx in enumerate(sorted_indices): r[idx] = i
+
+        keys_out.append((name, rev_order, out))
+        total_bytes_to_write += sum([chunk_ranges[idx][1]-chunk_ranges[idx][0]+1 for idx in sorted_indices])
+        ranks.append(r)
+        writers.append(SortedChunkWriter(out, header, get_tmpdir))
+
+    # chunk_ranges are in file order
+    t_start = time.time()
+    total_bytes = 0
+    for idx, (s, e) in enumerate(chunk_ranges):
+        targets = [i for i in range(len(writers)) if ranks[i][idx] is not None]
+        if not targets: continue
+
+        ifs.seek(s-1) # forward seek; mostly within the read buffer
+        data = ifs.read(e-s+1)
+        total_bytes += len(data)
+        for i in targets: writers[i].add(ranks[i][idx], data)
+
+        if sum([w.nbytes for w in writers]) > max_memory_mb*1024**2:
+            for w in writers: w.flush_run()
+
+        if idx%1000 == 0:
+            sys.stdout.write("%d/%d chunks read (%.1f MB/sec)\r" % (idx+1, len(chunk_ranges), total_bytes/1024.**2/(time.time()-t_start+1e-6)))
+            sys.stdout.flush()
+
+    print("%d chunks (%.1f MB) read in %.1f sec.                " % (len(chunk_ranges), total_bytes/1024.**2, time.time()-t_start))
+
+    for (name, rev_order, out), w in zip(keys_out, writers):
+        w.finish(buffer_mb*1024**2)
+        print("%s: %d chunks sorted by %s (%s order)%s" % (out, w.n_written, name, "decreasing" if rev_order else "increasing",
+                                                           "; merged from %d temporary files" % w.n_runs if w.n_runs else ""))
+
+    if tmpdir: shutil.rmtree(tmpdir[0])
 # run()
 
 if __name__ == "__main__":
-    import sys
-    run(sys.argv[1], sys.argv[2], sys.argv[3], stop_after=int(sys.argv[4]) if len(sys.argv)>4 else None)
-    
+    # sort_stream.py stream pkl key1[,key2,..] [stop_after]
+    # key: e.g. ioversigma- (decreasing order) or ioversigma+ (increasing order); ioversigma-:1000 writes the first 1000 chunks only.
+    run(sys.argv[1], sys.argv[2], sys.argv[3].split(",") if "," in sys.argv[3] else sys.argv[3],
+        stop_after=int(sys.argv[4]) if len(sys.argv)>4 else None)
+
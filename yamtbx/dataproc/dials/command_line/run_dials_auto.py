@@ -7,6 +7,11 @@ from yamtbx.dataproc import pointless
 import pickle 
 import json
 import os
+import time
+import queue
+import threading
+import traceback
+import subprocess
 from cctbx import sgtbx
 from cctbx import crystal
 from libtbx.utils import Sorry
@@ -121,98 +126,319 @@ def calc_merging_stats(hklin, cut_resolution=True):
     return dict(d_min=d_min, cutoffs=cutoffs, stats=stats)
 # calc_merging_stats()
 
-def run_dials_sequence(filename_template, prefix, nr_range, wdir, known_xs, overrides, scan_varying, nproc):
-    log_out = open(os.path.join(wdir, "dials_sequence.log"), "w")
-    pointless_log = os.path.join(wdir, "pointless.log")
+class Stage(object):
+    """
+    A step of processing in wdir; either a command (cmd) or a python function (func(stage)) which may call commands
+    by stage.call(). For func, cmd is a description used only to check if the previous run is the same.
+    cmd and inputs can be functions returning them, evaluated when the stage starts.
+    Runs after all stages in deps (names of stages in the same wdir) succeeded.
+    Skipped if all outputs exist, are not older than inputs, and were made by the same cmd in the previous run.
+    If check_outputs=True, the stage fails when any of outputs is missing after run, and stages depending on it are not run.
+    Heavy stages use all cores given to the programs (nproc=), and only one of them runs at once.
+    """
+    def __init__(self, name, wdir, cmd=None, func=None, deps=[], inputs=[], outputs=[], stdin=None, stdout=None,
+                 heavy=False, check_outputs=False):
+        self.name = name
+        self.wdir = wdir
+        self.cmd = cmd
+        self.func = func
+        self.deps = deps
+        self.inputs = inputs
+        self.outputs = outputs
+        self.stdin = stdin
+        self.stdout = stdout # filename relative to wdir; None for dials_sequence.log
+        self.heavy = heavy
+        self.check_outputs = check_outputs
+    # __init__()
+
+    def key(self): return (self.wdir, self.name)
+
+    def get_cmd(self): return self.cmd() if callable(self.cmd) else self.cmd
+    def get_inputs(self): return self.inputs() if callable(self.inputs) else self.inputs
+
+    def is_up_to_date(self, last_record):
+        if not last_record or last_record.get("status") not in ("done", "skipped"): return False
+        if last_record.get("cmd") != self.get_cmd(): return False
+        outputs = [os.path.join(self.wdir, f) for f in self.outputs]
+        if not outputs or not all([os.path.isfile(f) for f in outputs]): return False
+        inputs = [os.path.join(self.wdir, f) for f in self.get_inputs()]
+        inputs = [f for f in inputs if os.path.isfile(f)]
+        if not inputs: return True
+        return min([os.path.getmtime(f) for f in outputs]) >= max([os.path.getmtime(f) for f in inputs])
+    # is_up_to_date()
+
+    def write_log(self, msg):
+        with open(os.path.join(self.wdir, "dials_sequence.log"), "a") as ofs:
+            ofs.write(msg + "\n")
+    # write_log()
+
+    def call(self, cmd, stdin=None, stdout=None):
+        """
+        Run cmd in wdir and returns the return code. Unlike util.call(), the current directory is not changed,
+        so that commands can be run from concurrent threads.
+        """
+        if stdout is None: stdout = self.stdout
+        if stdout is None: stdout = "dials_sequence.log"
+        ofs = open(os.path.join(self.wdir, stdout), "a" if stdout == "dials_sequence.log" else "w")
+        p = subprocess.Popen(cmd, shell=True, cwd=self.wdir, stdin=subprocess.PIPE,
+                             stdout=ofs, stderr=subprocess.STDOUT, universal_newlines=True)
+        if stdin is not None: p.stdin.write(stdin)
+        p.stdin.close()
+        p.wait()
+        ofs.close()
+        return p.returncode
+    # call()
+
+    def run(self):
+        if self.func is not None:
+            self.func(self)
+        else:
+            self.call(self.get_cmd(), stdin=self.stdin)
+
+        if self.check_outputs:
+            missing = [f for f in self.outputs if not os.path.isfile(os.path.join(self.wdir, f))]
+            if missing: raise Exception("Expected file(s) not found: " + " ".join(missing))
+    # run()
+# class Stage
+
+class StageRunner(object):
+    """
+    Run stages (of possibly multiple datasets) respecting their dependencies. Stages are started in the given order
+    as soon as their dependencies are satisfied; at most one heavy stage and max_light_jobs light stages run at once,
+    so that e.g. exports and post-processing of a dataset overlap with processing of the next dataset.
+    Status and timing of each stage are recorded in dials_stages.json in its wdir.
+    """
+    record_file = "dials_stages.json"
+
+    def __init__(self, stages, max_light_jobs=2):
+        self.stages = stages
+        self.max_light_jobs = max_light_jobs
+        self.records = {} # {wdir: {name: dict(cmd=, status=, start=, end=, time=)}}
+        self.last_records = {}
+        for wdir in set([s.wdir for s in stages]):
+            self.records[wdir] = {}
+            try: self.last_records[wdir] = json.load(open(os.path.join(wdir, self.record_file)))
+            except: self.last_records[wdir] = {}
+    # __init__()
+
+    def save_records(self, wdir):
+        jsonout = os.path.join(wdir, self.record_file)
+        json.dump(self.records[wdir], open(jsonout+".tmp", "w"), indent=1)
+        os.rename(jsonout+".tmp", jsonout)
+    # save_records()
+
+    def run_stage(self, stage, q):
+        rec, err = dict(cmd=None, start=time.time()), None
+        try:
+            rec["cmd"] = stage.get_cmd()
+            if stage.is_up_to_date(self.last_records[stage.wdir].get(stage.name)):
+                rec["status"] = "skipped"
+            else:
+                stage.run()
+                rec["status"] = "done"
+        except:
+            rec["status"], err = "failed", traceback.format_exc()
+
+        rec["end"] = time.time()
+        rec["time"] = rec["end"] - rec["start"]
+        q.put((stage, rec, err))
+    # run_stage()
+
+    def run(self):
+        q = queue.Queue()
+        status = {}
+        pending = list(self.stages)
+        n_heavy, n_light = 0, 0
+
+        while True:
+            for s in list(pending):
+                dep_status = [status.get((s.wdir, d)) for d in s.deps]
+                if any([x in ("failed", "cancelled") for x in dep_status]):
+                    status[s.key()] = "cancelled"
+                    self.records[s.wdir][s.name] = dict(status="cancelled")
+                    self.save_records(s.wdir)
+                    s.write_log("Stage %s: cancelled" % s.name)
+                    pending.remove(s)
+                    continue
+                if not all([x in ("done", "skipped") for x in dep_status]): continue
+                if s.heavy and n_heavy >= 1: continue
+                if not s.heavy and n_light >= self.max_light_jobs: continue
+
+                if s.heavy: n_heavy += 1
+                else: n_light += 1
+                pending.remove(s)
+                status[s.key()] = "running"
+                s.write_log("Stage %s: started" % s.name)
+                th = threading.Thread(target=self.run_stage, args=(s, q))
+                th.daemon = True
+                th.start()
+
+            if n_heavy + n_light == 0: break
+
+            s, rec, err = q.get()
+            if s.heavy: n_heavy -= 1
+            else: n_light -= 1
+            status[s.key()] = rec["status"]
+            self.records[s.wdir][s.name] = rec
+            self.save_records(s.wdir)
+            s.write_log("Stage %s: %s (%.1f sec)" % (s.name, rec["status"], rec["time"]))
+            if err is not None: s.write_log(err)
+
+        return status
+    # run()
+# class StageRunner
+
+def make_dials_stages(filename_template, prefix, nr_range, wdir, known_xs, overrides, scan_varying, nproc):
+    """
+    Returns stages of processing one dataset, which used to be run in this order:
+    dials.import, find_spots, export (XDS format), index, refine, integrate, export (mtz), pointless, export (XDS_ASCII), aimless,
+    and calculation of merging statistics.
+    """
+    log_out = open(os.path.join(wdir, "dials_sequence.log"), "a")
 
     # Prepare
     img_files = find_existing_files_in_template(filename_template, nr_range[0], nr_range[1],
                                                 datadir=os.path.dirname(prefix), check_compressed=True)
     if len(img_files) == 0:
-        mylog.error("No files found for %s %s" % (filename_template, nr_range))
-        return
+        log_out.write("No files found for %s %s\n" % (filename_template, nr_range))
+        return []
 
     nproc_str = "nproc=%d"%nproc
 
     log_out.write("Importing %s range=%s\n" % (img_files, nr_range))
     log_out.write(" Overrides: %s\n" % overrides)
-    log_out.flush()
+    log_out.close()
 
     override_str = "" # TODO support other stuff.. (wavelength, distance, osc_range, rotation_axis,..)
     if "orgx" in overrides and "orgy" in overrides:
         override_str += "slow_fast_beam_centre=%.2f,%.2f " % (overrides["orgy"], overrides["orgx"])
 
+    stages = []
     if len(img_files) == 1 and img_files[0].endswith(".h5"):
-        util.call('dials.import "%s" %s image_range=%d,%d output.experiments=imported.expt' % (img_files[0], override_str,
-                                                                                               nr_range[0], nr_range[1]),
-                  wdir=wdir, stdout=log_out,
-                  expects_out=[os.path.join(wdir, "imported.expt")])
+        cmd = 'dials.import "%s" %s image_range=%d,%d output.experiments=imported.expt' % (img_files[0], override_str,
+                                                                                            nr_range[0], nr_range[1])
     else:
-        util.call('dials.import %s template="%s" image_range=%d,%d output.experiments=imported.expt' % (override_str,
-                                                                                                        filename_template.replace("?","#"),
-                                                                                                        nr_range[0], nr_range[1]),
-                  wdir=wdir, stdout=log_out,
-                  expects_out=[os.path.join(wdir, "imported.expt")])
-
-    util.call("dials.find_spots imported.expt filter.d_max=30 %s output.reflections=strong.refl" % nproc_str, # global_threshold=200
-              wdir=wdir, stdout=log_out,
-              expects_out=[os.path.join(wdir, "strong.refl")])
-
-    util.call("dials.export strong.refl format=xds xds.directory=.",
-              wdir=wdir, stdout=log_out)
-
-    index_ok = False
-    for index_meth in ("fft3d", "fft1d", "real_space_grid_search"):
-        for index_assi in ("local", "simple"):
-            if index_ok: break
-            cmd = "dials.index imported.expt strong.refl output.experiments=indexed.expt output.reflections=indexed.refl "
-            cmd += "indexing.method=%s index_assignment.method=%s " % (index_meth, index_assi)
-            if known_xs is not None:# not in (known.space_group, known.unit_cell):
-                cmd += "unit_cell=%s space_group=%d " % (",".join(["%.3f"%x for x in known_xs.unit_cell().parameters()]),
-                                                        known_xs.space_group().type().number())
-            elif index_meth == "real_space_grid_search":
-                continue
-
-            log_out.write("Trying indexing.method=%s index_assignment.method=%s\n" % (index_meth, index_assi))
-            log_out.flush()
-            util.call(cmd, wdir=wdir, stdout=log_out)
-            if os.path.isfile(os.path.join(wdir, "indexed.expt")):
-                index_ok = True
-            else:
+        cmd = 'dials.import %s template="%s" image_range=%d,%d output.experiments=imported.expt' % (override_str,
+                                                                                                     filename_template.replace("?","#"),
+                                                                                                     nr_range[0], nr_range[1])
+    stages.append(Stage("import", wdir, cmd, outputs=["imported.expt"], check_outputs=True))
+
+    stages.append(Stage("find_spots", wdir,
+                        "dials.find_spots imported.expt filter.d_max=30 %s output.reflections=strong.refl" % nproc_str, # global_threshold=200
+                        deps=["import"], inputs=["imported.expt"], outputs=["strong.refl"], heavy=True, check_outputs=True))
+
+    stages.append(Stage("export_spots", wdir, "dials.export strong.refl format=xds xds.directory=. output.log=dials.export_spots.log",
+                        deps=["find_spots"], inputs=["strong.refl"], outputs=["SPOT.XDS"]))
+
+    index_cmd = "dials.index imported.expt strong.refl output.experiments=indexed.expt output.reflections=indexed.refl "
+    if known_xs is not None:# not in (known.space_group, known.unit_cell):
+        index_cmd += "unit_cell=%s space_group=%d " % (",".join(["%.3f"%x for x in known_xs.unit_cell().parameters()]),
+                                                      known_xs.space_group().type().number())
+
+    def run_index(stage):
+        for index_meth in ("fft3d", "fft1d", "real_space_grid_search"):
+            for index_assi in ("local", "simple"):
+                if known_xs is None and index_meth == "real_space_grid_search":
+                    continue
+
+                stage.write_log("Trying indexing.method=%s index_assignment.method=%s" % (index_meth, index_assi))
+                stage.call(index_cmd + "indexing.method=%s index_assignment.method=%s " % (index_meth, index_assi))
+                if os.path.isfile(os.path.join(wdir, "indexed.expt")):
+                    return
                 for f in ("dials.index.log", "dials.index.debug.log"):
                     util.rotate_file(os.path.join(wdir, f))
+    # run_index()
 
-    if not index_ok:
-        return
-
-    files_for_integration = "indexed.expt indexed.refl"
+    stages.append(Stage("index", wdir, index_cmd, func=run_index, deps=["find_spots"], inputs=["imported.expt", "strong.refl"],
+                        outputs=["indexed.expt", "indexed.refl"], heavy=True, check_outputs=True))
 
     if scan_varying:
-        util.call("dials.refine indexed.expt indexed.refl scan_varying=true output.experiments=refined.expt output.reflections=refined.refl",
-                  wdir=wdir, stdout=log_out)
-        if os.path.isfile(os.path.join(wdir, "refined.refl")):
-            files_for_integration = "refined.expt refined.refl"
-        else:
-            log_out.write("dials.refine failed. using intedexed results.\n")
-
-    util.call("dials.integrate %s min_spots.per_degree=10 output.experiments=integrated.expt output.reflections=integrated.refl %s" % (files_for_integration, nproc_str),
-              wdir=wdir, stdout=log_out)
-    util.call("dials.export integrated.refl integrated.expt mtz.hklout=integrated.mtz",
-              wdir=wdir, stdout=log_out)
-    util.call("pointless integrated.mtz hklout pointless.mtz",
-              wdir=wdir, stdin="SETTING SYMMETRY-BASED\ntolerance 10\n", stdout=open(pointless_log, "w"))
-    util.call("dials.export integrated.expt integrated.refl format=xds_ascii xds_ascii.hklout=DIALS.HKL",
-              wdir=wdir, stdout=log_out)
-    util.call("aimless hklin pointless.mtz hklout aimless.mtz",
-              wdir=wdir, stdin="output UNMERGED\n", stdout=open(os.path.join(wdir, "aimless.log"), "w"))
-              
-    #job_str += "touch dials_job_finished\n"
-
-    ret = calc_merging_stats(os.path.join(wdir, "aimless_unmerged.mtz"))
-    ret["symm"] = get_most_possible_symmetry(wdir)
-
-    pickle.dump(ret, open(os.path.join(wdir, "kamo_dials.pkl"), "wb"), -1)
+        refine_cmd = "dials.refine indexed.expt indexed.refl scan_varying=true output.experiments=refined.expt output.reflections=refined.refl"
+        def run_refine(stage):
+            stage.call(refine_cmd)
+            if not os.path.isfile(os.path.join(wdir, "refined.refl")):
+                stage.write_log("dials.refine failed. using intedexed results.")
+        # run_refine()
+
+        stages.append(Stage("refine", wdir, refine_cmd, func=run_refine,
+                            deps=["index"], inputs=["indexed.expt", "indexed.refl"], outputs=["refined.expt", "refined.refl"], heavy=True))
+
+    def files_for_integration():
+        if scan_varying and os.path.isfile(os.path.join(wdir, "refined.refl")):
+            return ["refined.expt", "refined.refl"]
+        return ["indexed.expt", "indexed.refl"]
+    # files_for_integration()
+
+    stages.append(Stage("integrate", wdir,
+                        lambda: "dials.integrate %s min_spots.per_degree=10 output.experiments=integrated.expt output.reflections=integrated.refl %s" % (" ".join(files_for_integration()), nproc_str),
+                        deps=["refine" if scan_varying else "index"], inputs=files_for_integration,
+                        outputs=["integrated.expt", "integrated.refl"], heavy=True))
+    stages.append(Stage("export_mtz", wdir, "dials.export integrated.refl integrated.expt mtz.hklout=integrated.mtz",
+                        deps=["integrate"], inputs=["integrated.expt", "integrated.refl"], outputs=["integrated.mtz"]))
+    stages.append(Stage("pointless", wdir, "pointless integrated.mtz hklout pointless.mtz",
+                        stdin="SETTING SYMMETRY-BASED\ntolerance 10\n", stdout="pointless.log",
+                        deps=["export_mtz"], inputs=["integrated.mtz"], outputs=["pointless.mtz", "pointless.log"]))
+    stages.append(Stage("export_xds_ascii", wdir, "dials.export integrated.expt integrated.refl format=xds_ascii xds_ascii.hklout=DIALS.HKL output.log=dials.export_xds_ascii.log",
+                        deps=["integrate"], inputs=["integrated.expt", "integrated.refl"], outputs=["DIALS.HKL"]))
+    stages.append(Stage("aimless", wdir, "aimless hklin pointless.mtz hklout aimless.mtz",
+                        stdin="output UNMERGED\n", stdout="aimless.log",
+                        deps=["pointless"], inputs=["pointless.mtz"], outputs=["aimless_unmerged.mtz", "aimless.log"]))
+
+    def make_summary(stage):
+        ret = calc_merging_stats(os.path.join(wdir, "aimless_unmerged.mtz"))
+        ret["symm"] = get_most_possible_symmetry(wdir)
+        pickle.dump(ret, open(os.path.join(wdir, "kamo_dials.pkl"), "wb"), -1)
+    # make_summary()
+
+    stages.append(Stage("summary", wdir, "calc_merging_stats", func=make_summary, deps=["aimless", "export_xds_ascii"],
+                        inputs=["aimless_unmerged.mtz", "pointless.log", "integrated.expt", "DIALS.HKL"], outputs=["kamo_dials.pkl"]))
 
     # TODO config.params.xds.exclude_resolution_range config.params.reverse_phi
+    return stages
+# make_dials_stages()
 
-# run_dials()
+def run_dials_sequences(args_list, max_light_jobs=2):
+    """
+    Process multiple datasets; args_list is a list of dict of arguments of run_dials_sequence().
+    Exports and post-processing of a dataset run concurrently with processing of the next dataset.
+    Stages of the same dataset may also run concurrently (e.g. two dials.export); they must not share output or log files.
+    Note that datasets need to be given together here to overlap; run_dials_sequence() (one job per dataset in KAMO)
+    only overlaps stages within the dataset.
+    Returns status of stages {(wdir, name): status}.
+    """
+    stages = []
+    for args in args_list:
+        wdir = args["wdir"]
+        open(os.path.join(wdir, "dials_sequence.log"), "w").close()
+        stages.extend(make_dials_stages(**args))
+
+    t_start = time.time()
+    status = StageRunner(stages, max_light_jobs=max_light_jobs).run()
+
+    for wdir in sorted(set([s.wdir for s in stages])):
+        try: records = json.load(open(os.path.join(wdir, StageRunner.record_file)))
+        except: records = {}
+        with open(os.path.join(wdir, "dials_sequence.log"), "a") as ofs:
+            ofs.write("\nStage timings:\n")
+            for s in [x for x in stages if x.wdir == wdir]:
+                r = records.get(s.name, {})
+                ofs.write(" %-16s %-9s %s\n" % (s.name, r.get("status", ""), "%8.1f sec" % r["time"] if "time" in r else ""))
+
+    print("%d datasets processed in %.1f sec." % (len(args_list), time.time()-t_start))
+    return status
+# run_dials_sequences()
+
+def run_dials_sequence(filename_template, prefix, nr_range, wdir, known_xs, overrides, scan_varying, nproc):
+    return run_dials_sequences([dict(filename_template=filename_template, prefix=prefix, nr_range=nr_range, wdir=wdir,
+                                     known_xs=known_xs, overrides=overrides, scan_varying=scan_varying, nproc=nproc)])
+# run_dials_sequence()
+
+if __name__ == "__main__":
+    import sys
+    # run_dials_auto.py args.pkl.. (arguments of run_dials_sequence() saved by KAMO; wdir is relative to the pkl file)
+    args_list = []
+    for pklin in sys.argv[1:]:
+        args = pickle.load(open(pklin, "rb"))
+        args["wdir"] = os.path.join(os.path.dirname(os.path.abspath(pklin)), args["wdir"])
+        args_list.append(args)
+    run_dials_sequences(args_list)
@@ -233,21 +233,25 @@ def extract_to_minicbf(h5master, frameno_or_path, cbfout, binning=1):
 """ % h)
 # extract_to_minicbf()
 
-def compress_h5data(h5obj, path, data, chunks, compression="bslz4"):
+def compress_h5data(h5obj, path, data, chunks, compression="bslz4", shape=None, dtype=None):
+    # If data is None, empty dataset of given shape and dtype is created.
     import bitshuffle.h5
 
+    if data is not None:
+        shape, dtype = data.shape, data.dtype
+
     if compression is None:
-        dataset = h5obj.create_dataset(path, data.shape,
-                                       chunks=chunks, dtype=data.dtype, data=data)        
+        dataset = h5obj.create_dataset(path, shape,
+                                       chunks=chunks, dtype=dtype, data=data)        
     elif compression=="bslz4":
-        dataset = h5obj.create_dataset(path, data.shape,
+        dataset = h5obj.create_dataset(path, shape,
                                        compression=bitshuffle.h5.H5FILTER,
                                        compression_opts=(0, bitshuffle.h5.H5_COMPRESS_LZ4),
-                                       chunks=chunks, dtype=data.dtype, data=data)
+                                       chunks=chunks, dtype=dtype, data=data)
     elif compression=="shuf+gz":
-        dataset = h5obj.create_dataset(path, data.shape,
+        dataset = h5obj.create_dataset(path, shape,
                                        compression="gzip",shuffle=True,
-                                       chunks=chunks, dtype=data.dtype, data=data)
+                                       chunks=chunks, dtype=dtype, data=data)
     else:
         raise "Unknwon compression name (%s)" % compression
 
@@ -274,6 +278,27 @@ def create_data_file(outfile, data, chunks, nrlow, nrhigh, compression="bslz4"):
     h5.close()
 # create_data_file()
 
+def create_data_file_from_blocks(outfile, shape, dtype, blocks, chunks, nrlow, nrhigh, compression="bslz4"):
+    """
+    Same as create_data_file(), but data are given by blocks of frames so that whole data need not be on memory.
+    blocks: iterable of (first frame index, 3D array)
+    """
+    h5 = h5py.File(outfile, "w")
+    h5.create_group("/entry")
+    h5["/entry"].attrs["NX_class"] = "NXentry"
+    h5.create_group("/entry/data")
+    h5["/entry/data"].attrs["NX_class"] = "NXdata"
+
+    dataset = compress_h5data(h5, "/entry/data/data", None, chunks, compression, shape=shape, dtype=dtype)
+    for i, data in blocks:
+        dataset[i:i+data.shape[0]] = data
+
+    dataset.attrs["image_nr_low"] = nrlow
+    dataset.attrs["image_nr_high"] = nrhigh
+
+    h5.close()
+# create_data_file_from_blocks()
+
 def get_masterh5_related_filenames(masterh5):
     ret = [masterh5]
 
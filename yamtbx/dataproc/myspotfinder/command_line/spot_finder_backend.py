@@ -113,7 +113,11 @@ class DiffScanManager(object):
 
     def add_scanlog(self, slog):
         slog = os.path.abspath(slog)
-        self.scanlog[os.path.dirname(slog)] = bl_logfiles.BssDiffscanLog(slog)
+        logdir = os.path.dirname(slog)
+        if logdir in self.scanlog and self.scanlog[logdir].scanlog == slog:
+            self.scanlog[logdir].parse() # only reads appended lines
+        else:
+            self.scanlog[logdir] = bl_logfiles.BssDiffscanLog(slog)
     # add_scanlog()
 
     def add_dir(self, slogdir):
@@ -678,6 +682,7 @@ class ResultsManager(object):
         self.dbdir = dbdir
         self.rqueue = rqueue
         self._diffscan_params = {}
+        self._scanlogs = {} # diffscan.log: BssDiffscanLog object; used only in this thread
     # __init__()
 
     def start(self):
@@ -689,6 +694,16 @@ class ResultsManager(object):
 
     def is_running(self): return self.thread is not None and self.thread.is_alive()
 
+    def get_scanlog(self, scanlog):
+        # Parser is kept for each log so that only appended lines are read next time
+        scanlog = os.path.abspath(scanlog)
+        if scanlog in self._scanlogs:
+            self._scanlogs[scanlog].parse()
+        else:
+            self._scanlogs[scanlog] = bl_logfiles.BssDiffscanLog(scanlog)
+        return self._scanlogs[scanlog]
+    # get_scanlog()
+
     def update_diffscan_params(self, msg):
         wdir = str(msg["data_directory"])
         prefix = str(msg["file_prefix"])
@@ -710,8 +725,8 @@ class ResultsManager(object):
             scanlog = os.path.join(wdir, "diffscan.log")
             if not os.path.isfile(scanlog): return
 
-            slog = bl_logfiles.BssDiffscanLog(scanlog)
-            slog.remove_overwritten_scans()
+            # remove_overwritten_scans() is not needed for the last matched scan, and would make the next parse() reread everything
+            slog = self.get_scanlog(scanlog)
             matched = [x for x in slog.scans if x.get_prefix()==prefix+"_"]
             if matched:
                 scan_direction = matched[-1].scan_direction
@@ -748,8 +763,7 @@ class ResultsManager(object):
             scanlog = os.path.join(wdir, "..", "diffscan.log")
             gcxy = None
             if os.path.isfile(scanlog):
-                slog = bl_logfiles.BssDiffscanLog(scanlog)
-                slog.remove_overwritten_scans()
+                slog = self.get_scanlog(scanlog) # the last matched scan is used; no need to remove overwritten scans
                 gcxy = slog.calc_grid_coord(prefix=str(msg["file_prefix"])+"_", num=msg["idx"]) # may return None
 
             if gcxy is None: gcxy = [float("nan")]*2
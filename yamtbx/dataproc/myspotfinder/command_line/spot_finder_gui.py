@@ -50,6 +50,7 @@ from yamtbx.util import get_number_of_processors, rotate_file
 from yamtbx.dataproc.XIO import XIO
 from yamtbx.dataproc.myspotfinder import shikalog
 from yamtbx.dataproc.myspotfinder import config_manager
+from yamtbx.dataproc.myspotfinder import report_spotdata
 from yamtbx.dataproc.XIO.plugins import eiger_hdf5_interpreter
 
 EventResultsUpdated, EVT_RESULTS_UPDATED = wx.lib.newevent.NewEvent()
@@ -162,6 +163,7 @@ class ReportHTMLMakerThread(object):
 
         self.plotFrame = parent.plotFrame
         self.plot_data = None
+        self.spot_pagers = {} # wdir -> report_spotdata.SpotDataPager
 
     def start(self, interval=None):
         self.stop()
@@ -415,51 +417,37 @@ class ReportHTMLMakerThread(object):
             shikalog.warning("No results found. Exiting. %s"% wdir)
             return
 
-        dbfile = os.path.join(wdir, "shika.db")
-        con = sqlite3.connect(dbfile, timeout=10, isolation_level=None)
-        con.execute('pragma query_only = ON;')
-        print("Reading data from DB for making report html.")
-        c = con.execute("select filename,spots from spots")
-        dbspots = dict([(str(x[0]), pickle.loads(str(x[1]))) for x in c.fetchall()])
-        spot_data = "var spot_data = {"
-        for i, (f, stat) in enumerate(result):
-            if stat is None: continue
-            bf = os.path.basename(f)
-            spots = dbspots[bf]["spots"]
-            thumb_posmag = dbspots[bf]["thumb_posmag"]
-            r = re.search("^(.*)_([0-9]+)\.[^0-9]+$", bf)
-            prefix, num = r.group(1), int(r.group(2))
-            spot_data += '"%s":[[' % bf
-            for y,x,snr,d in spots:
-                #x, y = spot.max_pxl_y(), spot.max_pxl_x()
-                pos = thumb_posmag[0:2]
-                mag = thumb_posmag[2]
-                x, y = (x - pos[0])*mag, (y - pos[1])*mag
-                spot_data += "[%d,%d]," % (x, y)
-
-            spot_data += "], %.1f, %.1f, %d, %d]," % (stat.stats[1], stat.stats[2], stat.stats[0], num)
-
-        spot_data += "};"
-        spot_data = spot_data.replace("inf,", "Infinity,").replace("nan,", "NaN,")
-        
-        con.close()
+        if wdir not in self.spot_pagers:
+            self.spot_pagers[wdir] = report_spotdata.SpotDataPager(wdir)
+        pager = self.spot_pagers[wdir]
+        n_written = pager.update(dict([(os.path.basename(f), stat) for f, stat in result if stat is not None]))
+        shikalog.info("Spot data updated for %d frames." % n_written)
 
         # Determine img picture extension
         img_ext = ".png" if os.path.exists(os.path.join(wdir, os.path.basename(result[0][0])+".png")) else ".jpg"
-        jpg_dirs = "var jpg_dirs = {"
         flag_tiled_jpg = False
         if glob.glob(os.path.join(wdir, "thumb_*")):
+            checked = set()
             for res in result:
                 r = re.search("^(.*)_([0-9]+)\.[^0-9]+$", os.path.basename(res[0]))
-                prefix, num = r.group(1), int(r.group(2))
-                jd = os.path.join("thumb_%s_%.3d" % (prefix, num//1000))
-                if not os.path.exists(jd): flag_tiled_jpg = True  # THIS MAY CAUSE A PROBLEM..
-                jpg_dirs += '"%s":"%s",' % (os.path.basename(res[0]), jd)
+                jd = "thumb_%s_%.3d" % (r.group(1), int(r.group(2))//1000)
+                if jd in checked: continue
+                checked.add(jd)
+                if not os.path.exists(os.path.join(wdir, jd)):
+                    flag_tiled_jpg = True
+                    break
+            jpg_dir_js = """\
+    function jpgDir(f) {
+        var r = /^(.*)_([0-9]+)\\.[^0-9]+$/.exec(f);
+        var n = String(Math.floor(parseInt(r[2], 10)/1000));
+        while (n.length < 3) n = "0" + n;
+        return "thumb_" + r[1] + "_" + n;
+    }
+"""
         else:
-            for res in result:
-                jpg_dirs += '"%s":".",' % os.path.basename(res[0])
-
-        jpg_dirs += "};"
+            jpg_dir_js = """\
+    function jpgDir(f) { return "."; }
+"""
 
         ofs = open(htmlout, "w")
         ofs.write("""\
@@ -473,16 +461,21 @@ class ReportHTMLMakerThread(object):
     function changeplot(obj, name){
      document.images[name].src = "plot_"+name+obj.value+".png";
     }
-    %(spot_data)s
-    %(jpg_dirs)s
-""" % dict(spot_data=spot_data,
-           jpg_dirs=jpg_dirs if not flag_tiled_jpg else ""))
+%(spot_js)s
+%(jpg_dir_js)s
+""" % dict(spot_js=pager.make_js(version=int(time.time())),
+           jpg_dir_js=jpg_dir_js if not flag_tiled_jpg else ""))
 
         if flag_tiled_jpg: # FOR TILED JPEG
             ofs.write("""\
-    function plotClick(scanprefix, imgfile) {
+    function showFrame(scanprefix, imgfile, data) {
+        if (isNaN(data[4])) { // spot data not found; no tile to show
+          document.getElementById(scanprefix+"info").innerHTML = "<table border=0><tr><td>File name: <td>" + imgfile + "<tr><td colspan=2>No spot data</table>";
+          var canvas = document.getElementById(scanprefix+"canvas");
+          canvas.getContext('2d').clearRect(0,0,canvas.width,canvas.height);
+          return;
+        }
         var f = imgfile;
-        var data = spot_data[f];
         var img = new Image();
         var idx = Math.floor((data[4]-1)/100);
         var n1 = idx*100+1;
@@ -507,11 +500,10 @@ class ReportHTMLMakerThread(object):
             
         else: # FOR SINGLE JPEGs
             ofs.write("""\
-    function plotClick(scanprefix, imgfile) {
+    function showFrame(scanprefix, imgfile, data) {
         var f = imgfile;
-        var data = spot_data[f];
         var img = new Image();
-        img.src = jpg_dirs[f] + "/" + f + "%(img_ext)s";
+        img.src = jpgDir(f) + "/" + f + "%(img_ext)s";
         img.onload = (function(fn){
           return function(){
             var td = document.getElementById(scanprefix+"info");
@@ -544,6 +536,9 @@ class ReportHTMLMakerThread(object):
           }
         }(f));
     }
+    function plotClick(scanprefix, imgfile) {
+        withSpotData(imgfile, function(data) { showFrame(scanprefix, imgfile, data); });
+    }
   //-->
   </script>
   <style type="text/css">
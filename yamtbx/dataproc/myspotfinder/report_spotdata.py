@@ -0,0 +1,196 @@
+"""
+(c) RIKEN 2015. All rights reserved.
+Author: Keitaro Yamashita
+
+This software is released under the new BSD License; see LICENSE.
+"""
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import os
+import re
+import json
+import pickle
+import sqlite3
+import shutil
+
+from yamtbx.dataproc.myspotfinder import shikalog
+
+re_frame_name = re.compile(r"^(.*)_([0-9]+)\.[^0-9]+$")
+
+def page_key(filename, page_size):
+    r = re_frame_name.search(filename)
+    if not r: return None, None
+    prefix, num = r.group(1), int(r.group(2))
+    return "%s_%.3d" % (prefix, num//page_size), num
+# page_key()
+
+class SpotDataPager(object):
+    """
+    Paged spot data for SHIKA html report.
+
+    Spot positions are not embedded in report.html, but written to small javascript files
+    (JSON wrapped with a callback so that they can be loaded from file:// URL) and loaded when needed.
+    Only rows of shika.db added (or replaced) since the last update are unpickled,
+    and only pages containing them are rewritten.
+
+    Page file: <datadir>/<prefix>_<num//page_size>.js
+      shikaSpotPage(["<key>", {"<filename>": [[[x,y],..], total, median, n_spots, num], ..}]);
+    """
+    STATE_FILE = "state.json"
+
+    def __init__(self, wdir, datadir="shika_spotdata", page_size=1000):
+        self.wdir = wdir
+        self.datadir_name = datadir
+        self.datadir = os.path.join(wdir, datadir)
+        self.page_size = page_size
+        self.last_rowid = 0
+        self.pending = {} # filename -> converted spot coordinates, waiting for stats
+        self.pages = {} # page key -> dict (only pages touched in this session)
+        self.load_state()
+    # __init__()
+
+    def state_file(self): return os.path.join(self.datadir, self.STATE_FILE)
+    def page_file(self, key): return os.path.join(self.datadir, "%s.js" % key)
+
+    def load_state(self):
+        if not os.path.isfile(self.state_file()): return
+        try:
+            state = json.load(open(self.state_file()))
+            if state.get("page_size") != self.page_size:
+                shikalog.info("Page size changed. Resetting spot data in %s" % self.datadir)
+                self.reset()
+                return
+            self.last_rowid = state["last_rowid"]
+            self.pending = state.get("pending", {})
+        except:
+            shikalog.exception("Failed to read %s. Resetting spot data." % self.state_file())
+            self.reset()
+    # load_state()
+
+    def save_state(self):
+        tmp = self.state_file() + ".tmp"
+        # pending rows are already behind last_rowid, so they are saved too; otherwise they would be lost on restart
+        json.dump(dict(last_rowid=self.last_rowid, page_size=self.page_size, pending=self.pending), open(tmp, "w"))
+        os.rename(tmp, self.state_file())
+    # save_state()
+
+    def reset(self):
+        if os.path.isdir(self.datadir):
+            shutil.rmtree(self.datadir)
+
+        self.last_rowid = 0
+        self.pending = {}
+        self.pages = {}
+    # reset()
+
+    def get_page(self, key):
+        if key in self.pages: return self.pages[key]
+
+        page = {}
+        pf = self.page_file(key)
+        if os.path.isfile(pf):
+            try:
+                s = open(pf).read()
+                page = json.loads(s[s.index("(")+1:s.rindex(")")])[1]
+            except:
+                shikalog.exception("Failed to read %s. Page will be rebuilt." % pf)
+
+        self.pages[key] = page
+        return page
+    # get_page()
+
+    def write_page(self, key):
+        pf = self.page_file(key)
+        with open(pf+".tmp", "w") as ofs:
+            ofs.write("shikaSpotPage(%s);\n" % json.dumps([key, self.pages[key]], separators=(",", ":")))
+        os.rename(pf+".tmp", pf)
+    # write_page()
+
+    def update(self, stats):
+        """
+        stats: dict of {basename: Stat}. Rows whose stats are not yet available are kept and retried next time.
+        Returns the number of frames written.
+        """
+        dbfile = os.path.join(self.wdir, "shika.db")
+        if not os.path.isfile(dbfile): return 0
+
+        con = sqlite3.connect(dbfile, timeout=10, isolation_level=None)
+        con.execute('pragma query_only = ON;')
+
+        max_rowid = con.execute("select max(rowid) from spots").fetchone()[0] or 0
+        if max_rowid < self.last_rowid:
+            shikalog.info("shika.db seems to be recreated. Resetting spot data in %s" % self.datadir)
+            self.reset()
+
+        if not os.path.isdir(self.datadir): os.makedirs(self.datadir)
+
+        c = con.execute("select rowid,filename,spots from spots where rowid > ? order by rowid", (self.last_rowid,))
+        for rowid, bf, blob in c:
+            msg = pickle.loads(bytes(blob))
+            pos, mag = msg["thumb_posmag"][0:2], msg["thumb_posmag"][2]
+            self.pending[str(bf)] = [[int((x - pos[0])*mag), int((y - pos[1])*mag)] for y,x,snr,d in msg["spots"]]
+            self.last_rowid = rowid
+        con.close()
+
+        touched = set()
+        for bf in list(self.pending):
+            stat = stats.get(bf)
+            if stat is None: continue
+            key, num = page_key(bf, self.page_size)
+            if key is None:
+                shikalog.warning("Unrecognized file name for spot data: %s" % bf)
+                del self.pending[bf]
+                continue
+            self.get_page(key)[bf] = [self.pending.pop(bf), round(float(stat.stats[1]), 1),
+                                     round(float(stat.stats[2]), 1), int(stat.stats[0]), num]
+            touched.add(key)
+
+        for key in touched:
+            self.write_page(key)
+
+        self.save_state()
+        n_written = sum([len(self.pages[k]) for k in touched])
+        shikalog.debug("Spot data: %d pages rewritten (%d frames), %d frames waiting for stats" % (len(touched), n_written, len(self.pending)))
+        return n_written
+    # update()
+
+    def make_js(self, version):
+        """
+        Javascript to load pages on demand. withSpotData(imgfile, callback) calls callback(data) when the page is available.
+        version is appended to URLs to avoid stale pages from browser cache.
+        """
+        return r"""
+    var spot_pages = {};
+    var spot_page_callbacks = {};
+    function shikaSpotPage(page) {
+        var key = page[0];
+        spot_pages[key] = page[1];
+        var cbs = spot_page_callbacks[key] || [];
+        delete spot_page_callbacks[key];
+        for (var i = 0; i < cbs.length; i++) cbs[i]();
+    }
+    function spotPageKey(imgfile) {
+        var r = /^(.*)_([0-9]+)\.[^0-9]+$/.exec(imgfile);
+        var n = String(Math.floor(parseInt(r[2], 10)/%(page_size)d));
+        while (n.length < 3) n = "0" + n;
+        return r[1] + "_" + n;
+    }
+    function withSpotData(imgfile, callback) {
+        var key = spotPageKey(imgfile);
+        var run = function() {
+            var data = spot_pages[key][imgfile];
+            if (data === undefined) data = [[], NaN, NaN, 0, NaN]; // frame number unknown
+            callback(data);
+        };
+        if (key in spot_pages) { run(); return; }
+        if (key in spot_page_callbacks) { spot_page_callbacks[key].push(run); return; }
+        spot_page_callbacks[key] = [run];
+        var s = document.createElement("script");
+        s.src = "%(datadir)s/" + key + ".js?v=%(version)s";
+        s.onerror = function() { shikaSpotPage([key, {}]); };
+        document.head.appendChild(s);
+    }
+""" % dict(page_size=self.page_size, datadir=self.datadir_name, version=version)
+    # make_js()
+# class SpotDataPager
@@ -36,26 +36,90 @@ def modify_xdsinp(xdsinp, inp_params):
     """
     inp_params = [(key, val), (key, val), ...]
     If val is None, does not insert key=val line, but comment out original speicifications (thus use default).
+    Use XdsInp if many modifications are made before running XDS.
     """
 
-    kwds = get_xdsinp_keyword(xdsinp)
-
-    ofs = open(xdsinp, "w")
-    for k, v in inp_params:
-        if v is None:
-            continue
-        ofs.write(" %s= %s\n" % (k, v))
-    ofs.write("\n")
-
-    for kwd, val in kwds:
-        if kwd in [k for k,v in inp_params]:
-            ofs.write("!")
-        ofs.write(" %s= %s\n" % (kwd,val))
-
-    ofs.close()
-    #print open(xdsinp).read()
+    inp = XdsInp(xdsinp)
+    inp.modify(inp_params)
+    inp.write()
 # modify_xdsinp()
 
+class XdsInp(object):
+    """
+    XDS.INP kept in memory.
+    The original text (keyword order and comments) is kept until modified. modify() works in the same way as
+    modify_xdsinp(), so the file written after several modify() calls is the same as the one after the same
+    number of modify_xdsinp() calls, but parsed and written only once.
+    If the file is changed by other programs, call reload().
+    """
+    def __init__(self, xdsinp=None, inp_str=None):
+        assert (xdsinp, inp_str).count(None) == 1
+        self.xdsinp = xdsinp
+        if xdsinp: inp_str = open(xdsinp).read()
+        self.set_str(inp_str)
+    # __init__()
+
+    def set_str(self, inp_str):
+        self._text = inp_str # None after modified
+        self._lines = [] # [(key, val, commented), ..] after modified. key is None for a blank line.
+        self._kwds = []
+        for l in inp_str.splitlines(True):
+            if "!" in l: l = l[:l.index("!")] # Remove comment
+            elif l.endswith("\n"): l = l[:-1]
+            self._kwds.extend(re_xds_kwd.findall(l))
+        self.dirty = False
+    # set_str()
+
+    def reload(self):
+        self.set_str(open(self.xdsinp).read())
+    # reload()
+
+    def keywords(self):
+        # Same as get_xdsinp_keyword()
+        return list(self._kwds)
+    # keywords()
+
+    def get(self, key, default=None):
+        # The last one is returned if specified multiple times (as dict(get_xdsinp_keyword()))
+        for k, v in reversed(self._kwds):
+            if k == key: return v
+        return default
+    # get()
+
+    def modify(self, inp_params):
+        keys = set([k for k, v in inp_params])
+        lines = [(k, v, False) for k, v in inp_params if v is not None]
+        lines.append((None, None, False))
+        lines.extend([(k, v, k in keys) for k, v in self._kwds])
+        self._lines = lines
+        self._text = None
+        self._kwds = [(k, v) for k, v, c in lines if k is not None and not c]
+        self.dirty = True
+    # modify()
+
+    def append_str(self, inp_str):
+        # Same as appending inp_str to the file
+        self.set_str(self.as_str() + inp_str)
+        self.dirty = True
+    # append_str()
+
+    def as_str(self):
+        if self._text is not None: return self._text
+        return "".join(["\n" if k is None else "%s %s= %s\n" % ("!" if c else "", k, v)
+                        for k, v, c in self._lines])
+    # as_str()
+
+    def write(self, xdsinp=None):
+        # If xdsinp is not given, write to the original file only when modified.
+        if xdsinp is None:
+            if not self.dirty: return
+            xdsinp = self.xdsinp
+            self.dirty = False
+
+        open(xdsinp, "w").write(self.as_str())
+    # write()
+# class XdsInp
+
 def make_backup(backup_needed, bk_prefix=None, wdir=None, quiet=False):
     if wdir is None:
         wdir = os.getcwd()
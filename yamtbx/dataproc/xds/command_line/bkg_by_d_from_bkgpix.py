@@ -33,38 +33,148 @@ def calc_edge_resolution(xparm, nx, ny):
     min_len = min((orgx, nx-orgx, orgy, ny-orgy))
     return radius_to_d(min_len, xparm)
 
-def run(bkgpix_in, xparm_in, nbins):
-    bkgpix, nx, ny = cbf.load_cbf_as_flex(bkgpix_in)
-    xparm = XPARM(xparm_in)
+class RadialProfile(object):
+    """
+    Statistics of pixel values in resolution bins (equal width in 1/d^2) over the whole detector.
+    The bin of each pixel is calculated once. Images given by add() are averaged pixel by pixel
+    (negative values are regarded as invalid), and statistics of all bins are calculated at once
+    from the values sorted by bin and value.
+    """
+    def __init__(self, xparm, nx, ny, nbins, d_min=None, mask=None):
+        """
+        mask: bool array (True for pixels to be excluded) of size nx*ny
+        """
+        if d_min is None: d_min = calc_edge_resolution(xparm, nx, ny)
+        self.d_min, self.nbins = d_min, nbins
+        self.s2_step = (1./d_min**2) / nbins
 
-    d_min = calc_edge_resolution(xparm, nx, ny)
-    print("# edge resolution=", d_min)
-    s2_step = (1./d_min**2) / nbins
+        assert xparm.qx == xparm.qy
+        orgx, orgy = xparm.origin
+        x, y = numpy.arange(nx) - orgx, numpy.arange(ny)[:,None] - orgy
+        theta = numpy.arctan(numpy.sqrt(x**2+y**2)*xparm.qx/xparm.distance) / 2.
+        s2 = (2.*numpy.sin(theta)/xparm.wavelength)**2 # 1/d^2
 
-    bins = [[] for i in range(nbins)]
+        self.bin_idx = numpy.minimum((s2/self.s2_step).astype(numpy.int32), nbins-1).ravel()
+        self.bin_idx[s2.ravel() > 1./d_min**2] = -1
+        if mask is not None: self.bin_idx[mask] = -1
 
-    for i in range(0, bkgpix.size(), 2):
-        val = bkgpix[i]
-        if val < 0:
-            continue
+        self.sum = numpy.zeros(nx*ny)
+        self.count = numpy.zeros(nx*ny, dtype=numpy.int32)
+    # __init__()
 
-        x,y = i%nx, int(i/nx)
-        d = xy_to_d(x, y, xparm)
-        if d < d_min:
-            continue
+    def add(self, data):
+        valid = data >= 0
+        self.sum += numpy.where(valid, data, 0)
+        self.count += valid
+    # add()
 
-        s2 = 1./d**2
-        idx = int(s2/s2_step)
-        if idx >= nbins: idx = nbins - 1
-        bins[idx].append(val/100.)
+    def bin_d_range(self):
+        with numpy.errstate(divide="ignore"):
+            s2 = numpy.arange(self.nbins+1) * self.s2_step
+            d = 1./numpy.sqrt(s2)
+        return d[:-1], d[1:]
+    # bin_d_range()
 
-    for i in range(nbins):
-        dmax, dmin =  1./numpy.sqrt(i*s2_step), 1./numpy.sqrt((i+1)*s2_step)
-        print("%7.2f %7.2f %.4f" % (dmax, dmin, sum(bins[i])/len(bins[i])))
+    def stats(self, percentiles=(), scale=1.):
+        """
+        Returns dict of arrays (nbins): n, mean, std, median and percentile values (key: percentile number).
+        Values are multiplied by scale. Empty bins get nan.
+        """
+        sel = (self.bin_idx >= 0) & (self.count > 0)
+        b = self.bin_idx[sel]
+        v = self.sum[sel] / self.count[sel] * scale
+
+        order = numpy.lexsort((v, b))
+        b, v = b[order], v[order]
+        n = numpy.bincount(b, minlength=self.nbins)
+        starts = numpy.concatenate(([0], numpy.cumsum(n)[:-1]))
+        ret = dict(n=n)
+
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            ret["mean"] = numpy.bincount(b, weights=v, minlength=self.nbins) / n
+            ret["std"] = numpy.sqrt(numpy.maximum(0, numpy.bincount(b, weights=v**2, minlength=self.nbins)/n - ret["mean"]**2))
 
+        for q in set((50.,) + tuple(percentiles)):
+            # linear interpolation between the closest ranks (same as numpy.percentile)
+            pos = starts + q/100. * numpy.maximum(n-1, 0)
+            lo = numpy.floor(pos).astype(int)
+            hi = numpy.minimum(lo+1, starts+n-1)
+            val = numpy.full(self.nbins, numpy.nan)
+            ok = n > 0
+            val[ok] = v[lo[ok]] + (v[hi[ok]] - v[lo[ok]]) * (pos[ok] - lo[ok])
+            ret[q] = val
 
+        ret["median"] = ret[50.]
+        return ret
+    # stats()
+# class RadialProfile
+
+master_params_str = """\
+xparm = None
+ .type = path
+ .help = "XPARM.XDS (default: in the directory of the first image)"
+nbins = 100
+ .type = int
+d_min = None
+ .type = float
+ .help = "high resolution limit (default: resolution at the edge of detector)"
+mask = None
+ .type = path
+ .help = "cbf file. Pixels with negative values are excluded."
+percentiles = None
+ .type = floats
+ .help = "e.g. 25 75"
+show_all = False
+ .type = bool
+ .help = "Show number of pixels, std and median as well as mean"
+"""
+
+def run(bkgpix_in, xparm_in, nbins, d_min=None, mask_in=None, percentiles=(), show_all=False):
+    """
+    bkgpix_in: BKGPIX.cbf or list of them (averaged)
+    """
+    if not isinstance(bkgpix_in, (list, tuple)): bkgpix_in = [bkgpix_in]
+    xparm = XPARM(xparm_in)
+    if percentiles is None: percentiles = ()
+
+    mask = None
+    if mask_in is not None:
+        mask = cbf.load_minicbf_as_numpy(mask_in)[0] < 0
+
+    prof = None
+    for f in bkgpix_in:
+        data, nx, ny = cbf.load_minicbf_as_numpy(f)
+        if prof is None:
+            prof = RadialProfile(xparm, nx, ny, nbins, d_min=d_min, mask=mask)
+            print("# edge resolution=", calc_edge_resolution(xparm, nx, ny))
+        prof.add(data)
+
+    stats = prof.stats(percentiles, scale=1./100.)
+    dmaxs, dmins = prof.bin_d_range()
+
+    print("# %d images averaged; d_min= %.2f" % (len(bkgpix_in), prof.d_min))
+    keys = (["n", "std", "median"] if show_all else []) + list(percentiles)
+    if keys: print("#   dmax    dmin mean %s" % " ".join([str(k) if k in ("n", "std", "median") else "p%g" % k for k in keys]))
+    for i in range(nbins):
+        line = "%7.2f %7.2f %.4f" % (dmaxs[i], dmins[i], stats["mean"][i])
+        for k in keys:
+            line += " %d" % stats[k][i] if k == "n" else " %.4f" % stats[k][i]
+        print(line)
+# run()
 
 if __name__ == "__main__":
-    imgin = sys.argv[1]
-    xparm = os.path.join(os.path.dirname(imgin), "XPARM.XDS")
-    run(imgin, xparm, 100)
+    import iotbx.phil
+
+    cmdline = iotbx.phil.process_command_line(args=sys.argv[1:],
+                                              master_string=master_params_str)
+    params = cmdline.work.extract()
+    imgin = cmdline.remaining_args
+    if not imgin:
+        print("Usage: %s BKGPIX.cbf [more BKGPIX.cbf..] [parameters]" % os.path.basename(sys.argv[0]))
+        iotbx.phil.parse(master_params_str).show(prefix="  ", attributes_level=1)
+        quit()
+
+    xparm = params.xparm
+    if xparm is None: xparm = os.path.join(os.path.dirname(imgin[0]), "XPARM.XDS")
+    run(imgin, xparm, params.nbins, d_min=params.d_min, mask_in=params.mask,
+        percentiles=params.percentiles, show_all=params.show_all)
@@ -9,8 +9,8 @@ from __future__ import print_function
 from __future__ import unicode_literals
 import iotbx.phil
 from cctbx.array_family import flex
-from libtbx import easy_mp
 from yamtbx.util import read_path_list
+from yamtbx.dataproc.cc_matrix import CCMatrix
 from yamtbx.dataproc.xds.xds_ascii import XDS_ASCII
 import os
 import numpy
@@ -53,17 +53,8 @@ def run(lstin, params):
         a = a.select(a.data()/a.sigmas()>=params.min_ios)
         arrays.append(a)
 
-    # Prep 
-    args = []
-    for i in range(len(arrays)-1):
-        for j in range(i+1, len(arrays)):
-            args.append((i,j))
-           
     # Calc all CC
-    worker = lambda x: calc_cc(arrays[x[0]], arrays[x[1]])
-    results = easy_mp.pool_map(fixed_func=worker,
-                               args=args,
-                               processes=params.nproc)
+    args, results = CCMatrix(arrays).all_pairs(nproc=params.nproc)
 
     # Make matrix
     mat = numpy.zeros(shape=(len(arrays), len(arrays)))
@@ -10,8 +10,10 @@ from mmtbx.scaling.absolute_scaling import kernel_normalisation
 from yamtbx import util
 from yamtbx.util.xtal import CellConstraints
 from yamtbx.dataproc.xds import xds_ascii
+from yamtbx.dataproc.cc_matrix import miller_index_keys
 
 import collections
+import numpy
 
 master_params_str = """\
 lstin = None
@@ -27,6 +29,12 @@ d_min = None
  .type = float
 d_max = None
  .type = float
+n_bins = None
+ .type = int
+ .help = "Number of resolution shells (of each dataset) for binned CC. Written in dat_binned_out"
+dat_binned_out = "cc_with_targets_binned.dat"
+ .type = path
+ .help = "Output file of binned CC"
 """
 
 def calc_cc(ari, arj):
@@ -38,6 +46,76 @@ def calc_cc(ari, arj):
       return float("nan"), ari.size()
 # calc_cc()
 
+class MultiTargetCC(object):
+    """
+    CC of a dataset with many targets at once, equivalent to calc_cc() for each target.
+    Indices of all targets are concatenated and mapped to a table of unique indices once; for each dataset, the table is
+    aligned with the dataset by one sorted search, and sums needed for CC are accumulated for each target
+    (and resolution bin) by numpy.bincount.
+    """
+    def __init__(self, target_arrays):
+        self.n_targets = len(target_arrays)
+        self.keys = numpy.concatenate([miller_index_keys(a.indices()) for a in target_arrays])
+        self.data = numpy.concatenate([a.data().as_numpy_array() for a in target_arrays])
+        self.target_id = numpy.repeat(numpy.arange(self.n_targets), [a.size() for a in target_arrays])
+        self.ukeys, self.uidx = numpy.unique(self.keys, return_inverse=True)
+    # __init__()
+
+    def align(self, iobs):
+        """
+        Returns indices of iobs, target ids and target values of common reflections (in the order of targets).
+        iobs must not have duplicated indices.
+        """
+        qkeys = miller_index_keys(iobs.indices())
+        qidx = numpy.zeros(self.ukeys.size, dtype=int) - 1 # index in iobs for each of unique keys
+        if self.ukeys.size > 0:
+            pos = numpy.minimum(numpy.searchsorted(self.ukeys, qkeys), self.ukeys.size-1)
+            found = self.ukeys[pos] == qkeys
+            qidx[pos[found]] = numpy.nonzero(found)[0]
+
+        qidx = qidx[self.uidx]
+        match = qidx >= 0
+        return qidx[match], self.target_id[match], self.data[match]
+    # align()
+
+    @staticmethod
+    def grouped_cc(group, x, y, n_groups, epsilon=1.e-15):
+        """
+        CC and number of pairs of x and y for each group (0..n_groups-1), as flex.linear_correlation()
+        (nan if not well defined).
+        """
+        n = numpy.bincount(group, minlength=n_groups)
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            mx = numpy.bincount(group, weights=x, minlength=n_groups) / n
+            my = numpy.bincount(group, weights=y, minlength=n_groups) / n
+            dx, dy = x - mx[group], y - my[group]
+            num = numpy.bincount(group, weights=dx*dy, minlength=n_groups)
+            den = numpy.sqrt(numpy.bincount(group, weights=dx**2, minlength=n_groups) *
+                             numpy.bincount(group, weights=dy**2, minlength=n_groups))
+            cc = numpy.where(den > numpy.abs(num*epsilon), num/den, numpy.nan)
+        cc[(num == 0) & (den == 0)] = 0.
+        cc[n == 0] = numpy.nan
+        return cc, n
+    # grouped_cc()
+
+    def calc(self, iobs, n_bins=None):
+        """
+        Returns CC and number of common reflections with each target.
+        If n_bins is given, also returns those in resolution bins of iobs (n_targets x n_bins) and the binner.
+        """
+        qidx, tid, y = self.align(iobs)
+        x = iobs.data().as_numpy_array()[qidx]
+        cc, nref = self.grouped_cc(tid, x, y, self.n_targets)
+        if n_bins is None: return cc, nref
+
+        binner = iobs.setup_binner(n_bins=n_bins)
+        bins = numpy.array(binner.bin_indices(), dtype=int)[qidx] - 1 # 0 is for outside of d_max
+        sel = (bins >= 0) & (bins < n_bins)
+        cc_b, nref_b = self.grouped_cc(tid[sel]*n_bins + bins[sel], x[sel], y[sel], self.n_targets*n_bins)
+        return cc, nref, cc_b.reshape(self.n_targets, n_bins), nref_b.reshape(self.n_targets, n_bins), binner
+    # calc()
+# class MultiTargetCC
+
 def read_target_files(target_files, d_min, d_max, normalization, log_out):
     ret = collections.OrderedDict()
     for i, f in enumerate(target_files):
@@ -77,7 +155,12 @@ def run(params, target_files):
     ofs.write("file %s " % cellcon.get_label_for_free_params())
     ofs.write(" ".join(["cc.%.3d nref.%.3d"%(x,x) for x in range(len(targets))]))
     ofs.write("\n")
-    
+
+    mtcc = MultiTargetCC(list(targets.values()))
+    if params.n_bins is not None:
+        ofs_b = open(params.dat_binned_out, "w")
+        ofs_b.write("file target bin d_max d_min cc nref\n")
+
     for xac_file in xac_files:
         print("reading", xac_file)
         xac = xds_ascii.XDS_ASCII(xac_file)
@@ -93,14 +176,22 @@ def run(params, target_files):
             except:
                 fail_flag = True
 
-        for i, ta in enumerate(targets.values()):
-            if fail_flag:
-                ofs.write(" % .4f %4d" % cc_num)
-            else:
-                cc_num = calc_cc(iobs, ta)
-                ofs.write(" % .4f %4d" % cc_num)
-            
+        if fail_flag:
+            for i in range(len(targets)): ofs.write(" % .4f %4d" % (float("nan"), 0))
+            ofs.write("\n")
+            continue
+
+        ret = mtcc.calc(iobs, params.n_bins)
+        for i in range(len(targets)):
+            ofs.write(" % .4f %4d" % (ret[0][i], ret[1][i]))
         ofs.write("\n")
+
+        if params.n_bins is not None:
+            cc_b, nref_b, binner = ret[2:]
+            for i in range(len(targets)):
+                for j in range(params.n_bins):
+                    d_max, d_min = binner.bin_d_range(j+1)
+                    ofs_b.write("%s %.3d %2d %7.3f %7.3f % .4f %4d\n" % (xac_file, i, j+1, d_max, d_min, cc_b[i,j], nref_b[i,j]))
 # run()
 
 if __name__ == "__main__":
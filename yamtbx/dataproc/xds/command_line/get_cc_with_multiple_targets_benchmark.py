@@ -0,0 +1,137 @@
+#!/usr/bin/env yamtbx.python
+"""
+(c) RIKEN 2015. All rights reserved.
+Author: Keitaro Yamashita
+
+This software is released under the new BSD License; see LICENSE.
+"""
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+"""
+get_cc_with_multiple_targets_benchmark.py : time MultiTargetCC.calc() against a loop of calc_cc() over targets
+(as get_cc_with_multiple_targets.py did before) on synthetic data, and check that the outputs are identical.
+
+Usage: yamtbx.python get_cc_with_multiple_targets_benchmark.py [n_targets=100] [n_datasets=3] [n_bins=10] [d_min=1.8]
+"""
+
+import sys
+import time
+import numpy
+
+import iotbx.phil
+from cctbx import crystal
+from cctbx import miller
+from cctbx.array_family import flex
+
+from yamtbx.dataproc.xds.command_line.get_cc_with_multiple_targets import calc_cc, MultiTargetCC
+
+master_params_str = """\
+n_targets = 100
+ .type = int(value_min=1)
+n_datasets = 3
+ .type = int(value_min=1)
+ .help = "Number of query datasets"
+n_bins = 10
+ .type = int(value_min=1)
+ .help = "Number of resolution shells for binned CC"
+d_min = 1.8
+ .type = float
+seed = 1234
+ .type = int
+"""
+
+def make_arrays(params):
+    """
+    Targets and query datasets sharing a common true intensity with different noise and completeness.
+    Two targets are special: an empty one (no common reflections) and one with constant values.
+    """
+    rs = numpy.random.RandomState(params.seed)
+    symm = crystal.symmetry((70, 80, 90, 90, 90, 90), "P212121")
+    mset = miller.build_set(symm, anomalous_flag=False, d_min=params.d_min)
+    true_i = rs.exponential(1000., mset.size())
+
+    def make_one(frac, noise):
+        sel = rs.random_sample(mset.size()) < frac
+        data = true_i[sel] + rs.normal(0, noise, sel.sum())
+        return mset.select(flex.bool(sel)).array(data=flex.double(data))
+
+    targets = [make_one(0.5 + 0.5*rs.random_sample(), rs.uniform(100, 3000)) for i in range(params.n_targets)]
+    if params.n_targets > 2:
+        targets[1] = make_one(0., 100.) # empty
+        targets[2] = targets[2].customized_copy(data=flex.double(targets[2].size(), 10.))
+
+    queries = [make_one(0.9, rs.uniform(100, 1000)) for i in range(params.n_datasets)]
+    return targets, queries
+# make_arrays()
+
+def calc_binned_with_loop(iobs, targets, n_bins):
+    """
+    Same results as binned ones of MultiTargetCC.calc(iobs, n_bins) with a loop of calc_cc().
+    """
+    binner = iobs.setup_binner(n_bins=n_bins)
+    iobs_b = [iobs.select(binner.selection(j+1)) for j in range(n_bins)]
+    return [[calc_cc(x, t) for x in iobs_b] for t in targets]
+# calc_binned_with_loop()
+
+def format_results(cc, nref):
+    # as in cc_with_targets.dat and cc_with_targets_binned.dat
+    return " ".join(["% .4f %4d" % (c, n) for c, n in zip(cc, nref)])
+# format_results()
+
+def run(params, out=sys.stdout):
+    targets, queries = make_arrays(params)
+    print("%d targets (%d - %d reflections), %d query datasets (%d reflections on average)" % (len(targets),
+                                                                                            min([t.size() for t in targets]),
+                                                                                            max([t.size() for t in targets]),
+                                                                                            len(queries),
+                                                                                            numpy.mean([q.size() for q in queries])),
+          file=out)
+
+    t0 = time.time()
+    mtcc = MultiTargetCC(targets)
+    t_setup = time.time() - t0
+
+    t_loop, t_loop_b, t_multi, t_multi_b = 0., 0., 0., 0.
+    n_diff = 0
+    for iobs in queries:
+        t0 = time.time()
+        ret = [calc_cc(iobs, t) for t in targets]
+        t_loop += time.time() - t0
+
+        t0 = time.time()
+        ret_b = calc_binned_with_loop(iobs, targets, params.n_bins)
+        t_loop_b += time.time() - t0
+
+        t0 = time.time()
+        cc, nref = mtcc.calc(iobs)
+        t_multi += time.time() - t0
+
+        t0 = time.time()
+        cc2, nref2, cc_b, nref_b, binner = mtcc.calc(iobs, params.n_bins)
+        t_multi_b += time.time() - t0
+
+        str_loop = format_results(*zip(*ret))
+        if format_results(cc, nref) != str_loop or format_results(cc2, nref2) != str_loop:
+            n_diff += 1
+        for i in range(len(targets)):
+            if format_results(cc_b[i], nref_b[i]) != format_results(*zip(*ret_b[i])):
+                n_diff += 1
+
+    n = len(queries)
+    print("Time per query dataset (sec):", file=out)
+    print(" %-36s %8.3f" % ("calc_cc() loop", t_loop/n), file=out)
+    print(" %-36s %8.3f" % ("MultiTargetCC.calc()", t_multi/n), file=out)
+    print(" %-36s %8.3f" % ("calc_cc() loop in %d bins" % params.n_bins, t_loop_b/n), file=out)
+    print(" %-36s %8.3f" % ("MultiTargetCC.calc(n_bins=%d) (all)" % params.n_bins, t_multi_b/n), file=out)
+    print(" %-36s %8.3f" % ("MultiTargetCC setup (once)", t_setup), file=out)
+    print("Outputs identical: %s" % ("yes" if n_diff == 0 else "NO (%d differences)" % n_diff), file=out)
+    return n_diff == 0
+# run()
+
+if __name__ == "__main__":
+    cmdline = iotbx.phil.process_command_line(args=sys.argv[1:],
+                                              master_string=master_params_str)
+    params = cmdline.work.extract()
+    if not run(params): sys.exit(1)
@@ -0,0 +1,171 @@
+#!/usr/bin/env yamtbx.python
+"""
+(c) RIKEN 2015. All rights reserved.
+Author: Keitaro Yamashita
+
+This software is released under the new BSD License; see LICENSE.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+"""
+spot_xds_benchmark.py : time parsing and queries of SpotXds (idxreflp.py) on a synthetic SPOT.XDS,
+compared with the line-by-line parser and per-spot loops over items (as SpotXds did before it kept columns).
+Results of both are checked to be the same.
+
+Usage: yamtbx.python spot_xds_benchmark.py [n_spots=1000000] [ncol=7] [spot_xds=SPOT.XDS]
+If spot_xds exists, it is used instead of generating one.
+"""
+
+import os
+import sys
+import time
+import math
+import shutil
+import tempfile
+import numpy
+
+import iotbx.phil
+from yamtbx.dataproc.xds.idxreflp import SpotXds
+
+master_params_str = """\
+spot_xds = None
+ .type = path
+ .help = "SPOT.XDS to use. If not given or not exists, a synthetic one is written (and removed in the end if not given)"
+n_spots = 1000000
+ .type = int(value_min=1)
+ncol = *7 4 5 8
+ .type = choice(multi=False)
+ .help = "Number of columns of synthetic SPOT.XDS"
+n_frames = 3600
+ .type = int(value_min=1)
+seed = 1234
+ .type = int
+"""
+
+geom = (1.0, 1231.5, 1263.5, 0.172, 200.) # wavelength, orgx, orgy, qx, distance
+
+def write_spot_xds(spot_xds, n_spots, ncol, n_frames, seed):
+    """
+    Spots randomly on a Pilatus 6M-sized detector; about a half is indexed (if hkl is written).
+    """
+    rs = numpy.random.RandomState(seed)
+    cols = [rs.uniform(0, 2463, n_spots), rs.uniform(0, 2527, n_spots),
+            numpy.sort(rs.uniform(0, n_frames-0.01, n_spots)), # z not rounded up to n_frames
+            rs.exponential(500., n_spots)]
+    fmt = ["%.2f", "%.2f", "%.2f", "%.1f"]
+    if ncol in (5, 8):
+        cols.append(rs.randint(1, 61, n_spots))
+        fmt.append("%d")
+    if ncol in (7, 8):
+        hkl = rs.randint(-40, 41, (n_spots, 3))
+        hkl[rs.random_sample(n_spots) < 0.5] = 0
+        cols.extend(hkl.T)
+        fmt.extend(["%d"]*3)
+
+    numpy.savetxt(spot_xds, numpy.column_stack(cols), fmt=str(" ".join(fmt)))
+# write_spot_xds()
+
+# Per-spot loops over items, as in SpotXds before it kept columns
+def is_indexed(hkl): return not (hkl[0] is None or all([h==0 for h in hkl]))
+
+def loop_indexed_and_unindexed_by_frame(items):
+    data = {}
+    for xyz, intensity, iseg, hkl in items:
+        frame = int(xyz[2])+1
+        data.setdefault(frame, [0, 0])[0 if is_indexed(hkl) else 1] += 1
+    return sorted(data.items())
+# loop_indexed_and_unindexed_by_frame()
+
+def loop_spots_by_frame(items):
+    data = {}
+    for xyz, intensity, iseg, hkl in items:
+        frame = int(xyz[2])+1
+        data[frame] = data.get(frame, 0) + 1
+    return data
+# loop_spots_by_frame()
+
+def loop_indexed_and_unindexed_by_frame_on_detector(items):
+    data = {"indexed": {}, "unindexed": {}}
+    for xyz, intensity, iseg, hkl in items:
+        data["indexed" if is_indexed(hkl) else "unindexed"].setdefault(int(xyz[2])+1, []).append(xyz[:2])
+    return data
+# loop_indexed_and_unindexed_by_frame_on_detector()
+
+def loop_indexed_and_unindexed_on_detector(items, calc_d):
+    data = {"indexed": [], "unindexed": []}
+    for xyz, intensity, iseg, hkl in items:
+        data["indexed" if is_indexed(hkl) else "unindexed"].append(xyz[:2] + (calc_d(*xyz[:2]),))
+    return data
+# loop_indexed_and_unindexed_on_detector()
+
+def same_with_d(a, b):
+    # resolutions may differ by rounding (numpy vs math)
+    if len(a) != len(b): return False
+    if len(a) == 0: return True
+    a, b = numpy.array(a), numpy.array(b)
+    return numpy.array_equal(a[:,:2], b[:,:2]) and numpy.allclose(a[:,2], b[:,2], rtol=1e-12, atol=0)
+# same_with_d()
+
+def run(params, out=sys.stdout):
+    tmpdir = None
+    spot_xds = params.spot_xds
+    if spot_xds is None or not os.path.isfile(spot_xds):
+        if spot_xds is None:
+            tmpdir = tempfile.mkdtemp(prefix="spot_xds_benchmark")
+            spot_xds = os.path.join(tmpdir, "SPOT.XDS")
+        print("Writing %d spots with %s columns to %s" % (params.n_spots, params.ncol, spot_xds), file=out)
+        write_spot_xds(spot_xds, params.n_spots, int(params.ncol), params.n_frames, params.seed)
+
+    try:
+        times, same = [], []
+        t0 = time.time()
+        sx = SpotXds(spot_xds)
+        t_new = time.time() - t0
+        sx.set_geometry(*geom)
+
+        t0 = time.time()
+        sx_lines = SpotXds(None)
+        sx_lines.parse_lines(open(spot_xds).read().splitlines())
+        t_old = time.time() - t0
+        times.append(("parse", t_old, t_new))
+        same.append(("parse", sx.items == sx_lines.items))
+        print("%d spots in %d frames" % (len(sx.frames), len(sx.frame_numbers)), file=out)
+
+        items = sx_lines.items
+        for name, func_loop, func_new, cmp in (("indexed_and_unindexed_by_frame",
+                                                lambda: loop_indexed_and_unindexed_by_frame(items),
+                                                sx.indexed_and_unindexed_by_frame, None),
+                                               ("spots_by_frame",
+                                                lambda: loop_spots_by_frame(items),
+                                                sx.spots_by_frame, None),
+                                               ("indexed_and_unindexed_by_frame_on_detector",
+                                                lambda: loop_indexed_and_unindexed_by_frame_on_detector(items),
+                                                sx.indexed_and_unindexed_by_frame_on_detector, None),
+                                               ("indexed_and_unindexed_on_detector (with d)",
+                                                lambda: loop_indexed_and_unindexed_on_detector(items, sx.calc_d),
+                                                sx.indexed_and_unindexed_on_detector,
+                                                lambda a, b: all([same_with_d(a[k], b[k]) for k in ("indexed", "unindexed")]))):
+            t0 = time.time()
+            ret_old = func_loop()
+            t_old = time.time() - t0
+            t0 = time.time()
+            ret_new = func_new()
+            t_new = time.time() - t0
+            times.append((name, t_old, t_new))
+            same.append((name, cmp(ret_old, ret_new) if cmp else ret_old == ret_new))
+
+        print("%-45s %10s %10s %s" % ("", "loop", "columns", "same"), file=out)
+        for (name, t_old, t_new), (_, s) in zip(times, same):
+            print("%-45s %10.3f %10.3f %s" % (name, t_old, t_new, "yes" if s else "NO"), file=out)
+        print("(times in sec)", file=out)
+        return all([s for _, s in same])
+    finally:
+        if tmpdir: shutil.rmtree(tmpdir)
+# run()
+
+if __name__ == "__main__":
+    cmdline = iotbx.phil.process_command_line(args=sys.argv[1:],
+                                              master_string=master_params_str)
+    params = cmdline.work.extract()
+    if not run(params): sys.exit(1)
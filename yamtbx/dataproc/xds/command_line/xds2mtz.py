@@ -17,8 +17,12 @@ When FRIDEL'S_LAW= FALSE,
 When FRIDEL'S_LAW= TRUE,
  MTZ columns will be IMEAN, FP
 
+By default, MTZ file is made using external programs (xdsconv, f2mtz, cad, unique, ..).
+With --in-process option, MTZ file is made in-process using cctbx (French-Wilson method for I to F).
+See xds2mtz_benchmark.py to compare the two.
+
 With -x option, phenix.xtriage is executed automatically.
-With -t option, ctruncate is used for converting I to F.
+With -t option, ctruncate is used for converting I to F (--in-process is ignored).
 """
 
 import sys, os, optparse, subprocess, re
@@ -30,6 +34,9 @@ from yamtbx.dataproc.command_line import copy_free_R_flag
 from yamtbx.dataproc.command_line import create_free_R_flag
 import iotbx.mtz
 from cctbx import sgtbx
+from cctbx import crystal
+from cctbx import miller
+from cctbx.array_family import flex
 
 def run_xtriage_in_module_if_possible(args,  wdir):
     try:
@@ -280,18 +287,93 @@ end
 
 # xds2mtz_work()
 
-
-def add_multi(xds_file, workmtz, dmin=None, dmax=None, force_anomalous=False):
+def get_isym(f_anom):
+    """
+    ISYM column for merged anomalous array, as in output of xdsconv or ctruncate:
+    0 if both Bijvoet mates (or centric), 1 if only F(+), 2 if only F(-) is present.
+    """
+    mean_set = f_anom.average_bijvoet_mates()
+    acen = f_anom.select_acentric()
+    acen_asu = acen.customized_copy(anomalous_flag=False).map_to_asu()
+    sel_minus = (acen.indices().as_vec3_double() - acen_asu.indices().as_vec3_double()).norms() > 0
+
+    isym = flex.int(mean_set.size(), 0)
+    has_plus, has_minus = flex.bool(mean_set.size(), False), flex.bool(mean_set.size(), False)
+    for sel, has in ((~sel_minus, has_plus), (sel_minus, has_minus)):
+        pairs = miller.match_indices(mean_set.indices(), acen_asu.indices().select(sel)).pairs()
+        has.set_selected(pairs.column(0), True)
+
+    isym.set_selected(has_plus & ~has_minus, 1)
+    isym.set_selected(~has_plus & has_minus, 2)
+    return mean_set.customized_copy(data=isym, sigmas=None)
+# get_isym()
+
+def xds2mtz_in_process(refl, mtzout, sg, wavelen, logout, anom_flag, dmin=None, dmax=None, with_multiplicity=False):
+    """
+    Make MTZ file equivalent to that by xds2mtz_work() from a single parse of XDS_ASCII file, without external programs.
+    Columns: IMEAN,SIGIMEAN,F,SIGF (+ I(+),SIGI(+),I(-),SIGI(-),F(+),SIGF(+),F(-),SIGF(-),DANO,SIGDANO,ISYM if anom_flag)
+             (+ MULTIPLICITY if with_multiplicity).
+    Intensities are merged in the original space group, and F is estimated by French-Wilson method.
+    Missing reflections up to the highest resolution are included like CCP4 unique.
+    """
     from yamtbx.dataproc.xds import xds_ascii
 
-    print("Adding multiplicity for each reflection")
-
-    xac = xds_ascii.XDS_ASCII(xds_file)
-    iobs = xac.i_obs(anomalous_flag=True if force_anomalous else None)
+    logout.write("reading %s\n" % refl)
+    logout.flush()
+    xac = xds_ascii.XDS_ASCII(refl, i_only=True)
+    iobs = xac.i_obs(anomalous_flag=anom_flag)
     iobs = iobs.resolution_filter(d_min=float(dmin) if dmin is not None else None,
                                   d_max=float(dmax) if dmax is not None else None)
-    iobs = iobs.select(iobs.sigmas() > 0).map_to_asu()
+    iobs = iobs.select(iobs.sigmas() > 0).map_to_asu() # negative sigma means rejected
+
+    symm = crystal.symmetry(unit_cell=iobs.unit_cell(), space_group_symbol=sg)
+    arrays = [] # [(array, root label, column types), ..]
     
+    logout.write("merging intensities\n")
+    logout.flush()
+    i_mean = iobs.as_non_anomalous_array().merge_equivalents(use_internal_variance=False).array()
+    arrays.append((i_mean, "IMEAN", None))
+    if anom_flag:
+        i_anom = iobs.merge_equivalents(use_internal_variance=False).array()
+        arrays.append((i_anom, "I", None))
+
+    logout.write("estimating F by French-Wilson method\n")
+    logout.flush()
+    arrays.append((i_mean.french_wilson(log=logout), "F", None))
+    if anom_flag:
+        f_anom = i_anom.french_wilson(log=logout)
+        arrays.append((f_anom, "F", None))
+        arrays.append((f_anom.anomalous_differences(), "DANO", "DQ"))
+        arrays.append((get_isym(f_anom), "ISYM", "Y"))
+
+    if with_multiplicity:
+        arrays.append((get_multiplicity(iobs), "MULTIPLICITY", None))
+
+    # change space group if requested and generate all unique reflections
+    arrays = [(a.customized_copy(crystal_symmetry=symm).map_to_asu(), l, t) for a, l, t in arrays]
+    arrays[0] = (arrays[0][0].complete_array(d_min=i_mean.d_min(), new_data_value=float("nan"),
+                                             new_sigmas_value=float("nan")),) + arrays[0][1:]
+
+    logout.write("writing %s\n" % mtzout)
+    logout.flush()
+    mtz_dataset = None
+    for a, label, col_types in arrays:
+        if mtz_dataset is None:
+            mtz_dataset = a.as_mtz_dataset(column_root_label=label, column_types=col_types,
+                                           crystal_name="XDS", project_name="XDS", dataset_name="XDS",
+                                           wavelength=float(wavelen.split()[0]))
+        else:
+            mtz_dataset.add_miller_array(a, column_root_label=label, column_types=col_types)
+
+    mtz_dataset.mtz_object().write(file_name=mtzout+".tmp")
+    os.rename(mtzout+".tmp", mtzout)
+# xds2mtz_in_process()
+
+def get_multiplicity(iobs):
+    """
+    Multiplicity of each unique reflection in iobs (unmerged, already mapped to ASU),
+    after rejecting reflections whose merged <I>/sd(<I>) < -3.
+    """
     merge = iobs.merge_equivalents(use_internal_variance=False)
     array_merged = merge.array()
     reject_sel = (array_merged.data() < -3*array_merged.sigmas())
@@ -300,10 +382,23 @@ def add_multi(xds_file, workmtz, dmin=None, dmax=None, force_anomalous=False):
     
     # merge again after rejection
     merge = iobs.merge_equivalents(use_internal_variance=False)
+    return merge.redundancies()
+# get_multiplicity()
+
+def add_multi(xds_file, workmtz, dmin=None, dmax=None, force_anomalous=False):
+    from yamtbx.dataproc.xds import xds_ascii
+
+    print("Adding multiplicity for each reflection")
+
+    xac = xds_ascii.XDS_ASCII(xds_file, i_only=True)
+    iobs = xac.i_obs(anomalous_flag=True if force_anomalous else None)
+    iobs = iobs.resolution_filter(d_min=float(dmin) if dmin is not None else None,
+                                  d_max=float(dmax) if dmax is not None else None)
+    iobs = iobs.select(iobs.sigmas() > 0).map_to_asu()
 
     mtz_object = iotbx.mtz.object(workmtz)
     crystals = mtz_object.crystals()
-    crystals[-1].datasets()[-1].add_miller_array(miller_array=merge.redundancies(), column_root_label="MULTIPLICITY")
+    crystals[-1].datasets()[-1].add_miller_array(miller_array=get_multiplicity(iobs), column_root_label="MULTIPLICITY")
     mtz_object.write(file_name=workmtz)
 # generate_multi()
 
@@ -347,7 +442,7 @@ def add_test_flag(workmtz, preferred_fraction=0.05, max_fraction=0.1, max_free=2
                            ccp4=ccp4_style, use_lattice_symmetry=use_lattice_symmetry, log_out=log_out)
 # add_test_flag()
 
-def xds2mtz(xds_file, dir_name, hklout=None, run_xtriage=False, run_ctruncate=False, dmin=None, dmax=None, force_anomalous=False, with_multiplicity=False, space_group=None, flag_source=None, add_flag=False):
+def xds2mtz(xds_file, dir_name, hklout=None, run_xtriage=False, run_ctruncate=False, dmin=None, dmax=None, force_anomalous=False, with_multiplicity=False, space_group=None, flag_source=None, add_flag=False, use_external=True):
     if hklout is None:
         hklout = os.path.splitext(os.path.basename(xds_file))[0] + ".mtz"
 
@@ -406,14 +501,26 @@ def xds2mtz(xds_file, dir_name, hklout=None, run_xtriage=False, run_ctruncate=Fa
 
     ##
     # convert to MTZ
-    xds2mtz_work(xds_file,
-                 mtzout=os.path.join(dir_name, hklout),
-                 sg=str(sginfo).replace(" ",""),
-                 wavelen=header.get("X-RAY_WAVELENGTH","0"),
-                 logout=logout,
-                 anom_flag=anom_flag,
-                 use_ctruncate=run_ctruncate,
-                 dmin=dmin, dmax=dmax)
+    if run_ctruncate: use_external = True # ctruncate is only available in external programs
+
+    if use_external:
+        xds2mtz_work(xds_file,
+                     mtzout=os.path.join(dir_name, hklout),
+                     sg=str(sginfo).replace(" ",""),
+                     wavelen=header.get("X-RAY_WAVELENGTH","0"),
+                     logout=logout,
+                     anom_flag=anom_flag,
+                     use_ctruncate=run_ctruncate,
+                     dmin=dmin, dmax=dmax)
+    else:
+        xds2mtz_in_process(xds_file,
+                           mtzout=os.path.join(dir_name, hklout),
+                           sg=str(sginfo).replace(" ",""),
+                           wavelen=header.get("X-RAY_WAVELENGTH","0"),
+                           logout=logout,
+                           anom_flag=anom_flag,
+                           dmin=dmin, dmax=dmax,
+                           with_multiplicity=with_multiplicity)
 
     if run_xtriage:
         print("Running xtriage..")
@@ -421,7 +528,7 @@ def xds2mtz(xds_file, dir_name, hklout=None, run_xtriage=False, run_ctruncate=Fa
         if anom_flag: args.append('input.xray_data.obs_labels="I(+),SIGI(+),I(-),SIGI(-)"')
         run_xtriage_in_module_if_possible(args=args, wdir=dir_name)
 
-    if with_multiplicity:
+    if with_multiplicity and use_external:
         add_multi(xds_file, os.path.join(dir_name, hklout),
                   dmin=dmin, dmax=dmax, force_anomalous=anom_flag)
 
@@ -438,6 +545,7 @@ if __name__ == "__main__":
     parser.add_option("--dir","-d", action="store", type=str, dest="dir", default="ccp4",
                       help="output directory")
     parser.add_option("--xtriage","-x", action="store_true", dest="run_xtriage", help="run phenix.xtriage")
+    parser.add_option("--in-process", action="store_true", dest="in_process", help="convert without xdsconv, f2mtz, cad, unique, etc. (faster; not with --truncate)")
     parser.add_option("--truncate","-t", action="store_true", dest="run_ctruncate", help="use ctruncate to estimate F")
     parser.add_option("--multiplicity","-m", action="store_true", dest="make_mtzmulti", help="Add multiplicity info")
     parser.add_option("--anomalous","-a", action="store_true", dest="anomalous", help="force anomalous")
@@ -467,5 +575,5 @@ if __name__ == "__main__":
             dmin=opts.dmin, dmax=opts.dmax, force_anomalous=opts.anomalous,
             with_multiplicity=opts.make_mtzmulti,
             flag_source=opts.flag_source, add_flag=opts.add_flag,
-            space_group=opts.sg)
+            space_group=opts.sg, use_external=not opts.in_process)
 
@@ -0,0 +1,131 @@
+#!/usr/bin/env yamtbx.python
+"""
+(c) RIKEN 2015. All rights reserved.
+Author: Keitaro Yamashita
+
+This software is released under the new BSD License; see LICENSE.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+"""
+xds2mtz_benchmark.py : compare run time and results of xds2mtz.py with external programs
+(xdsconv, f2mtz, cad, unique, ..) and with in-process conversion, e.g. for a large XSCALE output.
+
+Usage: yamtbx.python xds2mtz_benchmark.py XSCALE.HKL [workdir=] [repeat=] [with_multiplicity=] [run_ctruncate=]
+"""
+
+import os
+import sys
+import time
+import shutil
+
+import iotbx.phil
+import iotbx.mtz
+from cctbx.array_family import flex
+
+from yamtbx.dataproc.xds.command_line import xds2mtz
+
+master_params_str = """\
+xds_file = None
+ .type = path
+ .help = "XDS_ASCII.HKL or XSCALE output"
+workdir = xds2mtz_benchmark
+ .type = path
+ .help = "Working directory. Must not exist"
+repeat = 1
+ .type = int(value_min=1)
+ .help = "Number of runs for each method. The shortest time is reported."
+with_multiplicity = True
+ .type = bool
+force_anomalous = False
+ .type = bool
+run_ctruncate = False
+ .type = bool
+ .help = "Use ctruncate in the external conversion"
+keep_files = False
+ .type = bool
+ .help = "Keep MTZ files and logs in workdir"
+"""
+
+def compare_mtz(mtz_ref, mtz_test, out=sys.stdout):
+    """
+    Compare columns of the same labels. Reports number of reflections with defined values in each file,
+    number of common ones, CC and max absolute difference of values.
+    """
+    arrays_ref = dict([(a.info().label_string(), a) for a in iotbx.mtz.object(mtz_ref).as_miller_arrays()])
+    arrays_test = dict([(a.info().label_string(), a) for a in iotbx.mtz.object(mtz_test).as_miller_arrays()])
+
+    print("%-45s %8s %8s %8s %8s %10s" % ("labels", "n.ext", "n.inproc", "n.common", "CC", "max.diff"), file=out)
+    for label in sorted(arrays_ref):
+        if label not in arrays_test:
+            print("%-45s (only in external)" % label, file=out)
+            continue
+
+        a1, a2 = [x.select(x.data().as_double() == x.data().as_double()) # remove NaN
+                  for x in (arrays_ref[label], arrays_test[label])]
+        c1, c2 = a1.common_sets(a2, assert_is_similar_symmetry=False)
+        d1, d2 = c1.data().as_double(), c2.data().as_double()
+        if c1.size() > 1:
+            corr = flex.linear_correlation(d1, d2)
+            cc = "%8.5f" % corr.coefficient() if corr.is_well_defined() else "nan"
+            maxdiff = "%10.3e" % flex.max(flex.abs(d1 - d2))
+        else:
+            cc, maxdiff = "nan", "nan"
+
+        print("%-45s %8d %8d %8d %8s %10s" % (label, a1.size(), a2.size(), c1.size(), cc, maxdiff), file=out)
+
+    for label in sorted(set(arrays_test) - set(arrays_ref)):
+        print("%-45s (only in in-process)" % label, file=out)
+# compare_mtz()
+
+def run(params):
+    if os.path.exists(params.workdir):
+        print("Error: %s already exists." % params.workdir)
+        return
+
+    xds_file = os.path.abspath(params.xds_file)
+    print("File: %s (%.1f MB)" % (xds_file, os.path.getsize(xds_file)/1024.**2))
+    print()
+
+    times, mtzfiles = {}, {}
+    for method in ("external", "in-process"):
+        times[method] = []
+        for i in range(params.repeat):
+            wdir = os.path.join(params.workdir, "%s_%d" % (method, i))
+            t0 = time.time()
+            xds2mtz.xds2mtz(xds_file, dir_name=wdir, hklout="out.mtz",
+                            run_ctruncate=params.run_ctruncate and method == "external",
+                            force_anomalous=params.force_anomalous,
+                            with_multiplicity=params.with_multiplicity,
+                            use_external=method == "external")
+            times[method].append(time.time() - t0)
+            mtzfiles[method] = os.path.join(wdir, "out.mtz")
+
+    print()
+    print("Comparison of columns (external vs in-process):")
+    compare_mtz(mtzfiles["external"], mtzfiles["in-process"])
+
+    print()
+    print("Time (sec; best of %d):" % params.repeat)
+    for method in ("external", "in-process"):
+        print(" %-10s %8.2f" % (method, min(times[method])))
+    print(" speed-up   %8.2f" % (min(times["external"]) / max(1e-6, min(times["in-process"]))))
+
+    if not params.keep_files:
+        shutil.rmtree(params.workdir)
+# run()
+
+if __name__ == "__main__":
+    cmdline = iotbx.phil.process_command_line(args=sys.argv[1:],
+                                              master_string=master_params_str)
+    params = cmdline.work.extract()
+    if len(cmdline.remaining_args) > 0: params.xds_file = cmdline.remaining_args[0]
+
+    if params.xds_file is None:
+        print("Usage: %s XSCALE.HKL [workdir=] [repeat=] [with_multiplicity=] [run_ctruncate=]" % sys.argv[0])
+        print()
+        iotbx.phil.parse(master_params_str).show(prefix="  ", attributes_level=1)
+        quit()
+
+    run(params)
@@ -4,13 +4,11 @@
 Author: Keitaro Yamashita
 
 This software is released under the new BSD License; see LICENSE.
-"""
 
-"""
 Analyze overlapped spots due to non-merohedral twinning or multiple crystals.
 Give two XDS_ASCII.HKL files to this script.
-
-
+Reflections in the second file overlapped with any reflection in the first file are reported,
+and statistics and MTZ file (*_novl.mtz) are made from non-overlapped reflections.
 """
 from __future__ import division
 from __future__ import print_function
@@ -20,57 +18,118 @@ from cctbx import miller
 from cctbx.array_family import flex
 from iotbx.merging_statistics import dataset_statistics, filter_intensities_by_sigma
 from yamtbx.dataproc.xds import xds_ascii
+from libtbx import easy_mp
 from scipy import spatial
 import numpy
+import itertools
 import sys
 import os
 
-def run(files):
+master_params_str = """\
+dxy_max = 15
+ .type = float
+ .help = "Maximum distance on detector (pixel) between overlapped reflections"
+dz_max = 2.5
+ .type = float
+ .help = "Maximum distance in frame between overlapped reflections"
+frame_range = None
+ .type = ints(size=2)
+ .help = "Analyze only reflections of the second file in this frame range"
+n_bins = 10
+ .type = int
+ .help = "Number of resolution shells for overlap statistics"
+nproc = 1
+ .type = int
+show_pairs = False
+ .type = bool
+ .help = "Show all overlapped pairs"
+"""
+
+def find_overlaps(xyz1, xyz2, dxy_max, dz_max, nproc=1, chunk_size=100000):
+    """
+    Find all pairs of (i2, i1) where |z2-z1| < dz_max and (x2-x1)^2+(y2-y1)^2 < dxy_max^2.
+    xyz1, xyz2: numpy arrays of shape (n, 3)
+    z is scaled so that the condition is within a cube of dxy_max in Chebyshev distance,
+    which is queried by KD-tree for chunks of xyz2 (in parallel if nproc>1), and then the exact condition is checked.
+    Returns numpy arrays of i2 and i1 (in order of i2).
+    """
+    scale = numpy.array([1., 1., dxy_max/dz_max])
+    tree = spatial.cKDTree(xyz1*scale)
+
+    def work(se):
+        s, e = se
+        nb = tree.query_ball_point(xyz2[s:e]*scale, r=dxy_max, p=numpy.inf)
+        counts = numpy.array([len(x) for x in nb], dtype=int)
+        i2 = numpy.repeat(numpy.arange(s, e), counts)
+        i1 = numpy.fromiter(itertools.chain.from_iterable(nb), dtype=int, count=int(counts.sum()))
+        d = xyz1[i1] - xyz2[i2]
+        sel = (numpy.abs(d[:,2]) < dz_max) & (d[:,0]**2 + d[:,1]**2 < dxy_max**2)
+        return i2[sel], i1[sel]
+    # work()
+
+    chunks = [(s, min(s+chunk_size, len(xyz2))) for s in range(0, len(xyz2), chunk_size)]
+    results = easy_mp.pool_map(fixed_func=work, args=chunks, processes=nproc)
+    if not results: return numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int)
+    return numpy.concatenate([x[0] for x in results]), numpy.concatenate([x[1] for x in results])
+# find_overlaps()
+
+def show_overlap_stats(ovl, frames, ms, n_bins, out):
+    """
+    ovl: flex.bool (overlapped or not) for reflections in miller set ms; frames: their frame numbers
+    """
+    print("Overlaps by frame:", file=out)
+    print(" frame  nref  novl  %ovl", file=out)
+    frames = frames.as_numpy_array()
+    novl = numpy.bincount(frames, weights=ovl.as_numpy_array()).astype(int)
+    nref = numpy.bincount(frames)
+    for f in numpy.nonzero(nref)[0]:
+        print("%6d %5d %5d %5.1f" % (f, nref[f], novl[f], 100.*novl[f]/nref[f]), file=out)
+    print(file=out)
+
+    print("Overlaps by resolution:", file=out)
+    print("   dmax   dmin   nref   novl  %ovl", file=out)
+    binner = ms.setup_binner(n_bins=n_bins)
+    for i_bin in binner.range_used():
+        sel = binner.selection(i_bin)
+        n, no = sel.count(True), (ovl & sel).count(True)
+        dmax, dmin = binner.bin_d_range(i_bin)
+        print("%7.2f %6.2f %6d %6d %5.1f" % (dmax, dmin, n, no, 100.*no/n if n > 0 else float("nan")), file=out)
+    print(file=out)
+# show_overlap_stats()
+
+def run(files, params):
     assert len(files) == 2
 
     hkl1 = xds_ascii.XDS_ASCII(files[0], sys.stdout)
     hkl2 = xds_ascii.XDS_ASCII(files[1], sys.stdout)
 
+    if params.frame_range is not None:
+        fsel = (hkl2.iframe >= params.frame_range[0]) & (hkl2.iframe <= params.frame_range[1])
+        hkl2.remove_selection(~fsel)
+
     hkl1_points = numpy.column_stack((hkl1.xd, hkl1.yd, hkl1.zd))
-    tree1 = spatial.cKDTree(hkl1_points)
-
-    n_ovl, n_nonovl = 0, 0
-
-    novl_indices, novl_i, novl_sigma = flex.miller_index(), flex.double(), flex.double()
-
-    for i in range(len(hkl2.indices)):
-        x, y, z = hkl2.xd[i], hkl2.yd[i], hkl2.zd[i]
-        #if z > 180:
-        #    continue
-        dists, idxs = tree1.query((x,y,z), k=3, p=1)
-
-        overlaps = []
-        for dist, idx in zip(dists, idxs):
-            idx = int(idx)
-            xo, yo, zo = hkl1.xd[idx], hkl1.yd[idx], hkl1.zd[idx]
-
-            if abs(z-zo) < 2.5 and (xo-x)**2+(yo-y)**2 < 15**2: # FIXME MAGIC NUMBER!
-                overlaps.append((dist,idx))
-
-        if len(overlaps) == 0:
-            novl_indices.append(hkl2.indices[i])
-            novl_i.append(hkl2.iobs[i])
-            novl_sigma.append(hkl2.sigma_iobs[i])
-            n_nonovl += 1
-        else:
-            print(hkl2.indices[i], x, y, z)
-            for dist, idx in overlaps:
-                xo, yo, zo = hkl1.xd[idx], hkl1.yd[idx], hkl1.zd[idx]
-                print(hkl1.indices[idx], xo, yo, zo)
-                print(dist, idx)
-            print()
+    hkl2_points = numpy.column_stack((hkl2.xd, hkl2.yd, hkl2.zd))
+
+    idx2, idx1 = find_overlaps(hkl1_points, hkl2_points, params.dxy_max, params.dz_max, nproc=params.nproc)
+    ovl = flex.bool((numpy.bincount(idx2, minlength=len(hkl2_points)) > 0).tolist())
+
+    if params.show_pairs:
+        for i, j in zip(idx2, idx1):
+            i, j = int(i), int(j)
+            d = hkl1_points[j] - hkl2_points[i]
+            print(hkl2.indices[i], hkl2.xd[i], hkl2.yd[i], hkl2.zd[i], "-", hkl1.indices[j], hkl1.xd[j], hkl1.yd[j], hkl1.zd[j],
+                  "dist= %.2f" % numpy.sqrt(d[0]**2+d[1]**2))
+        print()
 
-    print()
     n_ref = len(hkl2.indices)
-    print("%.2f%% overlap!" % (100.*(n_ref-n_nonovl)/n_ref))
+    print("%d pairs found" % len(idx2))
+    print("%.2f%% overlap!" % (100.*ovl.count(True)/n_ref))
+    print()
 
-    novl_array = miller.array(miller_set=miller.set(crystal_symmetry=hkl2.symm, indices=novl_indices),
-                              data=novl_i, sigmas=novl_sigma)
+    show_overlap_stats(ovl, hkl2.iframe, hkl2.as_miller_set(anomalous_flag=False), params.n_bins, sys.stdout)
+
+    novl_array = miller.array(miller_set=miller.set(crystal_symmetry=hkl2.symm, indices=hkl2.indices.select(~ovl)),
+                              data=hkl2.iobs.select(~ovl), sigmas=hkl2.sigma_iobs.select(~ovl)).set_observation_type_xray_intensity()
 
     stats = dataset_statistics(novl_array, anomalous=False, sigma_filtering="xds")
     stats.show(out=sys.stdout)
@@ -82,10 +141,20 @@ def run(files):
     filtr = filter_intensities_by_sigma(novl_array, "xds")
     hklout = os.path.splitext(os.path.basename(files[1]))[0] + "_novl.mtz"
     filtr.array_merged.set_observation_type_xray_intensity().as_mtz_dataset(column_root_label="IMEAN").mtz_object().write(hklout)
+# run()
 
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print("Usage: %s XDS_ASCII.HKL.1 XDS_ASCII.HKL.2" % sys.argv[0])
+    import iotbx.phil
+
+    cmdline = iotbx.phil.process_command_line(args=sys.argv[1:],
+                                              master_string=master_params_str)
+    params = cmdline.work.extract()
+    files = cmdline.remaining_args
+
+    if len(files) < 2:
+        print("Usage: %s XDS_ASCII.HKL.1 XDS_ASCII.HKL.2 [parameters]" % sys.argv[0])
+        print()
+        iotbx.phil.parse(master_params_str).show(prefix="  ", attributes_level=1)
         quit()
 
-    run(sys.argv[1:])
+    run(files, params)
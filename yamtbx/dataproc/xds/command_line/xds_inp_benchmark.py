@@ -0,0 +1,103 @@
+#!/usr/bin/env yamtbx.python
+"""
+(c) RIKEN 2015. All rights reserved.
+Author: Keitaro Yamashita
+
+This software is released under the new BSD License; see LICENSE.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+"""
+xds_inp_benchmark.py : time the per-dataset sequence of XDS.INP edits made by xds_sequence() in run_all_xds_simple,
+with modify_xdsinp() (XDS.INP parsed and written at each edit) and with XdsInp (parsed once, written before each XDS run),
+and check that the resulting files are identical.
+
+Usage: yamtbx.python xds_inp_benchmark.py XDS.INP [repeat=100]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import iotbx.phil
+from yamtbx.dataproc.xds import XdsInp, modify_xdsinp
+
+master_params_str = """\
+xdsinp = None
+ .type = path
+ .help = "XDS.INP (not modified)"
+repeat = 100
+ .type = int(value_min=1)
+ .help = "Number of datasets simulated"
+"""
+
+# (edits, XDS is run after this?) in the order of xds_sequence(); string is appended to XDS.INP
+edit_sequence = [([("DELPHI", "5.0")], False),
+                 ([("MAXIMUM_NUMBER_OF_PROCESSORS", "8")], False),
+                 ([("JOB", "XYCORR INIT")], True),
+                 ([("JOB", "INIT"), ("DATA_RANGE", "3 1800")], True),
+                 ([("JOB", "COLSPOT")], True),
+                 ("\n SPOT_RANGE= 1 450\n", False),
+                 ([("JOB", "IDXREF"), ("UNIT_CELL_CONSTANTS", "70.000 80.000 90.000 90 90 90"),
+                   ("SPACE_GROUP_NUMBER", "19")], True),
+                 ([("JOB", "DEFPIX INTEGRATE"), ("INCLUDE_RESOLUTION_RANGE", "50 0")], True),
+                 ([("JOB", "CORRECT"), ("CORRECTIONS", ""), ("NBATCH", "1"), ("MINIMUM_I/SIGMA", "50"),
+                   ("REFINE(CORRECT)", "")], True),
+                 ([("SPACE_GROUP_NUMBER", "19"), ("UNIT_CELL_CONSTANTS", "70.12 80.23 90.34 90.00 90.00 90.00")], False),
+                 ([("JOB", "CORRECT")], True),
+                 ([("JOB", "CORRECT"), ("INCLUDE_RESOLUTION_RANGE", "50 1.80")], True)]
+
+def run_per_edit(xdsinp):
+    for edit, run_xds in edit_sequence:
+        if isinstance(edit, list): modify_xdsinp(xdsinp, edit)
+        else: open(xdsinp, "a").write(edit)
+# run_per_edit()
+
+def run_in_memory(xdsinp):
+    inp = XdsInp(xdsinp)
+    for edit, run_xds in edit_sequence:
+        if isinstance(edit, list): inp.modify(edit)
+        else: inp.append_str(edit)
+        if run_xds: inp.write()
+    inp.write()
+# run_in_memory()
+
+def run(params, out=sys.stdout):
+    tmpdir = tempfile.mkdtemp(prefix="xds_inp_benchmark")
+    try:
+        results = {}
+        for name, func in (("modify_xdsinp", run_per_edit), ("XdsInp", run_in_memory)):
+            xdsinp = os.path.join(tmpdir, "XDS.INP.%s" % name)
+            t = 0.
+            for i in range(params.repeat):
+                shutil.copyfile(params.xdsinp, xdsinp)
+                t0 = time.time()
+                func(xdsinp)
+                t += time.time() - t0
+            results[name] = t / params.repeat
+            print("%-14s %7.3f ms/dataset" % (name, results[name]*1.e3), file=out)
+
+        same = open(os.path.join(tmpdir, "XDS.INP.modify_xdsinp")).read() == open(os.path.join(tmpdir, "XDS.INP.XdsInp")).read()
+        print("%d edits per dataset; speed-up %.2f; identical output: %s" % (len(edit_sequence),
+                                                                          results["modify_xdsinp"]/max(1e-9, results["XdsInp"]),
+                                                                          same), file=out)
+    finally:
+        shutil.rmtree(tmpdir)
+# run()
+
+if __name__ == "__main__":
+    cmdline = iotbx.phil.process_command_line(args=sys.argv[1:],
+                                              master_string=master_params_str)
+    params = cmdline.work.extract()
+    if len(cmdline.remaining_args) > 0: params.xdsinp = cmdline.remaining_args[0]
+
+    if params.xdsinp is None:
+        print("Usage: %s XDS.INP [repeat=100]" % sys.argv[0])
+        print()
+        iotbx.phil.parse(master_params_str).show(prefix="  ", attributes_level=1)
+        quit()
+
+    run(params)
@@ -1,45 +1,234 @@
 """
-(c) RIKEN 2015. All rights reserved. 
+(c) RIKEN 2015. All rights reserved.
 Author: Keitaro Yamashita
 
 This software is released under the new BSD License; see LICENSE.
 """
 from __future__ import print_function
 from __future__ import unicode_literals
+import os
 import sys
+import time
+import shutil
+import tempfile
+import multiprocessing
+import numpy
 
+import iotbx.phil
 from cctbx.array_family import flex
-from cctbx import miller
+from libtbx import easy_mp
+from libtbx.utils import Sorry
 
+from yamtbx import util
 from yamtbx.dataproc.xds.xds_ascii import XDS_ASCII
+from yamtbx.dataproc.cc_matrix import miller_index_keys
 
-def run(lstin):
-    data = []
-    for l in open(lstin):
-        xdsasc = l.strip()
-        xa = XDS_ASCII(xdsasc, sys.stdout, i_only=True)
-        ma = miller.array(miller_set=xa.as_miller_set(anomalous_flag=False),
-                          data=xa.iobs)
-        data.append((xdsasc, ma))
-
-    print("index filename")
-    for i, d in enumerate(data):
-        print(i, d[0])
-
-    print("i j n.i n.j n.common cc")
-    for i in range(len(data)-1):
-        for j in range(i+1, len(data)):
-            di, dj = data[i][1].common_sets(data[j][1], assert_is_similar_symmetry=False)
-            print(i, j, data[i][1].data().size(), data[j][1].data().size(), end=' ') 
-            if len(di.data()) == 0:
-                print(0, "nan")
-            else:
-                corr = flex.linear_correlation(di.data(), dj.data())
-                assert corr.is_well_defined()
-                cc =  corr.coefficient()
-                print(len(di.data()), cc)
+master_params_str = """\
+lstin = None
+ .type = path
+ .help = "List of XDS_ASCII.HKL files"
+output = None
+ .type = path
+ .help = "Output file. Results are written as soon as computed and sorted in the end. If the file exists, the calculation is resumed. Default: stdout (not sorted)"
+nproc = None
+ .type = int(value_min=1)
+ .help = "Number of processes. Default: number of cores"
+max_memory_mb = 1024
+ .type = float
+ .help = "Approximate upper limit of memory (MB) for data loaded by all processes at once"
+"""
+
+header_pairs = "i j n.i n.j n.common cc"
+
+def cache_data(xdsasc, npzout):
+    """
+    Save data needed for CC calculation of xdsasc into npzout:
+    keys (of Miller indices) and intensities of all observations (used when the file is the second of a pair),
+    and sorted unique keys with intensities of their last observations (used when the file is the first of a pair).
+    Returns the number of observations.
+    """
+    xa = XDS_ASCII(xdsasc, i_only=True)
+    keys = miller_index_keys(xa.indices)
+    data = xa.iobs.as_numpy_array()
+    perm = numpy.argsort(keys, kind="mergesort")
+    skeys = keys[perm]
+    last = numpy.ones(len(skeys), dtype=bool)
+    last[:-1] = skeys[1:] != skeys[:-1]
+
+    numpy.savez(npzout, keys=keys, data=data, ukeys=skeys[last], udata=data[perm[last]])
+    return len(data)
+# cache_data()
+
+def calc_cc(di, dj):
+    """
+    Returns number of common observations and CC between data di and dj (dict saved by cache_data()),
+    which are the same as len() and linear_correlation of miller.array.common_sets(); i.e. each observation
+    in dj is paired with the last observation of the same index in di.
+    """
+    ukeys, keys = di["ukeys"], dj["keys"]
+    if len(ukeys) == 0 or len(keys) == 0: return 0, "nan"
+
+    pos = numpy.minimum(numpy.searchsorted(ukeys, keys), len(ukeys)-1)
+    sel = ukeys[pos] == keys
+    if not sel.any(): return 0, "nan"
+
+    corr = flex.linear_correlation(flex.double(di["udata"][pos[sel]]), flex.double(dj["data"][sel]))
+    assert corr.is_well_defined()
+    return int(sel.sum()), corr.coefficient()
+# calc_cc()
+
+pairwise_cc_worker_dict = {} # constants for worker processes; set before fork
+
+def pairwise_cc_worker(pairs):
+    """
+    Calculate CC for list of pairs [(i,j), ..]; returns output lines.
+    """
+    d = pairwise_cc_worker_dict
+    idxes = set([x[0] for x in pairs] + [x[1] for x in pairs])
+    data = dict([(i, numpy.load(d["npzfiles"][i])) for i in idxes])
+    ret = []
+    for i, j in pairs:
+        n, cc = calc_cc(data[i], data[j])
+        ret.append("%d %d %d %d %d %s\n" % (i, j, d["nobs"][i], d["nobs"][j], n, cc))
+    return ret
+# pairwise_cc_worker()
+
+def make_tasks(sizes, todo, max_bytes, nproc):
+    """
+    Split files into blocks so that data of two blocks (the unit of a task) for nproc processes fit in max_bytes.
+    Blocks are small enough to give several tasks per process. Returns lists of pairs in todo for each pair of blocks.
+    """
+    n = len(sizes)
+    nb_min = int(numpy.ceil(numpy.sqrt(8.*nproc))) # nb*(nb+1)/2 >= 4*nproc tasks
+    max_nfiles = max(1, int(numpy.ceil(n/float(nb_min))))
+    block_bytes = max_bytes / 2. / nproc
+
+    block_of = []
+    nb, cur_bytes, cur_n = 0, 0, 0
+    for s in sizes:
+        if cur_n > 0 and (cur_bytes + s > block_bytes or cur_n >= max_nfiles):
+            nb, cur_bytes, cur_n = nb+1, 0, 0
+        block_of.append(nb)
+        cur_bytes += s
+        cur_n += 1
+
+    tasks = {}
+    for i, j in todo: tasks.setdefault((block_of[i], block_of[j]), []).append((i, j))
+    return [tasks[k] for k in sorted(tasks)]
+# make_tasks()
+
+def read_output(output, files):
+    """
+    Read partially computed output. Returns set of computed pairs and their lines.
+    Incomplete lines (e.g. the job was killed while writing) are discarded.
+    """
+    done, lines = set(), []
+    in_pairs, idx_files = False, []
+    for l in open(output):
+        if not l.endswith("\n"): break
+        if not in_pairs:
+            if l.strip() == header_pairs: in_pairs = True
+            elif l.strip() != "index filename": idx_files.append(l.rstrip("\n").split(" ", 1)[1])
+            continue
+
+        sp = l.split()
+        if len(sp) != 6: break
+        done.add((int(sp[0]), int(sp[1])))
+        lines.append(l)
+
+    if in_pairs and idx_files != files:
+        raise Sorry("File list in %s does not match the input." % output)
+
+    return done, lines
+# read_output()
+
+def write_output(output, files, lines):
+    ofs = open(output+".tmp", "w")
+    ofs.write("index filename\n")
+    for i, f in enumerate(files): ofs.write("%d %s\n" % (i, f))
+    ofs.write(header_pairs+"\n")
+    for l in lines: ofs.write(l)
+    ofs.close()
+    os.rename(output+".tmp", output)
+# write_output()
+
+def run(params):
+    global pairwise_cc_worker_dict
+
+    if params.nproc is None: params.nproc = util.get_number_of_processors()
+    files = [l.strip() for l in open(params.lstin) if l.strip()]
+    all_pairs = [(i, j) for i in range(len(files)-1) for j in range(i+1, len(files))]
+
+    done, lines = set(), []
+    if params.output is not None and os.path.isfile(params.output):
+        done, lines = read_output(params.output, files)
+        print("Resuming %s: %d/%d pairs already calculated." % (params.output, len(done), len(all_pairs)))
+
+    if params.output is not None:
+        write_output(params.output, files, lines)
+        ofs = open(params.output, "a")
+    else:
+        ofs = sys.stdout
+        ofs.write("index filename\n")
+        for i, f in enumerate(files): ofs.write("%d %s\n" % (i, f))
+        ofs.write(header_pairs+"\n")
+
+    todo = [x for x in all_pairs if x not in done]
+    if not todo:
+        if ofs is not sys.stdout: ofs.close()
+        return
+
+    # local disk is preferred; output directory if there is not enough space
+    outdir = os.path.dirname(os.path.abspath(params.output if params.output is not None else params.lstin))
+    tmpdir = util.get_temp_local_dir("xds_pairwise_cc", min_bytes=sum([os.path.getsize(f) for f in files])//2,
+                                     additional_tmpd=outdir, use_ramdisk=False)
+    if tmpdir is None: tmpdir = tempfile.mkdtemp(prefix="xds_pairwise_cc", dir=outdir)
+
+    try:
+        npzfiles = [os.path.join(tmpdir, "%.6d.npz" % i) for i in range(len(files))]
+        nobs = easy_mp.pool_map(fixed_func=lambda i: cache_data(files[i], npzfiles[i]),
+                                args=list(range(len(files))),
+                                processes=params.nproc)
+        tasks = make_tasks([os.path.getsize(f) for f in npzfiles], todo, params.max_memory_mb*1024**2, params.nproc)
+
+        t_start = time.time()
+        n_done = 0
+        pairwise_cc_worker_dict = dict(npzfiles=npzfiles, nobs=nobs)
+        pool = multiprocessing.Pool(params.nproc)
+        try:
+            for ret in pool.imap_unordered(pairwise_cc_worker, tasks):
+                ofs.write("".join(ret))
+                ofs.flush()
+                lines.extend(ret)
+                n_done += len(ret)
+                if ofs is not sys.stdout:
+                    sys.stdout.write("%d/%d pairs calculated (%.1f pairs/sec)\r" % (n_done, len(todo), n_done/(time.time()-t_start+1e-6)))
+                    sys.stdout.flush()
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            pairwise_cc_worker_dict = {}
+    finally:
+        shutil.rmtree(tmpdir)
+
+    if ofs is not sys.stdout:
+        ofs.close()
+        print("%d pairs calculated in %.1f sec.                " % (n_done, time.time()-t_start))
+        lines.sort(key=lambda l: tuple(map(int, l.split()[:2])))
+        write_output(params.output, files, lines)
 # run()
 
 if __name__ == "__main__":
-    lst = sys.argv[1]
-    run(lst)
+    cmdline = iotbx.phil.process_command_line(args=sys.argv[1:],
+                                              master_string=master_params_str)
+    params = cmdline.work.extract()
+    if len(cmdline.remaining_args) > 0: params.lstin = cmdline.remaining_args[0]
+
+    if params.lstin is None:
+        print("Usage: %s files.lst [output=cc.dat] [nproc=] [max_memory_mb=]" % sys.argv[0])
+        print()
+        iotbx.phil.parse(master_params_str).show(prefix="  ", attributes_level=1)
+        quit()
+
+    run(params)
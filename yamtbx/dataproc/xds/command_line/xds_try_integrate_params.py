@@ -4,12 +4,14 @@
 Author: Keitaro Yamashita
 
 This software is released under the new BSD License; see LICENSE.
-"""
-"""
+
 Try several parameters in INTEGRATE step of XDS, and optionally run CORRECT and make mtz files which are ready for refinement.
 
 Usage:
   PHENIX_TRUST_OTHER_ENV=1 phenix.python xds_try_integrate_params.py delphi=5,10,15,...
+
+Each combination is processed in INTEGRATE_refine_*_delphi_*/ using symbolic links to files in the current directory.
+Combinations are run concurrently with nproc= and nproc_each=, e.g. nproc=64 nproc_each=4 runs 16 at once.
 """
 from __future__ import print_function
 from __future__ import absolute_import
@@ -30,18 +32,29 @@ run_correct = True
     .help = Run CORRECT (and make mtz) or not.
 mtz_free = None
     .type = path
+
+nproc = None
+    .type = int(value_min=1)
+    .help = Total number of cores. Default: all cores.
+nproc_each = None
+    .type = int(value_min=1)
+    .help = Number of cores for each XDS run. Combinations are run concurrently with nproc/nproc_each jobs. Default: nproc (one at a time).
+rank_by = *cc_half isa i_over_sigma r_meas
+    .type = choice(multi=False)
+    .help = Sort summary table by this statistic in CORRECT.LP
 """
 
 import os
-import shutil
 import itertools
 import traceback
 import iotbx.phil
 
 from yamtbx.dataproc.xds import *
+from yamtbx import util
 from yamtbx.util import call
 from yamtbx.dataproc.xds.command_line import xds2mtz
 from yamtbx.dataproc.xds import files
+from yamtbx.dataproc.xds import param_sweep
 from .xds_try_scale_params import get_digit, copy_testflag
 
 def make_all_refine_combinations():
@@ -70,6 +83,24 @@ def get_refine_defined(xdsinp):
         return [org_kwd[-1][1].strip().split()]
 # get_refine_defined(xdsinp)
 
+def make_mtz(work_dir, mtz_free=None):
+    try:
+        call("xdsstat", stdin="\n", stdout=open(os.path.join(work_dir, "XDSSTAT.LP"),"w"), wdir=work_dir)
+
+        xds2mtz.xds2mtz(os.path.join(work_dir, "XDS_ASCII.HKL"),
+                        dir_name=os.path.join(work_dir, "ccp4"),
+                        run_ctruncate=False, run_xtriage=True
+                        )
+
+        if mtz_free is not None:
+            copy_testflag(mtzfree=mtz_free,
+                          mtzin=os.path.join(work_dir, "ccp4", "XDS_ASCII.mtz"))
+    except:
+        print(traceback.format_exc())
+        print("Ignoring xds2mtz error..")
+        print()
+# make_mtz()
+
 def run(params):
     xdsinp = "XDS.INP"
     workdir = os.getcwd()
@@ -87,62 +118,35 @@ def run(params):
     else:
         refine_params = get_refine_defined(xdsinp)
 
-    backup_needed = files.generated_by_INTEGRATE + ("XDS.INP",)
-    if params.run_correct:
-        backup_needed += files.generated_by_CORRECT
-
-    bk_prefix = None
-
-    try:
-        for rp in refine_params:
-            rp_str = "refine_none" if len(rp) == 0 else "refine_" + "+".join(rp)
-
-            for delphi in params.delphi:
-                delphi_str = ("delphi_%."+digit_delphi+"f") % delphi
-
-                bk_prefix = make_backup(backup_needed) # Backup existing XDS.INP and others
-
-                work_name = "INTEGRATE_%s_%s" % (rp_str, delphi_str)
-
-                inp_params = [("JOB","INTEGRATE"),
-                              ("DELPHI", delphi),
-                              ("REFINE(INTEGRATE)", " ".join(rp))
-                              ]
-                if params.run_correct:
-                    inp_params[0] = ("JOB","INTEGRATE CORRECT")
-
-                modify_xdsinp(xdsinp, inp_params=inp_params)
-                call("xds_par", stdout=sys.stdout)
-
-                # Move files into a new directory.
-                os.mkdir(work_name)
-                for f in backup_needed:
-                    shutil.move(f, work_name)
+    if params.nproc is None: params.nproc = util.get_number_of_processors()
+    if params.nproc_each is None: params.nproc_each = params.nproc
 
-                if params.run_correct:
-                    # make .mtz file
-                    try:
-                        call("xdsstat", stdin="\n", stdout=open(os.path.join(work_name, "XDSSTAT.LP"),"w"), wdir=work_name)
+    tasks = []
+    for rp in refine_params:
+        rp_str = "refine_none" if len(rp) == 0 else "refine_" + "+".join(rp)
 
-                        xds2mtz.xds2mtz(os.path.abspath(os.path.join(work_name, "XDS_ASCII.HKL")),
-                                        dir_name=os.path.join(workdir, work_name, "ccp4"),
-                                        run_ctruncate=False, run_xtriage=True
-                                        )
+        for delphi in params.delphi:
+            delphi_str = ("delphi_%."+digit_delphi+"f") % delphi
+            work_name = "INTEGRATE_%s_%s" % (rp_str, delphi_str)
 
-                        if params.mtz_free is not None:
-                            copy_testflag(mtzfree=params.mtz_free,
-                                          mtzin=os.path.join(workdir, work_name, "ccp4", "XDS_ASCII.mtz"))
-                    except:
-                        print(traceback.format_exc())
-                        print("Ignoring xds2mtz error..")
-                        print()
+            inp_params = [("JOB","INTEGRATE"),
+                          ("DELPHI", delphi),
+                          ("REFINE(INTEGRATE)", " ".join(rp))
+                          ]
+            if params.run_correct:
+                inp_params[0] = ("JOB","INTEGRATE CORRECT")
 
-                revert_files(backup_needed, bk_prefix) # Revert XDS.INP and others
+            tasks.append((work_name, inp_params))
 
-    finally:
-        # 6. Revert XDS.INP, etc.
-        revert_files(backup_needed, bk_prefix)
+    # Each combination runs in its own directory; files in the current directory are not modified.
+    sweep = param_sweep.XdsParamSweep(workdir, files.needed_by_INTEGRATE,
+                                      xds_cmd="xds_par", nproc=params.nproc, nproc_each=params.nproc_each,
+                                      post_func=(lambda wd: make_mtz(wd, params.mtz_free)) if params.run_correct else None)
+    results = sweep.run(tasks)
 
+    print()
+    param_sweep.show_summary(results, params.rank_by)
+    param_sweep.show_summary(results, params.rank_by, out=open(os.path.join(workdir, "INTEGRATE_sweep_summary.dat"), "w"))
 # run()
 
 
@@ -4,12 +4,14 @@
 Author: Keitaro Yamashita
 
 This software is released under the new BSD License; see LICENSE.
-"""
-"""
+
 Try several scaling parameters in CORRECT step of XDS, and make mtz files which are ready for refinement.
 
 Usage:
   PHENIX_TRUST_OTHER_ENV=1 phenix.python xds_try_scale_params.py wfac1=1,1.2,0.8,...
+
+Each combination is processed in CORRECT_wfac1_*_minpk_*/ using symbolic links to files in the current directory,
+and nproc= combinations are run at once.
 """
 from __future__ import print_function
 from __future__ import unicode_literals
@@ -23,15 +25,23 @@ minpk = [75.0]
 
 mtz_free = None
     .type = path
+
+nproc = None
+    .type = int(value_min=1)
+    .help = Number of XDS runs at once. Default: number of cores.
+rank_by = *cc_half isa i_over_sigma r_meas
+    .type = choice(multi=False)
+    .help = Sort summary table by this statistic in CORRECT.LP
 """
 import os
 
 import iotbx.phil
 
-from yamtbx.dataproc.xds import *
+from yamtbx import util
 from yamtbx.util import call
 from yamtbx.dataproc.xds.command_line import xds2mtz
 from yamtbx.dataproc.xds import files
+from yamtbx.dataproc.xds import param_sweep
 
 def copy_testflag(mtzfree, mtzin):
     call(cmd="copy_free_R_flag.py -r %s %s" % (mtzfree, mtzin),
@@ -45,17 +55,28 @@ def get_digit(x):
     assert len(x) > 0
 
     if len(x) == 1:
-        m = str(x[0])
+        m = x[0]
     else:
-        m = str(min(list(map(lambda x,y:y-x, x[:-1], x[1:]))))
+        m = min(list(map(lambda x,y:y-x, x[:-1], x[1:])))
+    m = ("%.6f" % m).rstrip("0") # str() gives 0.19999999999999996 for 1.2-1.0 in python3
     if "." in m:
         return len(m) - m.index(".") - 1
     else:
         return 0
 # get_digit()
 
+def make_mtz(work_dir, mtz_free=None):
+    xds2mtz.xds2mtz(os.path.join(work_dir, "XDS_ASCII.HKL"),
+                    dir_name=os.path.join(work_dir, "ccp4"),
+                    run_ctruncate=True, run_xtriage=True
+                    )
+
+    if mtz_free is not None:
+        copy_testflag(mtzfree=mtz_free,
+                      mtzin=os.path.join(work_dir, "ccp4", "XDS_ASCII.mtz"))
+# make_mtz()
+
 def run(params):
-    xdsinp = "XDS.INP"
     workdir = os.getcwd()
 
     params.wfac1.sort()
@@ -63,35 +84,26 @@ def run(params):
     digit_wfac1 = str(get_digit(params.wfac1))
     digit_minpk = str(get_digit(params.minpk))
 
-    backup_needed = files.generated_by_CORRECT + ("XDS.INP",)
-
-    bk_prefix = make_backup(backup_needed)
-
-    try:
-        for wfac1 in params.wfac1:
-            for minpk in params.minpk:
-                work_name = ("CORRECT_wfac1_%."+digit_wfac1+"f_minpk_%."+digit_minpk+"f")%(wfac1,minpk)
-                modify_xdsinp(xdsinp, inp_params=[("JOB","CORRECT"),
-                                                  ("WFAC1", wfac1),
-                                                  ("MINPK", minpk),
-                                                  ])
-                call("xds")
-                # make .mtz file
-                xds2mtz.xds2mtz(os.path.abspath("XDS_ASCII.HKL"),
-                                dir_name=os.path.join(workdir, "ccp4_"+work_name),
-                                run_ctruncate=True, run_xtriage=True
-                                )
-
-                if params.mtz_free is not None:
-                    copy_testflag(mtzfree=params.mtz_free,
-                                  mtzin=os.path.join(workdir, "ccp4_"+work_name, "XDS_ASCII.mtz"))
-
-                make_backup(backup_needed, work_name+"_")
-
-    finally:
-        # 6. Revert XDS.INP, etc.
-        revert_files(backup_needed, bk_prefix)
-
+    if params.nproc is None: params.nproc = util.get_number_of_processors()
+
+    tasks = []
+    for wfac1 in params.wfac1:
+        for minpk in params.minpk:
+            work_name = ("CORRECT_wfac1_%."+digit_wfac1+"f_minpk_%."+digit_minpk+"f")%(wfac1,minpk)
+            tasks.append((work_name, [("JOB","CORRECT"),
+                                      ("WFAC1", wfac1),
+                                      ("MINPK", minpk),
+                                      ]))
+
+    # Each combination runs in its own directory; files in the current directory are not modified.
+    sweep = param_sweep.XdsParamSweep(workdir, files.needed_by_CORRECT,
+                                      xds_cmd="xds", nproc=params.nproc, nproc_each=1,
+                                      post_func=lambda wd: make_mtz(wd, params.mtz_free))
+    results = sweep.run(tasks)
+
+    print()
+    param_sweep.show_summary(results, params.rank_by)
+    param_sweep.show_summary(results, params.rank_by, out=open(os.path.join(workdir, "CORRECT_sweep_summary.dat"), "w"))
 # run()
 
 if __name__ == "__main__":
@@ -31,3 +31,5 @@ needed_by_COLSPOT = ("BKGINIT.cbf", "BLANK.cbf", "GAIN.cbf", "X-CORRECTIONS.cbf"
 
 needed_by_INTEGRATE = ("XPARM.XDS", "BKGPIX.cbf", "BLANK.cbf", "GAIN.cbf", "X-CORRECTIONS.cbf", "Y-CORRECTIONS.cbf")
 
+needed_by_CORRECT = ("INTEGRATE.HKL", "XPARM.XDS", "BKGPIX.cbf", "BLANK.cbf", "GAIN.cbf", "X-CORRECTIONS.cbf", "Y-CORRECTIONS.cbf")
+
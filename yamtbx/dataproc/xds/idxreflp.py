@@ -113,17 +113,60 @@ class IdxrefLp(object):
 # class IdxrefLp
 
 class SpotXds(object):
+    """
+    SPOT.XDS is kept in columns (numpy arrays):
+      xyz (n,3), intensity (n,), iseg (n,), hkl (n,3), and
+      has_iseg, has_hkl (n,) for whether the optional columns were given.
+    frames (frame number of each spot), indexed (bool) and index by frame are prepared on parsing.
+    items (list of ((x,y,z), intensity, iseg, (h,k,l))) is made only when needed.
+    """
     def __init__(self, sptxdsin):
-        self.items = []
         self.calc_d = None
+        self.geom = None # (wavelength, orgx, orgy, qx, distance)
+        self.set_columns(numpy.zeros((0,3)), numpy.zeros(0), numpy.zeros(0, dtype=int), numpy.zeros((0,3), dtype=int),
+                         numpy.zeros(0, dtype=bool), numpy.zeros(0, dtype=bool))
         if sptxdsin is not None:
             self.parse(sptxdsin)
     # __init__()
 
+    def set_columns(self, xyz, intensity, iseg, hkl, has_iseg, has_hkl):
+        self.xyz, self.intensity, self.iseg, self.hkl = xyz, intensity, iseg, hkl
+        self.has_iseg, self.has_hkl = has_iseg, has_hkl
+        self._items = None
+
+        self.frames = self.xyz[:,2].astype(int) + 1 # int() truncates toward zero as well
+        self.indexed = self.has_hkl & numpy.any(self.hkl != 0, axis=1)
+
+        # Spots of frame_numbers[i] are frame_order[frame_starts[i]:frame_starts[i+1]] (in the original order)
+        self.frame_order = numpy.argsort(self.frames, kind="mergesort")
+        self.frame_numbers, self.frame_starts = numpy.unique(self.frames[self.frame_order], return_index=True)
+        self.frame_starts = numpy.append(self.frame_starts, len(self.frames))
+    # set_columns()
+
     def parse(self, sptxdsin):
-        self.items = []
+        text = open(sptxdsin).read()
+        first = text.split("\n", 1)[0].split()
+        ncol = len(first)
+        nlines = text.strip().count("\n") + 1 if text.strip() else 0
+        vals = numpy.fromstring(text, sep=" ") if nlines > 0 else numpy.zeros(0)
+
+        if ncol in (4, 5, 7, 8) and vals.size == ncol * nlines:
+            vals = vals.reshape(nlines, ncol)
+            n = nlines
+            iseg, hkl = numpy.zeros(n, dtype=int), numpy.zeros((n,3), dtype=int)
+            if ncol in (5, 8): iseg = vals[:,4].astype(int)
+            if ncol in (7, 8): hkl = vals[:,ncol-3:].astype(int)
+            self.set_columns(vals[:,:3].copy(), vals[:,3].copy(), iseg, hkl,
+                             numpy.ones(n, dtype=bool) if ncol in (5, 8) else numpy.zeros(n, dtype=bool),
+                             numpy.ones(n, dtype=bool) if ncol in (7, 8) else numpy.zeros(n, dtype=bool))
+        else:
+            # Number of columns is not uniform.
+            self.parse_lines(text.splitlines())
+    # parse()
 
-        for l in open(sptxdsin):
+    def parse_lines(self, lines):
+        items = []
+        for l in lines:
             sp = l.split()
             x, y, z, intensity, iseg, h, k, l = (None,)*8
 
@@ -140,12 +183,34 @@ class SpotXds(object):
             if iseg is not None: iseg = int(iseg)
             if h is not None: h, k, l = list(map(int, (h, k, l)))
                 
-            self.items.append(((x, y, z), intensity, iseg, (h, k, l)))
-    # parse()
-    
+            items.append(((x, y, z), intensity, iseg, (h, k, l)))
+
+        n = len(items)
+        self.set_columns(numpy.array([x[0] for x in items], dtype=float).reshape(n, 3),
+                         numpy.array([x[1] for x in items], dtype=float),
+                         numpy.array([x[2] if x[2] is not None else 0 for x in items], dtype=int),
+                         numpy.array([x[3] if x[3][0] is not None else (0,0,0) for x in items], dtype=int).reshape(n, 3),
+                         numpy.array([x[2] is not None for x in items], dtype=bool),
+                         numpy.array([x[3][0] is not None for x in items], dtype=bool))
+        self._items = items
+    # parse_lines()
+
+    @property
+    def items(self):
+        if self._items is None:
+            isegs = [x if f else None for x, f in zip(self.iseg.tolist(), self.has_iseg.tolist())]
+            hkls = [x if f else (None,)*3 for x, f in zip(zip(*self.hkl.T.tolist()), self.has_hkl.tolist())]
+            self._items = list(zip(list(zip(*self.xyz.T.tolist())), self.intensity.tolist(), isegs, hkls))
+        return self._items
+    # items()
+
     def write(self, out, frame_selection=[]):
-        for (i, (xyz, intensity, iseg, hkl)) in enumerate(self.items):
-            if frame_selection and int(xyz[2])+1 not in frame_selection: continue
+        sel = numpy.ones(len(self.frames), dtype=bool)
+        if frame_selection:
+            sel = numpy.isin(self.frames, list(frame_selection))
+
+        for i in numpy.where(sel)[0]:
+            xyz, intensity, iseg, hkl = self.items[i]
             out.write("% .2f % .2f % .2f" % xyz)
             out.write(" % .1f" % intensity)
             if iseg is not None: out.write(" %d" % iseg)
@@ -153,91 +218,78 @@ class SpotXds(object):
             out.write("\n")
     # write()
 
+    def resolutions(self):
+        # Vectorized version of calc_d() for all spots
+        assert self.geom is not None
+        wavelength, orgx, orgy, qx, distance = self.geom
+        x, y = self.xyz[:,0], self.xyz[:,1]
+        return wavelength/2./numpy.sin(0.5*numpy.arctan(numpy.sqrt((x-orgx)**2+(y-orgy)**2)*qx/distance))
+    # resolutions()
+
     def collected_spots(self, with_resolution=True):
-        if len(self.items) == 0: return []
+        if len(self.frames) == 0: return []
 
         if with_resolution:
             assert self.calc_d is not None
-            
-        ret = []
-        for xyz, intensity, iseg, hkl in self.items:
-            if with_resolution:
-                ret.append(xyz+(intensity, self.calc_d(*xyz[:2]),))
-            else:
-                ret.append(xyz+(intensity, -1,))
-            
-        return ret
+            d = self.resolutions()
+        else:
+            d = numpy.empty(len(self.frames))
+            d.fill(-1)
+
+        return list(zip(*(self.xyz.T.tolist() + [self.intensity.tolist(), d.tolist()])))
     # collected_spots()
 
     def indexed_and_unindexed_by_frame(self):
-        if len(self.items) == 0: return []
-        data = {}
-        for xyz, intensity, iseg, hkl in self.items:
-            frame = int(xyz[2])+1
-            if frame not in data:
-                data[frame] = [0, 0]
-            if hkl[0] is None or all([h==0 for h in hkl]):
-                data[frame][1] += 1 # unindexed
-            else:
-                data[frame][0] += 1 # indexed
-
-        ret = list(data.items())
-        ret.sort(key=lambda x: x[0])
-        return ret
+        if len(self.frames) == 0: return []
+        n_all = numpy.diff(self.frame_starts)
+        n_ind = numpy.add.reduceat(self.indexed[self.frame_order].astype(int), self.frame_starts[:-1])
+        return [(f, [i, n-i]) for f, i, n in zip(self.frame_numbers.tolist(), n_ind.tolist(), n_all.tolist())]
     # indexed_and_unindexed_by_frame()
 
     def spots_by_frame(self):
-        if len(self.items) == 0: return
-        data = {}
-        for xyz, intensity, iseg, hkl in self.items:
-            frame = int(xyz[2])+1
-            data[frame] = data.get(frame, 0) + 1
-
-        return data
+        if len(self.frames) == 0: return
+        return dict(zip(self.frame_numbers.tolist(), numpy.diff(self.frame_starts).tolist()))
     # spots_by_frame()
 
     def indexed_and_unindexed_on_detector(self, with_resolution=True):
-        if len(self.items) == 0: return
-
-        data = {"indexed": [], "unindexed": []}
+        if len(self.frames) == 0: return
 
         if with_resolution:
             assert self.calc_d is not None
-            
-
-        for xyz, intensity, iseg, hkl in self.items:
-            tmp = xyz[:2]
-            if with_resolution:
-                tmp += self.calc_d(*xyz[:2]),
-            else:
-                tmp += -1,
-
-            if hkl[0] is None or all([h==0 for h in hkl]):
-                data["unindexed"].append(tmp)
-            else:
-                data["indexed"].append(tmp)
-
-        return data
+            d = self.resolutions()
+        else:
+            d = numpy.empty(len(self.frames))
+            d.fill(-1)
+
+        tmp = numpy.column_stack((self.xyz[:,:2], d))
+        return {"indexed": list(zip(*tmp[self.indexed].T.tolist())),
+                "unindexed": list(zip(*tmp[~self.indexed].T.tolist()))}
     # indexed_and_unindexed_on_detector()
 
     def indexed_and_unindexed_by_frame_on_detector(self):
-        if len(self.items) == 0: return
+        if len(self.frames) == 0: return
 
         data = {"indexed": {}, "unindexed": {}}
 
-        for xyz, intensity, iseg, hkl in self.items:
-            frame = int(xyz[2])+1
-            tmp = xyz[:2]
-
-            key = "unindexed" if hkl[0] is None or all([h==0 for h in hkl]) else "indexed"
-            data[key].setdefault(frame, []).append(tmp)
+        for i, f in enumerate(self.frame_numbers.tolist()):
+            idxes = self.frame_order[self.frame_starts[i]:self.frame_starts[i+1]]
+            indexed = self.indexed[idxes]
+            xy = self.xyz[idxes,:2]
+            if indexed.any(): data["indexed"][f] = list(zip(*xy[indexed].T.tolist()))
+            if not indexed.all(): data["unindexed"][f] = list(zip(*xy[~indexed].T.tolist()))
 
         return data
     # indexed_and_unindexed_by_frame_on_detector()
 
+    def set_geometry(self, wavelength, orgx, orgy, qx, distance):
+        # XXX no support for non-normal incident beam or multipanel detector
+        self.geom = (wavelength, orgx, orgy, qx, distance)
+        self.calc_d = lambda x, y: wavelength/2./math.sin(0.5*math.atan(math.sqrt((x-orgx)**2+(y-orgy)**2)*qx/distance))
+    # set_geometry()
+
     def set_xparm(self, xparm_in):
         xparm = XPARM(xparm_in)
-        self.calc_d = lambda x, y: xparm.wavelength/2./math.sin(0.5*math.atan(math.sqrt((x-xparm.origin[0])**2+(y-xparm.origin[1])**2)*xparm.qx/abs(xparm.distance)))
+        self.set_geometry(xparm.wavelength, xparm.origin[0], xparm.origin[1], xparm.qx, abs(xparm.distance))
     # set_xparm()
 
     def set_xdsinp(self, xdsinp):
@@ -246,10 +298,7 @@ class SpotXds(object):
         orgx, orgy = list(map(float, (inp["ORGX"], inp["ORGY"])))
         qx = float(inp["QX"])
         distance = abs(float(inp["DETECTOR_DISTANCE"]))
-
-        # XXX no support for non-normal incident beam or multipanel detector
-        self.calc_d = lambda x, y: wavelength/2./math.sin(0.5*math.atan(math.sqrt((x-orgx)**2+(y-orgy)**2)*qx/distance))
+        self.set_geometry(wavelength, orgx, orgy, qx, distance)
     # set_xdsinp()
 
-
 # class SpotXds
@@ -0,0 +1,144 @@
+"""
+(c) RIKEN 2015. All rights reserved.
+Author: Keitaro Yamashita
+
+This software is released under the new BSD License; see LICENSE.
+"""
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+import os
+import sys
+import shutil
+import traceback
+from libtbx import easy_mp
+
+from yamtbx.dataproc.xds import XdsInp
+from yamtbx.dataproc.xds import correctlp
+from yamtbx.util import call
+
+# keywords whose values may be relative paths from the directory of XDS.INP
+path_keywords = ("NAME_TEMPLATE_OF_DATA_FRAMES", "LIB", "REFERENCE_DATA_SET")
+
+def read_correct_stats(wdir):
+    """
+    Statistics for ranking. NaN if CORRECT.LP is not available.
+    """
+    nan = float("nan")
+    ret = dict(isa=nan, cmpl=nan, i_over_sigma=nan, r_meas=nan, cc_half=nan, cc_half_outer=nan)
+    lpfile = os.path.join(wdir, "CORRECT.LP")
+    if not os.path.isfile(lpfile): return ret
+
+    try:
+        lp = correctlp.CorrectLp(lpfile)
+    except:
+        print(traceback.format_exc())
+        return ret
+
+    ret["isa"] = lp.get_ISa()
+    if "all" in lp.table:
+        table = lp.table["all"]
+        for k in ("cmpl", "i_over_sigma", "r_meas", "cc_half"):
+            ret[k] = table[k][-1] # total
+        if len(table["cc_half"]) > 1:
+            ret["cc_half_outer"] = table["cc_half"][-2]
+    return ret
+# read_correct_stats()
+
+class XdsParamSweep(object):
+    """
+    Run XDS for each set of XDS.INP parameters in its own directory (<srcdir>/<work_name>).
+    Input files (needed_files) are symbolic links to those in srcdir, which are never modified.
+    Runs are executed concurrently so that the total number of cores does not exceed nproc;
+    each XDS run uses nproc_each cores (MAXIMUM_NUMBER_OF_PROCESSORS=).
+    Each run is prepared and processed in <work_name>.tmp, which is renamed to <work_name> when finished.
+    A completed run (<work_name> exists) is not processed again, but its result is included in the summary;
+    <work_name>.tmp left by an interrupted or failed run is removed and processed again.
+    """
+    def __init__(self, srcdir, needed_files, xds_cmd="xds_par", nproc=1, nproc_each=1, post_func=None):
+        self.srcdir = os.path.abspath(srcdir)
+        self.needed_files = needed_files
+        self.xds_cmd = xds_cmd
+        self.nproc = nproc
+        self.nproc_each = min(nproc_each, nproc)
+        self.post_func = post_func # called with work directory after XDS run
+        self.xdsinp = XdsInp(os.path.join(self.srcdir, "XDS.INP"))
+    # __init__()
+
+    def prepare_workdir(self, work_name, inp_params, wdir=None):
+        if wdir is None: wdir = os.path.join(self.srcdir, work_name)
+        os.mkdir(wdir)
+
+        for f in self.needed_files:
+            if os.path.isfile(os.path.join(self.srcdir, f)):
+                os.symlink(os.path.join(self.srcdir, f), os.path.join(wdir, f))
+
+        inp_params = list(inp_params) + [("MAXIMUM_NUMBER_OF_PROCESSORS", self.nproc_each),
+                                         ("MAXIMUM_NUMBER_OF_JOBS", 1)]
+        for k in path_keywords:
+            val = self.xdsinp.get(k)
+            if not val or k in [x[0] for x in inp_params]: continue
+            sp = val.split()
+            if os.path.isabs(sp[0]): continue
+            sp[0] = os.path.normpath(os.path.join(self.srcdir, sp[0]))
+            inp_params.append((k, " ".join(sp)))
+
+        inp = XdsInp(inp_str=self.xdsinp.as_str())
+        inp.modify(inp_params)
+        inp.write(os.path.join(wdir, "XDS.INP"))
+        return wdir
+    # prepare_workdir()
+
+    def run_one(self, work_name, inp_params):
+        wdir = os.path.join(self.srcdir, work_name)
+        tmpdir = wdir + ".tmp"
+        if os.path.isdir(wdir):
+            print("%s was completed. skipping." % work_name)
+        else:
+            if os.path.isdir(tmpdir):
+                print("Removing incomplete %s" % os.path.basename(tmpdir))
+                shutil.rmtree(tmpdir)
+
+            print("Running %s" % work_name)
+            sys.stdout.flush()
+            try:
+                self.prepare_workdir(work_name, inp_params, wdir=tmpdir)
+                call(self.xds_cmd, stdout=open(os.path.join(tmpdir, "xds.log"), "w"), wdir=tmpdir)
+                if self.post_func is not None:
+                    self.post_func(tmpdir)
+                os.rename(tmpdir, wdir)
+            except:
+                print("Error in %s" % work_name)
+                print(traceback.format_exc())
+
+        ret = read_correct_stats(wdir)
+        ret["name"] = work_name
+        return ret
+    # run_one()
+
+    def run(self, tasks):
+        """
+        tasks = [(work_name, inp_params), ...]
+        Returns list of dict of statistics in the order of tasks.
+        """
+        nconc = max(1, self.nproc//self.nproc_each)
+        print("Running %d jobs; %d at once using %d cores each" % (len(tasks), nconc, self.nproc_each))
+        return easy_mp.pool_map(fixed_func=lambda x: self.run_one(*x),
+                                args=tasks,
+                                processes=nconc)
+    # run()
+# class XdsParamSweep
+
+def show_summary(results, rank_by="cc_half", out=sys.stdout):
+    """
+    Show results sorted by rank_by (descending; ascending for r_meas). Results without statistics come last.
+    """
+    sign = 1 if rank_by == "r_meas" else -1
+    ranked = sorted(results, key=lambda x: (x[rank_by]!=x[rank_by], sign*x[rank_by] if x[rank_by]==x[rank_by] else 0))
+    maxlen = max([len("name")] + [len(x["name"]) for x in results])
+
+    print(("%4s %-"+str(maxlen)+"s %6s %6s %6s %6s %7s %7s") % ("rank", "name", "ISa", "Cmpl", "I/sigI", "Rmeas", "CC1/2", "CC1/2ou"), file=out)
+    for i, r in enumerate(ranked):
+        print(("%4d %-"+str(maxlen)+"s %6.2f %6.1f %6.2f %6.1f %7.1f %7.1f") % (i+1, r["name"], r["isa"], r["cmpl"], r["i_over_sigma"],
+                                                                             r["r_meas"], r["cc_half"], r["cc_half_outer"]), file=out)
+# show_summary()
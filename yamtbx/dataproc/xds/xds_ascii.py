@@ -8,6 +8,7 @@ from __future__ import print_function
 from __future__ import unicode_literals
 import re
 import os
+import itertools
 import numpy
 from cctbx import crystal
 from cctbx import miller
@@ -145,7 +146,50 @@ class XDS_ASCII(object):
 
     # read_header()
     
+    def read_data_i_only(self, chunk_size=100000):
+        """
+        Faster version of read_data() for i_only=True. Text is converted by numpy in chunks of lines.
+        Returns False (nothing is read) if the data lines could not be converted in this way.
+        """
+        colindex = self._colindex
+        nitem = len(colindex)
+        cols = [colindex[k] for k in ("H", "K", "L", "IOBS", "SIGMA(IOBS)")]
+
+        ifs = open(self._filein)
+        for line in ifs:
+            if line.startswith('!END_OF_HEADER'):
+                break
+
+        chunks = []
+        while True:
+            text = "".join(itertools.islice(ifs, chunk_size))
+            if not text: break
+            end = "!" in text # !END_OF_DATA
+            if end: text = text[:text.index("!")]
+            nlines = text.count("\n")
+            vals = numpy.fromstring(text, sep=" ") if nlines > 0 else numpy.zeros(0)
+            if vals.size != nlines * nitem: return False
+            chunks.append(vals.reshape(nlines, nitem)[:,cols])
+            if end: break
+
+        vals = numpy.concatenate(chunks) if chunks else numpy.zeros((0, 5))
+        if vals.shape[0] != self._num_hkl: return False
+
+        hkl = [flex.int(vals[:,i].astype(numpy.int32)) for i in range(3)]
+        self.indices = flex.miller_index(*hkl)
+        self.iobs = flex.double(numpy.ascontiguousarray(vals[:,3]))
+        self.sigma_iobs = flex.double(numpy.ascontiguousarray(vals[:,4]))
+        self.xd, self.yd, self.zd, self.rlp, self.peak, self.corr = [flex.double() for i in range(6)]
+        self.iframe, self.iset = flex.int(), flex.int()
+
+        print("Reading data done.\n", file=self._log)
+        return True
+    # read_data_i_only()
+
     def read_data(self):
+        if self.i_only and self.read_data_i_only():
+            return
+
         colindex = self._colindex
         is_xscale = "RLP" not in colindex
         flag_data_start = False
@@ -254,7 +254,7 @@ def check_disk_free_bytes(d):
         return -1
 # check_disk_free_bytes()
 
-def get_temp_local_dir(prefix, min_bytes=None, min_kb=None, min_mb=None, min_gb=None, additional_tmpd=None):
+def get_temp_local_dir(prefix, min_bytes=None, min_kb=None, min_mb=None, min_gb=None, additional_tmpd=None, use_ramdisk=True):
     assert (min_bytes, min_kb, min_mb, min_gb).count(None) >= 2
 
     min_free_bytes = 0
@@ -266,7 +266,7 @@ def get_temp_local_dir(prefix, min_bytes=None, min_kb=None, min_mb=None, min_gb=
 
     ramdisk = "/dev/shm"
 
-    if os.path.isdir(ramdisk): tmpdirs = [ramdisk, tempfile.gettempdir()]
+    if use_ramdisk and os.path.isdir(ramdisk): tmpdirs = [ramdisk, tempfile.gettempdir()]
     else: tmpdirs = [tempfile.gettempdir()]
 
     if type(additional_tmpd) is str:
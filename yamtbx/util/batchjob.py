@@ -9,6 +9,7 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import os, subprocess, re, threading, time, stat
+import getpass
 import shlex
 
 # JobState
@@ -43,27 +44,69 @@ class SgeError(Exception):
 class SlurmError(Exception):
     pass
 
+class JobStateStore(object):
+    """
+    Job states shared between a JobManager and threads waiting for the jobs.
+    Every change of state wakes up the waiters, so no polling is needed for jobs whose
+    completion is notified (local processes).
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+
+    def set(self, j, state):
+        with self.cond:
+            j.state = state
+            self.cond.notify_all()
+    # set()
+
+    def notify(self):
+        with self.cond:
+            self.cond.notify_all()
+    # notify()
+
+    def wait_for(self, predicate, timeout=None):
+        # returns predicate() after it became true or timeout (sec) passed.
+        with self.cond:
+            endt = time.time() + timeout if timeout is not None else None
+            while not predicate():
+                if endt is None:
+                    self.cond.wait()
+                else:
+                    rest = endt - time.time()
+                    if rest <= 0: break
+                    self.cond.wait(rest)
+            return predicate()
+    # wait_for()
+# class JobStateStore
+
 class JobManager(object): # interface
-    def __init__(self): pass
+    def __init__(self):
+        self.store = JobStateStore()
     def submit(self, j): pass
-    def update_stat(self, j): pass # update j's state to RUNNING/FINISHED
+    def update_state(self, j): pass # update j's state to RUNNING/FINISHED
+    def update_states(self, jobs): # may be overridden to check all jobs at once
+        for job in jobs: self.update_state(job)
     def stop_all(self):pass
     def wait_all(self, jobs, interval=5, timeout=-1):
-        acc = 0
+        # Jobs are checked once per interval (in one query if the engine supports it),
+        # but returns as soon as finished jobs are notified through self.store.
+        all_finished = lambda: all([job.state==STATE_FINISHED for job in jobs])
+        startt = time.time()
         while True:
-            for job in jobs: self.update_state(job)
-            if all([job.state==STATE_FINISHED for job in jobs]):
+            self.update_states(jobs)
+            wait = interval
+            if timeout > 0:
+                wait = min(interval, timeout - (time.time() - startt))
+                if wait <= 0: return all_finished()
+            if self.store.wait_for(all_finished, timeout=wait):
                 return True
-            
-            time.sleep(interval)
-            acc += interval
-            if timeout > 0 and acc > timeout: return False
     # wait_all()
 # class JobManager
+
 class LocalThread(threading.Thread):
-    def __init__(self, num_jobs):
+    def __init__(self, num_jobs, store=None):
         self._stopevent = threading.Event()
-        self._sleepperiod = 1.0
+        self.store = store if store is not None else JobStateStore()
 
         self.num_jobs = num_jobs
         self.waiting_jobs = [] # [Job, ...]
@@ -80,35 +123,50 @@ class LocalThread(threading.Thread):
                              universal_newlines=True)
         return p
     # start_job()
-    
-    def run(self):
-        while not self._stopevent.isSet():
-            # Change state if finished
-            for j, p in self.p_list:
-                if p.poll() is not None:
-                    j.state = STATE_FINISHED
 
-            # Keep unfinished jobs
-            self.p_list = [p for p in self.p_list if p[1].poll() is None]
+    def add_job(self, j):
+        with self.store.cond:
+            self.waiting_jobs.append(j)
+            j.state = STATE_SUBMITTED
+            self.store.cond.notify_all()
+    # add_job()
+
+    def wait_process(self, j, p):
+        # Runs in its own thread; the job is marked finished when the process exits.
+        p.wait()
+        with self.store.cond:
+            self.p_list = [x for x in self.p_list if x[1] is not p]
+            if not self._stopevent.isSet():
+                j.state = STATE_FINISHED
+            self.store.cond.notify_all()
+    # wait_process()
 
-            # Register new jobs
-            for i in range(self.num_jobs - len(self.p_list)):
-                # Start conversion
-                if len(self.waiting_jobs) > 0:
+    def run(self):
+        cond = self.store.cond
+        with cond:
+            while not self._stopevent.isSet():
+                # Register new jobs
+                while self.waiting_jobs and len(self.p_list) < self.num_jobs:
                     j = self.waiting_jobs.pop(0)
-                    self.p_list.append( (j, self.start_job(j)) )
+                    p = self.start_job(j)
+                    self.p_list.append( (j, p) )
                     j.state = STATE_RUNNING
-            
-            time.sleep(0.1)
+                    t = threading.Thread(target=self.wait_process, args=(j, p))
+                    t.daemon = True
+                    t.start()
+
+                # Sleep until a job is submitted or finished
+                cond.wait()
 
-        if self._stopevent.isSet():
             for j, p in self.p_list:
                 p.kill()
                 j.state = STATE_FAILED
+            cond.notify_all()
     # run()
 
     def join(self, timeout=None):
         self._stopevent.set()
+        self.store.notify()
         threading.Thread.join(self, timeout)
     # join()
     
@@ -119,18 +177,17 @@ class ExecLocal(JobManager):
     def __init__(self, max_parallel):
         JobManager.__init__(self)
         self.num_jobs = max_parallel # referred by control tower when pickling
-        self._thread = LocalThread(num_jobs=self.num_jobs)
+        self._thread = LocalThread(num_jobs=self.num_jobs, store=self.store)
         self._thread.start()
         
     # __init__()
 
     def submit(self, j):
-        self._thread.waiting_jobs.append(j)
-        j.state = STATE_SUBMITTED
+        self._thread.add_job(j)
     # submit()
     
     def update_state(self, j):
-        # if running locally, state is changed during execution loop
+        # if running locally, state is changed when the process exits
         pass
                                             
     def stop_all(self):
@@ -138,10 +195,66 @@ class ExecLocal(JobManager):
 
 # class ExecLocal
         
-
-class SGE(JobManager):
-    def __init__(self, pe_name="par"):
+class ClusterJobManager(JobManager):
+    """
+    Base class for queueing systems.
+    States of all submitted jobs are checked with one query of the queue (list_queued_ids()),
+    which is not repeated within min_query_interval seconds.
+    """
+    def __init__(self, min_query_interval=1.):
         JobManager.__init__(self)
+        self.job_id = {} # [Job: jobid]
+        self.min_query_interval = min_query_interval
+        self._last_query_time = None
+    # __init__()
+
+    def list_queued_ids(self): return None # to be overridden. returns set of job ids in queue, or None if failed.
+
+    def update_states(self, jobs):
+        # jobs is not used; all submitted jobs are updated at once.
+        if not self.job_id: return
+        if self._last_query_time is not None and time.time() - self._last_query_time < self.min_query_interval:
+            return
+
+        queued = self.list_queued_ids()
+        self._last_query_time = time.time()
+        if queued is None: return # keep states until next successful query
+
+        for j, job_id in list(self.job_id.items()):
+            if job_id in queued:
+                if j.state != STATE_RUNNING: self.store.set(j, STATE_RUNNING)
+            else:
+                print("job %s finished (not in queue)." % job_id)
+                self.job_id.pop(j)
+                self.store.set(j, STATE_FINISHED)
+    # update_states()
+
+    def update_state(self, j):
+        # if job_id is unknown (waiting or finished), state won't be changed
+        if j in self.job_id:
+            self.update_states([j])
+    # update_state()
+
+    def register_submitted(self, j, job_id):
+        self.job_id[j] = job_id
+        self.store.set(j, STATE_SUBMITTED)
+        self._last_query_time = None # next update must see this job
+    # register_submitted()
+
+    def run_query(self, cmd):
+        p = subprocess.Popen(cmd, shell=True,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        stdout, stderr = p.communicate()
+        if p.returncode != 0:
+            print("%s failed (returned %s): %s" % (cmd, p.returncode, stderr.strip()))
+            return None
+        return stdout
+    # run_query()
+# class ClusterJobManager
+
+class SGE(ClusterJobManager):
+    def __init__(self, pe_name="par", min_query_interval=1.):
+        ClusterJobManager.__init__(self, min_query_interval)
         self.pe_name = pe_name
 
         qsub_found, qstat_found = False, False
@@ -154,8 +267,6 @@ class SGE(JobManager):
 
         if not( qsub_found and qstat_found ):
             raise SgeError("cannot find qsub or qstat command under $PATH")
-                
-        self.job_id = {} # [Job: jobid]
     # __init__()
 
     def submit(self, j):
@@ -185,25 +296,27 @@ class SGE(JobManager):
         if job_id == "":
             raise SgeError("cannot read job-id from qsub result. please contact author. stdout is:\n" % stdout)
         
-        self.job_id[j] = job_id
+        self.register_submitted(j, job_id)
         print("Job %s on %s is started. id=%s"%(j.script_name, j.wdir, job_id))
 
     # submit()
 
-    def update_state(self, j):
-        # if job_id is unknown (waiting or finished), state won't be changed
-        if j in self.job_id:
-            status = self.qstat(self.job_id[j])
-
-            if status is None: # if qsub failed, flagged as FINISHED
-                j.state = STATE_FINISHED
-                self.job_id.pop(j)
-                #j.check_after_run() # j.state may be changed to FAILED
+    def list_queued_ids(self):
+        """
+        example:
+        job-ID  prior   name       user         state submit/start at     queue                          slots ja-task-ID 
+        -----------------------------------------------------------------------------------------------------------------
+            123 0.55500 xds.sh     user         r     05/10/2016 10:10:10 all.q@node1                        4        
+        """
+        stdout = self.run_query("qstat -u %s" % getpass.getuser())
+        if stdout is None: return None
 
-            else: # if qsub succeeded, RUNNING or WAITING.
-                j.state = STATE_RUNNING
-            
-    # update_state()
+        ids = set()
+        for l in stdout.splitlines():
+            sp = l.split()
+            if sp and sp[0].isdigit(): ids.add(sp[0])
+        return ids
+    # list_queued_ids()
 
     def qstat(self, job_id):
         cmd = "qstat -j %s" % job_id
@@ -251,9 +364,9 @@ class SGE(JobManager):
 
 # class SGE
 
-class Slurm(JobManager):
-    def __init__(self):
-        JobManager.__init__(self)
+class Slurm(ClusterJobManager):
+    def __init__(self, min_query_interval=1.):
+        ClusterJobManager.__init__(self, min_query_interval)
 
         sbatch_found, squeue_found = False, False
         
@@ -265,8 +378,6 @@ class Slurm(JobManager):
 
         if not( sbatch_found and squeue_found ):
             raise SlurmError("cannot find sbatch or squeue command under $PATH")
-                
-        self.job_id = {} # [Job: jobid]
     # __init__()
 
     def submit(self, j):
@@ -293,25 +404,16 @@ class Slurm(JobManager):
         if job_id == "":
             raise SlurmError("cannot read job-id from sbatch result. please contact author. stdout is:\n" % stdout)
         
-        self.job_id[j] = job_id
+        self.register_submitted(j, job_id)
         print("Job %s on %s is started. id=%s"%(j.script_name, j.wdir, job_id))
 
     # submit()
 
-    def update_state(self, j):
-        # if job_id is unknown (waiting or finished), state won't be changed
-        if j in self.job_id:
-            status = self.qstat(self.job_id[j])
-
-            if status is None: # if sbatch failed, flagged as FINISHED?
-                j.state = STATE_FINISHED
-                self.job_id.pop(j)
-                #j.check_after_run() # j.state may be changed to FAILED
-
-            else: # if sbatch succeeded, RUNNING or WAITING.
-                j.state = STATE_RUNNING
-            
-    # update_state()
+    def list_queued_ids(self):
+        stdout = self.run_query('squeue -h -o "%%i" -u %s' % getpass.getuser())
+        if stdout is None: return None
+        return set([x.strip() for x in stdout.splitlines() if x.strip()])
+    # list_queued_ids()
 
     def qstat(self, job_id):
         cmd = "squeue --job %s" % job_id